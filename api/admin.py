@@ -1,19 +1,19 @@
 from django.contrib import admin
 from django.utils.html import format_html
 from django import forms
-from .models import Product, Order, AdminSettings
-import base64
+from .models import Product, Order, ArchivedOrder, SalesRollup, AdminSettings
+from .images import InvalidImage, store_image, thumbnail_url
 
 
 class ProductAdminForm(forms.ModelForm):
-    """Custom form to handle image file upload and convert to base64"""
+    """Custom form to handle image file upload into the image store"""
     image_file = forms.ImageField(required=False, label='Upload Image')
     
     class Meta:
         model = Product
         fields = '__all__'
         widgets = {
-            'image': forms.HiddenInput()  # Hide the base64 field
+            'image': forms.HiddenInput()  # Hide the external image URL field
         }
     
     def __init__(self, *args, **kwargs):
@@ -22,18 +22,22 @@ class ProductAdminForm(forms.ModelForm):
         if 'image' in self.fields:
             self.fields['image'].widget = forms.HiddenInput()
     
+    def clean_image_file(self):
+        image_file = self.cleaned_data.get('image_file')
+        if image_file:
+            # Store (and thumbnail) the upload once; save() only links the digest
+            try:
+                self._image_digest = store_image(image_file.read(), image_file.content_type or 'image/jpeg')
+            except InvalidImage as e:
+                raise forms.ValidationError(str(e))
+        return image_file
+    
     def save(self, commit=True):
         instance = super().save(commit=False)
         
-        # Convert uploaded image to base64
-        if self.cleaned_data.get('image_file'):
-            image_file = self.cleaned_data['image_file']
-            image_data = image_file.read()
-            base64_encoded = base64.b64encode(image_data).decode('utf-8')
-            
-            # Detect image format
-            content_type = image_file.content_type or 'image/jpeg'
-            instance.image = f"data:{content_type};base64,{base64_encoded}"
+        if getattr(self, '_image_digest', None):
+            instance.image_digest = self._image_digest
+            instance.image = None
         
         if commit:
             instance.save()
@@ -67,20 +71,20 @@ class ProductAdmin(admin.ModelAdmin):
     
     def image_preview(self, obj):
         """Display small image preview in list view"""
-        if obj.image:
+        if obj.image_digest or obj.image:
             return format_html(
-                '<img src="{}" style="width: 50px; height: 50px; object-fit: cover; border-radius: 4px;" />',
-                obj.image
+                '<img src="{}" style="width: 50px; height: 50px; object-fit: cover; border-radius: 4px;" loading="lazy" />',
+                thumbnail_url(obj.image_digest, 150) if obj.image_digest else obj.image
             )
         return format_html('<span style="color: #999;">No image</span>')
     image_preview.short_description = 'Image'
     
     def image_preview_large(self, obj):
         """Display large image preview in detail view"""
-        if obj.image:
+        if obj.image_digest or obj.image:
             return format_html(
                 '<img src="{}" style="max-width: 300px; max-height: 300px; border-radius: 8px; box-shadow: 0 2px 8px rgba(0,0,0,0.1);" />',
-                obj.image
+                thumbnail_url(obj.image_digest, 600) if obj.image_digest else obj.image
             )
         return format_html('<span style="color: #999;">No image uploaded</span>')
     image_preview_large.short_description = 'Current Image'
@@ -91,7 +95,26 @@ class OrderAdmin(admin.ModelAdmin):
     list_display = ['order_id', 'customer_name', 'phone_number', 'total_amount', 'status', 'created_at']
     list_filter = ['status', 'created_at']
     search_fields = ['order_id', 'customer_name', 'phone_number']
-    readonly_fields = ['order_id', 'created_at', 'expires_at']
+    readonly_fields = ['order_id', 'created_at', 'expires_at', 'telegram_board']
+
+
+@admin.register(ArchivedOrder)
+class ArchivedOrderAdmin(admin.ModelAdmin):
+    list_display = ['order_id', 'customer_name', 'phone_number', 'total_amount', 'status', 'created_at', 'archived_at']
+    list_filter = ['status', 'created_at']
+    search_fields = ['order_id', 'customer_name', 'phone_number']
+
+
+@admin.register(SalesRollup)
+class SalesRollupAdmin(admin.ModelAdmin):
+    list_display = ['granularity', 'bucket_start', 'category', 'orders', 'completed', 'cancellations', 'revenue', 'units']
+    list_filter = ['granularity', 'category']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
 
 
 @admin.register(AdminSettings)
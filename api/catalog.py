@@ -0,0 +1,236 @@
+"""
+Versioned product catalog cache for GET /api/products
+
+The rendered catalog JSON is stored in the shared Django cache together with
+a strong ETag and the catalog version it was built from. Any product change
+bumps the version (after the transaction commits), so the next request
+rebuilds the payload once and every other request is served from the cache.
+
+Clients that keep the catalog locally sync with GET /api/products?since=<token>
+instead (get_changes): only the products created or changed since the token
+(Product.updated_at, which stock changes bump too), the ids of products
+deactivated or deleted since (ProductTombstone), and a new token. A token is
+the server time of the previous sync; each sync looks back a further
+TOKEN_GRACE so a change whose transaction committed late is not missed, and
+clients merge by id, so repeats are harmless. When nothing changed (the
+catalog version is older than that), the answer costs one cache read.
+"""
+
+import hashlib
+import logging
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = 'catalog:version'
+# (version, etag, body, token)
+PAYLOAD_KEY = 'catalog:payload:2'
+LOCK_KEY = 'catalog:rebuild-lock'
+
+# A rebuild normally takes a few milliseconds; the lock only guards against
+# a crashed worker holding it forever.
+LOCK_TIMEOUT = 10
+WAIT_TIMEOUT = 2.0
+WAIT_STEP = 0.02
+
+TOKEN_GRACE = timedelta(seconds=60)
+# Deletions are remembered this long; older tokens get the whole catalog again
+TOMBSTONE_RETENTION = timedelta(days=30)
+PRUNE_KEY = 'catalog:tombstones:prune'
+PRUNE_INTERVAL = 24 * 3600
+
+
+def _new_version():
+    # Never restart from a small number: if the version key is evicted, a
+    # payload stamped with an old version must not look current again.
+    return time.time_ns()
+
+
+def get_version():
+    """Return the current catalog version, creating it if needed"""
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, _new_version(), None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def invalidate_catalog():
+    """Mark the cached catalog as stale (call after the change is committed)"""
+    # A fresh unique value rather than incr(): incr() is a get+set on most
+    # backends and would also reset the key's timeout.
+    cache.set(VERSION_KEY, _new_version(), None)
+
+
+def build_catalog():
+    """Serialize all active products and return (etag, body)"""
+    from .fast_serializers import PRODUCT_COLUMNS, serialize_products
+    from .models import Product
+    from .renderers import render_rows
+
+    rows = Product.objects.filter(active=True).values_list(*PRODUCT_COLUMNS, named=True)
+    body = render_rows(serialize_products(rows))
+    etag = '"%s"' % hashlib.sha256(body).hexdigest()[:40]
+    return etag, body
+
+
+def _rebuild(version):
+    # Taken before reading: whatever changes during the build is newer than it
+    token = new_token()
+    etag, body = build_catalog()
+    payload = (version, etag, body, token)
+    cache.set(PAYLOAD_KEY, payload, None)
+    return payload
+
+
+def get_payload():
+    """
+    Return (version, etag, body, token) for the current catalog.
+
+    Only one request rebuilds a stale catalog. While it does, concurrent
+    requests get the previous payload, or wait briefly when there is none.
+    """
+    cached = cache.get_many([VERSION_KEY, PAYLOAD_KEY])
+    version = cached.get(VERSION_KEY)
+    payload = cached.get(PAYLOAD_KEY)
+    if version is None:
+        version = get_version()
+
+    if payload and payload[0] == version:
+        return payload
+
+    if cache.add(LOCK_KEY, version, LOCK_TIMEOUT):
+        try:
+            return _rebuild(version)
+        finally:
+            cache.delete(LOCK_KEY)
+
+    if payload:
+        return payload
+
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(WAIT_STEP)
+        payload = cache.get(PAYLOAD_KEY)
+        if payload:
+            return payload
+
+    logger.warning("Catalog rebuild lock held too long, rebuilding without it")
+    return _rebuild(version)
+
+
+async def aget_payload():
+    """Async get_payload: one cache round trip when the payload is current, else the sync rebuild path"""
+    cached = await cache.aget_many([VERSION_KEY, PAYLOAD_KEY])
+    version = cached.get(VERSION_KEY)
+    payload = cached.get(PAYLOAD_KEY)
+    if version is not None and payload and payload[0] == version:
+        return payload
+    return await sync_to_async(get_payload)()
+
+
+def get_catalog():
+    """Return (etag, body) for the current catalog"""
+    _, etag, body, _ = get_payload()
+    return etag, body
+
+
+async def aget_catalog():
+    _, etag, body, _ = await aget_payload()
+    return etag, body
+
+
+def new_token():
+    """A sync token: the current time in microseconds, as a string"""
+    return str(time.time_ns() // 1000)
+
+
+def parse_token(value):
+    """Microseconds of a token, or None when it is missing, malformed or too old to sync from"""
+    try:
+        micros = int(value)
+    except (TypeError, ValueError):
+        return None
+    oldest = (time.time_ns() // 1000) - int(TOMBSTONE_RETENTION.total_seconds() * 1_000_000)
+    return micros if micros >= oldest else None
+
+
+def _lookback(since):
+    return since - int(TOKEN_GRACE.total_seconds() * 1_000_000)
+
+
+def _unchanged(since, version):
+    # The version is stamped after every change commits, so an older one
+    # means nothing changed since the lookback
+    return version is not None and version // 1000 < _lookback(since)
+
+
+def _changes_body(token, products, removed):
+    from .renderers import render_rows
+
+    return render_rows({'full': False, 'token': token, 'removed': removed, 'products': products})
+
+
+def _full_body(payload):
+    _, _, body, token = payload
+    return b'{"full":true,"token":"%s","removed":[],"products":%s}' % (token.encode(), body)
+
+
+def get_changes(token):
+    """
+    Body for GET /api/products?since=<token>. Without a usable token it is
+    the whole catalog (``full`` true, from the cached payload).
+    """
+    from .fast_serializers import PRODUCT_COLUMNS, serialize_products
+    from .models import Product, ProductTombstone
+
+    since = parse_token(token)
+    if since is None:
+        return _full_body(get_payload())
+
+    next_token = new_token()
+    if _unchanged(since, get_version()):
+        return _changes_body(next_token, [], [])
+
+    cutoff = datetime.fromtimestamp(_lookback(since) / 1_000_000, tz=dt_timezone.utc)
+    rows = list(Product.objects.filter(updated_at__gte=cutoff).values_list(*PRODUCT_COLUMNS, named=True))
+    changed = {row.id for row in rows}
+    removed = {row.id for row in rows if not row.active}
+    removed.update(
+        ProductTombstone.objects.filter(deleted_at__gte=cutoff).exclude(product_id__in=changed)
+        .values_list('product_id', flat=True)
+    )
+    products = serialize_products(row for row in rows if row.active)
+    return _changes_body(next_token, products, sorted(removed))
+
+
+async def aget_changes(token):
+    """Async get_changes: one cache round trip when nothing changed"""
+    since = parse_token(token)
+    if since is not None and _unchanged(since, await cache.aget(VERSION_KEY)):
+        return _changes_body(new_token(), [], [])
+    return await sync_to_async(get_changes)(token)
+
+
+def record_deletion(product_id):
+    """Leave a tombstone for a deleted product (call in the deleting transaction)"""
+    from .models import ProductTombstone
+
+    ProductTombstone.objects.update_or_create(product_id=product_id, defaults={'deleted_at': timezone.now()})
+    if cache.add(PRUNE_KEY, True, PRUNE_INTERVAL):
+        # Housekeeping: a failure is logged, not raised from the committed deletion
+        transaction.on_commit(prune_tombstones, robust=True)
+
+
+def prune_tombstones():
+    """Delete tombstones no token can still need"""
+    from .models import ProductTombstone
+
+    return ProductTombstone.objects.filter(deleted_at__lt=timezone.now() - TOMBSTONE_RETENTION).delete()[0]
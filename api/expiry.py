@@ -0,0 +1,196 @@
+"""
+Expiry of lapsed reservations
+
+Expired orders are cancelled with one guarded UPDATE (``status='reserved'``)
+and their stock is given back with one grouped UPDATE, instead of calling
+Order.cancel() per order.
+
+ExpiryScheduler keeps a heap of upcoming ``expires_at`` deadlines and sleeps
+until the next one is due. Creating or cancelling an order bumps a shared
+generation key, which wakes the scheduler to reload its deadlines. It also
+compacts the stock ledger every ``compact_interval`` seconds (see
+stock_ledger.py).
+"""
+
+import heapq
+import logging
+import time
+from collections import namedtuple
+
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from . import metrics, order_events, rollups, stock_ledger
+from .models import Order
+from .stock import record_movements, release
+
+
+logger = logging.getLogger(__name__)
+
+GENERATION_KEY = 'expiry:generation'
+METRICS_KEY = 'expiry:metrics'
+
+ExpiryResult = namedtuple('ExpiryResult', ['orders', 'units', 'lags'])
+
+
+def notify_deadlines_changed():
+    """Wake the expiry scheduler (call after an order is created or cancelled)"""
+    cache.set(GENERATION_KEY, time.time_ns(), None)
+
+
+def expire_due_orders(now=None):
+    """
+    Cancel every reserved order whose deadline has passed and restore its stock.
+
+    Returns ExpiryResult(orders, units, lags) for the orders actually expired,
+    where lags are the seconds between each ``expires_at`` and the release.
+    Orders picked or cancelled concurrently are left alone because the
+    UPDATE only matches rows that are still reserved.
+    """
+    now = now or timezone.now()
+
+    with transaction.atomic():
+        due = list(
+            Order.objects.select_for_update(skip_locked=True)
+            .filter(status='reserved', expires_at__lt=now)
+            .order_by()
+            .values_list(
+                'order_id', 'items', 'expires_at', 'created_at', 'total_amount', 'customer_name', 'room_number',
+                named=True,
+            )
+        )
+        if not due:
+            return ExpiryResult(0, 0, [])
+
+        order_ids = [row.order_id for row in due]
+        expired = Order.objects.filter(order_id__in=order_ids, status='reserved').update(
+            status='cancelled', cancelled_at=now
+        )
+        if expired != len(due):
+            # Without row locks (SQLite) a transition can slip in between the
+            # SELECT and the UPDATE; keep only the rows this UPDATE cancelled.
+            ours = set(
+                Order.objects.filter(order_id__in=order_ids, status='cancelled', cancelled_at=now)
+                .values_list('order_id', flat=True)
+            )
+            due = [row for row in due if row.order_id in ours]
+
+        units = release([item for row in due for item in row.items])
+        record_movements('release', due)
+        rollups.record('cancelled', due)
+        order_events.record('expired', due)
+
+    released_at = timezone.now()
+    lags = [(released_at - row.expires_at).total_seconds() for row in due]
+    metrics.ORDERS_EXPIRED.inc(len(due))
+    metrics.STOCK_RESTORED.inc(units, reason='expired')
+    for lag in lags:
+        metrics.EXPIRY_LAG.observe(lag)
+    return ExpiryResult(len(due), units, lags)
+
+
+class ExpiryScheduler:
+    """Sleep until the next reservation deadline instead of polling on a fixed interval"""
+
+    def __init__(self, resync_interval=300, poll_interval=1.0, on_expired=None, compact_interval=None, on_compacted=None):
+        self.resync_interval = resync_interval
+        self.poll_interval = poll_interval
+        self.on_expired = on_expired
+        self.compact_interval = compact_interval
+        self.on_compacted = on_compacted
+        self.heap = []
+        self.generation = None
+        self.next_resync = 0
+        self.next_compaction = 0
+        self.metrics = {
+            'sweeps': 0,
+            'expired_orders': 0,
+            'restored_units': 0,
+            'lag_count': 0,
+            'lag_sum': 0.0,
+            'lag_max': 0.0,
+            'lag_last': 0.0,
+        }
+
+    def load(self):
+        """Rebuild the deadline heap from the reserved orders in the database"""
+        self.generation = cache.get(GENERATION_KEY)
+        self.heap = [
+            (expires_at, order_id)
+            for order_id, expires_at in Order.objects.filter(status='reserved').order_by().values_list('order_id', 'expires_at')
+        ]
+        heapq.heapify(self.heap)
+        self.next_resync = time.monotonic() + self.resync_interval
+
+    def next_deadline(self):
+        return self.heap[0][0] if self.heap else None
+
+    def sweep(self, now):
+        while self.heap and self.heap[0][0] < now:
+            heapq.heappop(self.heap)
+
+        result = expire_due_orders(now)
+        self.metrics['sweeps'] += 1
+        if result.orders:
+            self.metrics['expired_orders'] += result.orders
+            self.metrics['restored_units'] += result.units
+            self.metrics['lag_count'] += len(result.lags)
+            self.metrics['lag_sum'] += sum(result.lags)
+            self.metrics['lag_max'] = max(self.metrics['lag_max'], *result.lags)
+            self.metrics['lag_last'] = result.lags[-1]
+            cache.set(METRICS_KEY, self.metrics, None)
+        if self.on_expired:
+            self.on_expired(result)
+        return result
+
+    def compact(self):
+        result = stock_ledger.compact()
+        self.next_compaction = time.monotonic() + self.compact_interval
+        if self.on_compacted:
+            self.on_compacted(result)
+        return result
+
+    def wait(self, timeout):
+        """
+        Sleep up to ``timeout`` seconds, returning early (True) if orders were
+        created or cancelled in the meantime.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(remaining, self.poll_interval))
+            if cache.get(GENERATION_KEY) != self.generation:
+                return True
+
+    def run_once(self):
+        """Expire what is due, then sleep until the next deadline or a wake-up"""
+        now = timezone.now()
+        if self.heap and self.heap[0][0] < now:
+            self.sweep(now)
+
+        if time.monotonic() >= self.next_resync:
+            self.load()
+        if self.compact_interval and time.monotonic() >= self.next_compaction:
+            self.compact()
+
+        timeout = self.next_resync - time.monotonic()
+        if self.compact_interval:
+            timeout = min(timeout, self.next_compaction - time.monotonic())
+        deadline = self.next_deadline()
+        if deadline is not None:
+            # expire_due_orders matches expires_at < now, so wake just after the deadline
+            timeout = min(timeout, (deadline - timezone.now()).total_seconds() + 0.001)
+
+        metrics.registry.maybe_flush()
+        if self.wait(max(timeout, 0)):
+            self.load()
+
+    def run(self):
+        self.load()
+        # Catch up on anything that lapsed while the scheduler was down
+        self.sweep(timezone.now())
+        while True:
+            self.run_once()
@@ -0,0 +1,151 @@
+"""
+Streaming CSV/JSONL exports for the admin panel
+
+Rows are read with values_list().iterator(), so only the exported columns
+are fetched (never the product image store) and the database hands them
+over in chunks. Output is produced as the rows arrive, optionally gzipped,
+so memory use does not grow with the table and the header goes out before
+the first query runs. Under ASGI the stream is an async iterator that
+builds each chunk in the sync thread, so the server sends chunks as they
+are ready instead of Django collecting the whole export first.
+"""
+
+import csv
+import json
+import zlib
+from decimal import Decimal
+
+from asgiref.sync import sync_to_async
+
+from .models import Order, Product
+from .pagination import filter_orders
+
+
+CHUNK_SIZE = 2000
+FLUSH_BYTES = 64 * 1024
+CENTS = Decimal('0.01')
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'jsonl': ('application/x-ndjson', 'jsonl'),
+}
+
+
+class Echo:
+    """File-like object for csv.writer that returns each line instead of buffering it"""
+
+    def write(self, value):
+        return value
+
+
+def _timestamp(value):
+    return value.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def product_rows(params):
+    rows = Product.objects.order_by('id').values_list('id', 'name', 'category', 'price', 'stock', 'active')
+    return rows.iterator(chunk_size=CHUNK_SIZE)
+
+
+def order_rows(params):
+    rows = filter_orders(Order.objects.all(), params).order_by('created_at', 'order_id').values_list(
+        'order_id', 'customer_name', 'phone_number', 'room_number', 'total_amount', 'status', 'created_at'
+    )
+    for *fields, created_at in rows.iterator(chunk_size=CHUNK_SIZE):
+        yield (*fields, _timestamp(created_at))
+
+
+def order_item_rows(params):
+    rows = filter_orders(Order.objects.all(), params).order_by('created_at', 'order_id').values_list(
+        'order_id', 'status', 'created_at', 'items'
+    )
+    for order_id, order_status, created_at, items in rows.iterator(chunk_size=CHUNK_SIZE):
+        created = _timestamp(created_at)
+        for item in items:
+            price = Decimal(str(item.get('price', 0))).quantize(CENTS)
+            qty = int(item.get('qty', 0))
+            yield (order_id, order_status, created, item.get('productId'), item.get('name'), price, qty, price * qty)
+
+
+# type -> (row generator, [(JSONL key, CSV header)])
+EXPORTS = {
+    'products': (product_rows, [
+        ('id', 'ID'), ('name', 'Name'), ('category', 'Category'),
+        ('price', 'Price'), ('stock', 'Stock'), ('active', 'Active'),
+    ]),
+    'orders': (order_rows, [
+        ('orderId', 'Order ID'), ('customerName', 'Customer'), ('phoneNumber', 'Phone'),
+        ('roomNumber', 'Room'), ('totalAmount', 'Total'), ('status', 'Status'), ('createdAt', 'Created'),
+    ]),
+    'order_items': (order_item_rows, [
+        ('orderId', 'Order ID'), ('status', 'Status'), ('createdAt', 'Created'), ('productId', 'Product ID'),
+        ('name', 'Product'), ('price', 'Price'), ('qty', 'Qty'), ('lineTotal', 'Line Total'),
+    ]),
+}
+
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def encode_lines(rows, columns, output):
+    """Yield encoded output lines (header first for CSV)"""
+    if output == 'csv':
+        writer = csv.writer(Echo())
+        yield writer.writerow([header for _, header in columns]).encode()
+        for row in rows:
+            yield writer.writerow(row).encode()
+    else:
+        keys = [key for key, _ in columns]
+        for row in rows:
+            yield json.dumps(dict(zip(keys, row)), default=_json_default).encode() + b'\n'
+
+
+def chunked(lines, compress=False):
+    """Join lines into ~64 KB chunks, gzipping them if asked; the first line is sent on its own"""
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    buffer = []
+    size = 0
+    first = True
+    for line in lines:
+        buffer.append(line)
+        size += len(line)
+        if first or size >= FLUSH_BYTES:
+            data = b''.join(buffer)
+            yield compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH) if compressor else data
+            buffer, size, first = [], 0, False
+
+    data = b''.join(buffer)
+    if compressor:
+        yield compressor.compress(data) + compressor.flush()
+    elif data:
+        yield data
+
+
+async def aiterate(chunks):
+    """Async iterator over a sync chunk iterator, advancing it one chunk per trip to the sync thread"""
+    chunks = iter(chunks)
+    done = object()
+    while True:
+        chunk = await sync_to_async(next)(chunks, done)
+        if chunk is done:
+            return
+        yield chunk
+
+
+def stream_export(export_type, params, output='csv', compress=False, asynchronous=False):
+    """
+    Return a byte-chunk iterator (an async one if ``asynchronous``, for
+    ASGI); raises ValueError for an unknown type, format or filter
+    """
+    if export_type not in EXPORTS:
+        raise ValueError(f"Unknown export type: {export_type}")
+    if output not in FORMATS:
+        raise ValueError(f"Unknown output format: {output}")
+
+    row_source, columns = EXPORTS[export_type]
+    # Parse the filters now so a bad value is a 400, not a broken stream
+    filter_orders(Order.objects.none(), params)
+    chunks = chunked(encode_lines(row_source(params), columns, output), compress)
+    return aiterate(chunks) if asynchronous else chunks
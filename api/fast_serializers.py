@@ -0,0 +1,120 @@
+"""
+values()-based serializers for the hot read paths
+
+ProductSerializer and OrderSerializer build every field through DRF's field
+machinery, which dominates the cost of a large list once the queries are
+cheap. These functions read plain rows from values_list(named=True) and
+build the same fields in the same order directly. Datetimes are only moved
+to the current time zone; renderers.render_rows() writes them in C with
+orjson, in DRF's format, so the response bytes are identical to the DRF
+serializers'. bench_serializers checks that.
+
+Keep them in sync with serializers.py when fields change.
+"""
+
+from decimal import Decimal
+
+from django.utils import timezone
+
+from .images import thumbnail_url, thumbnail_urls
+
+
+CENTS = Decimal('0.01')
+
+PRODUCT_COLUMNS = (
+    'id', 'name', 'category', 'price', 'stock', 'image', 'image_digest', 'active', 'created_at', 'updated_at',
+)
+
+# OrderSerializer output field -> model column, in OrderSerializer.Meta.fields order
+ORDER_FIELDS = {
+    'orderId': 'order_id',
+    'customerName': 'customer_name',
+    'phoneNumber': 'phone_number',
+    'roomNumber': 'room_number',
+    'notes': 'notes',
+    'items': 'items',
+    'totalAmount': 'total_amount',
+    'status': 'status',
+    'createdAt': 'created_at',
+    'expiresAt': 'expires_at',
+    'pickedAt': 'picked_at',
+    'completedAt': 'completed_at',
+    'cancelledAt': 'cancelled_at',
+}
+DATETIME_FIELDS = {'createdAt', 'expiresAt', 'pickedAt', 'completedAt', 'cancelledAt'}
+
+
+def decimal_string(value):
+    """Like serializers.DecimalField(decimal_places=2)"""
+    if value is None:
+        return None
+    return '{:f}'.format(value.quantize(CENTS))
+
+
+def local(value, tz):
+    """Like serializers.DateTimeField, short of formatting (left to render_rows)"""
+    if value is None:
+        return None
+    return value.astimezone(tz)
+
+
+def serialize_products(rows):
+    """ProductSerializer(many=True) output for rows of values_list(*PRODUCT_COLUMNS, named=True)"""
+    tz = timezone.get_current_timezone()
+    data = []
+    for row in rows:
+        digest = row.image_digest
+        data.append({
+            'id': row.id,
+            'name': row.name,
+            'category': row.category,
+            'price': decimal_string(row.price),
+            'stock': row.stock,
+            'image': thumbnail_url(digest) if digest else (row.image or None),
+            'thumbnails': thumbnail_urls(digest) if digest else None,
+            'active': row.active,
+            'created_at': local(row.created_at, tz),
+            'updated_at': local(row.updated_at, tz),
+        })
+    return data
+
+
+def order_fields(fields=None):
+    """Output fields to build, in serializer order; raises ValueError for unknown names"""
+    if fields is None:
+        return list(ORDER_FIELDS)
+    unknown = set(fields) - set(ORDER_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown field(s): {', '.join(sorted(unknown))}")
+    return [name for name in ORDER_FIELDS if name in fields]
+
+
+def order_columns(fields=None):
+    """Columns for values_list(); always includes the pagination key"""
+    columns = [ORDER_FIELDS[name] for name in order_fields(fields)]
+    return columns + [column for column in ('created_at', 'order_id') if column not in columns]
+
+
+def serialize_orders(rows, fields=None):
+    """OrderSerializer(many=True, fields=fields) output for rows of values_list(*order_columns(fields), named=True)"""
+    tz = timezone.get_current_timezone()
+    names = order_fields(fields)
+    # order_columns() lists the output fields' columns first, in this order
+    plan = [(name, row_index) for row_index, name in enumerate(names)]
+    times = [(name, row_index) for name, row_index in plan if name in DATETIME_FIELDS]
+    amount = 'totalAmount' in names
+
+    data = []
+    for row in rows:
+        item = {name: row[row_index] for name, row_index in plan}
+        if amount:
+            item['totalAmount'] = decimal_string(row.total_amount)
+        for name, row_index in times:
+            if row[row_index] is not None:
+                item[name] = row[row_index].astimezone(tz)
+        data.append(item)
+    return data
+
+
+def serialize_order(row, fields=None):
+    return serialize_orders([row], fields)[0]
@@ -0,0 +1,151 @@
+"""
+Idempotency-Key support for order creation and cancellation
+
+A client that retries a POST after a dropped connection sends the same
+Idempotency-Key header as the first attempt. The first request with a key
+runs the view and stores its response in the shared cache for RESULT_TTL;
+later requests with that key get the stored response back (marked with
+Idempotent-Replayed: true) without touching the database. A duplicate that
+arrives while the first is still running waits for its result instead of
+running the view a second time.
+
+A key belongs to one request: reusing it with another path or body is
+refused with 422. Server errors are not stored, so a retry after one runs
+the view again. Requests without the header behave as before.
+
+Put @idempotent above @throttle: it then checks the view's rate limits
+itself, only when it is about to run the view, so a client retrying a
+request that went through is given its response instead of a 429.
+"""
+
+import hashlib
+import logging
+import time
+import uuid
+from functools import wraps
+
+import orjson
+from django.core.cache import cache
+from rest_framework import status
+from rest_framework.response import Response
+
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+RESULT_KEY = 'idempotency:{}:result'
+LOCK_KEY = 'idempotency:{}:lock'
+
+RESULT_TTL = 24 * 3600
+# Only guards against a crashed worker holding the lock forever
+LOCK_TIMEOUT = 30
+WAIT_TIMEOUT = 10.0
+WAIT_STEP = 0.05
+
+
+def fingerprint(request):
+    """What makes two requests the same: method, path and the parsed body"""
+    body = orjson.dumps(request.data, default=str, option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(b'%s %s\n%s' % (request.method.encode(), request.path.encode(), body)).hexdigest()
+
+
+def replay(result, scope):
+    metrics.IDEMPOTENT_REPLAYS.inc(scope=scope)
+    response = Response(result['data'], status=result['status'])
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def mismatch():
+    return Response(
+        {'error': f'This {HEADER} was already used for a different request'},
+        status=status.HTTP_422_UNPROCESSABLE_ENTITY
+    )
+
+
+def check_throttles(request, throttle_classes):
+    """What APIView.check_throttles does, for the throttles @idempotent took over"""
+    view = request.parser_context['view']
+    waits = []
+    for throttle_class in throttle_classes:
+        throttle = throttle_class()
+        if not throttle.allow_request(request, view):
+            waits.append(throttle.wait())
+    if waits:
+        view.throttled(request, max(waits))
+
+
+def idempotent(scope):
+    """Honour Idempotency-Key on an @api_view function (put it below @api_view, above @throttle)"""
+
+    def decorator(view):
+        # Take the throttles over from @throttle, so that APIView does not
+        # check them before a replay could be served
+        throttle_classes = getattr(view, 'throttle_classes', [])
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            key = request.headers.get(HEADER)
+            if not key or request.method in ('GET', 'HEAD', 'OPTIONS'):
+                check_throttles(request, throttle_classes)
+                return view(request, *args, **kwargs)
+            if len(key) > MAX_KEY_LENGTH or not key.isprintable():
+                return Response(
+                    {'error': f'{HEADER} must be at most {MAX_KEY_LENGTH} printable characters'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            digest = hashlib.sha256(f'{scope}:{key}'.encode()).hexdigest()
+            result_key, lock_key = RESULT_KEY.format(digest), LOCK_KEY.format(digest)
+            request_fingerprint = fingerprint(request)
+
+            deadline = time.monotonic() + WAIT_TIMEOUT
+            while True:
+                result = cache.get(result_key)
+                if result is not None:
+                    if result['fingerprint'] != request_fingerprint:
+                        return mismatch()
+                    return replay(result, scope)
+
+                token = uuid.uuid4().hex
+                if cache.add(lock_key, token, LOCK_TIMEOUT):
+                    break
+                # Another request with this key is running: wait for its response
+                if time.monotonic() >= deadline:
+                    logger.warning("%s request still running after %.0fs (%s)", HEADER, WAIT_TIMEOUT, scope)
+                    response = Response(
+                        {'error': f'A request with this {HEADER} is still in progress'},
+                        status=status.HTTP_409_CONFLICT
+                    )
+                    response['Retry-After'] = '1'
+                    return response
+                time.sleep(WAIT_STEP)
+
+            try:
+                # It may have finished between our read and taking the lock
+                result = cache.get(result_key)
+                if result is not None:
+                    if result['fingerprint'] != request_fingerprint:
+                        return mismatch()
+                    return replay(result, scope)
+
+                check_throttles(request, throttle_classes)
+                response = view(request, *args, **kwargs)
+                if response.status_code < 500 and response.status_code != status.HTTP_429_TOO_MANY_REQUESTS:
+                    cache.set(result_key, {
+                        'fingerprint': request_fingerprint,
+                        'status': response.status_code,
+                        'data': response.data,
+                    }, RESULT_TTL)
+                return response
+            finally:
+                if cache.get(lock_key) == token:
+                    cache.delete(lock_key)
+
+        if throttle_classes:
+            wrapper.throttle_classes = []
+        return wrapper
+    return decorator
@@ -0,0 +1,129 @@
+"""
+Content-addressed product image store
+
+Each uploaded image is stored once, keyed by the SHA-256 of its bytes. The
+original is kept in the database (``ProductImage``) so it survives redeploys
+on hosts with an ephemeral disk, and WebP thumbnails are written to the
+default storage under images/. WhiteNoise serves them from MEDIA_ROOT like
+static files (see StaticFilesMiddleware); their URLs never change for a
+given image, so they get immutable cache headers. ``render_thumbnails``
+(run at build and at start) writes any thumbnail the disk lost.
+"""
+
+import base64
+import binascii
+import hashlib
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, UnidentifiedImageError
+
+
+THUMBNAIL_SIZES = (150, 300, 600)
+DEFAULT_SIZE = 300
+IMAGE_DIR = 'images'
+
+
+class InvalidImage(ValueError):
+    """Raised when uploaded bytes are not a readable image"""
+
+
+def decode_data_url(data_url):
+    """Return (content_type, bytes) for a ``data:<type>;base64,...`` URL"""
+    try:
+        header, encoded = data_url.split(',', 1)
+        content_type = header[len('data:'):].split(';')[0] or 'image/jpeg'
+        return content_type, base64.b64decode(encoded)
+    except (ValueError, binascii.Error):
+        raise InvalidImage('Malformed image data URL')
+
+
+def image_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def thumbnail_name(digest, size):
+    return f"{digest}-{size}.webp"
+
+
+def thumbnail_path(digest, size):
+    """Name of a thumbnail in the default storage"""
+    return f"{IMAGE_DIR}/{digest[:2]}/{thumbnail_name(digest, size)}"
+
+
+def thumbnail_url(digest, size=DEFAULT_SIZE):
+    return f"{settings.MEDIA_URL}{thumbnail_path(digest, size)}"
+
+
+def thumbnail_urls(digest):
+    """Return {size: url} for every pre-generated thumbnail"""
+    return {str(size): thumbnail_url(digest, size) for size in THUMBNAIL_SIZES}
+
+
+def generate_thumbnails(digest, data):
+    """Render the missing thumbnail sizes of an image to the default storage"""
+    try:
+        source = Image.open(BytesIO(data))
+        source.load()
+    except (UnidentifiedImageError, OSError):
+        raise InvalidImage('Unsupported image format')
+
+    has_alpha = source.mode in ('RGBA', 'LA', 'PA') or 'transparency' in source.info
+    source = source.convert('RGBA' if has_alpha else 'RGB')
+
+    for size in THUMBNAIL_SIZES:
+        path = thumbnail_path(digest, size)
+        if default_storage.exists(path):
+            continue
+        thumb = source.copy()
+        thumb.thumbnail((size, size), Image.LANCZOS)
+        out = BytesIO()
+        thumb.save(out, 'WEBP', quality=82, method=4)
+        default_storage.save(path, ContentFile(out.getvalue()))
+
+
+def store_image(data, content_type='image/jpeg'):
+    """Store image bytes once and return their digest"""
+    from .models import ProductImage
+
+    digest = image_digest(data)
+    generate_thumbnails(digest, data)
+    ProductImage.objects.get_or_create(
+        digest=digest,
+        defaults={'content_type': content_type, 'data': data}
+    )
+    return digest
+
+
+def store_data_url(data_url):
+    """Store a base64 data URL and return its digest"""
+    content_type, data = decode_data_url(data_url)
+    return store_image(data, content_type)
+
+
+def missing_thumbnails(digest):
+    return [size for size in THUMBNAIL_SIZES if not default_storage.exists(thumbnail_path(digest, size))]
+
+
+def render_missing_thumbnails():
+    """
+    Write the thumbnails missing from storage (e.g. after a redeploy wiped
+    the disk) from the stored originals. Returns (images, thumbnails) rendered.
+    """
+    from .models import ProductImage
+
+    images = rendered = 0
+    for digest in list(ProductImage.objects.values_list('digest', flat=True)):
+        missing = missing_thumbnails(digest)
+        if not missing:
+            continue
+        data = ProductImage.objects.filter(digest=digest).values_list('data', flat=True).first()
+        try:
+            generate_thumbnails(digest, bytes(data))
+        except InvalidImage:
+            continue
+        images += 1
+        rendered += len(missing)
+    return images, rendered
@@ -0,0 +1,409 @@
+"""
+"Order rush" load test
+
+Replays mixed traffic against the WSGI or ASGI application in-process, through
+httpx's WSGI/ASGI transports: catalog reads (half of them conditional), order
+creates that pile onto one hot product, cancels, admin pick/complete and stats
+polling. Telegram notifications go through the real outbox worker to a local
+FakeTelegramServer.
+
+All seeded products and orders are tagged (LOADTEST_PREFIX / LOADTEST_CUSTOMER)
+and removed afterwards, but run it against a scratch database anyway: the
+stats rollups are rebuilt at cleanup time.
+"""
+
+import asyncio
+import math
+import random
+import threading
+import time
+from collections import defaultdict, deque
+
+import httpx
+from django.conf import settings
+from django.core.servers.basehttp import get_internal_wsgi_application
+from django.db import close_old_connections, connections
+from django.test import override_settings
+from django.utils.module_loading import import_string
+
+from . import rollups, stock_ledger, telegram_bot
+from .models import Order, OrderEvent, Product, StockMovement, StockSnapshot, TelegramBoard, TelegramOutbox
+from .stock import available
+from .telegram_fake import FakeTelegramServer
+from .telegram_outbox import CircuitBreaker, OutboxWorker, RateLimiter
+from .views import ADMIN_PIN
+
+
+LOADTEST_PREFIX = 'Loadtest '
+LOADTEST_CUSTOMER = 'Loadtest Student'
+LOADTEST_CHAT_ID = '-100900'
+
+# Share of requests per action
+DEFAULT_MIX = {
+    'catalog': 45,
+    'create': 25,
+    'cancel': 5,
+    'pick': 8,
+    'complete': 7,
+    'stats': 10,
+}
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an unsorted list"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def seed_catalog(products, stock, hot_stock):
+    """Create the test products; returns {id: {name, price, stock}} with the hot product first"""
+    created = Product.objects.bulk_create([
+        Product(
+            name=f'{LOADTEST_PREFIX}{"Maggi" if n == 0 else f"Item {n}"}',
+            category='Loadtest',
+            price=20 + n % 5 * 10,
+            stock=hot_stock if n == 0 else stock,
+        )
+        for n in range(products)
+    ])
+    # Not every backend returns primary keys from bulk_create
+    rows = Product.objects.filter(name__startswith=LOADTEST_PREFIX, category='Loadtest').order_by('id')
+    return {
+        pk: {'name': name, 'price': float(price), 'stock': stock}
+        for pk, name, price, stock in rows.values_list('id', 'name', 'price', 'stock')[:len(created)]
+    }
+
+
+class Scenario:
+    """Picks the next request and tracks the orders it created"""
+
+    def __init__(self, catalog, mix, hot_share=0.7):
+        self.catalog = catalog
+        self.product_ids = list(catalog)
+        self.hot_id = self.product_ids[0]
+        self.mix = mix
+        self.hot_share = hot_share
+        self.reserved = deque()
+        self.picked = deque()
+        self.created = []
+        self.etag = None
+        self.phones = 0
+        self.lock = threading.Lock()
+
+    def next_request(self, rng):
+        """Return (action, method, path, json body, headers)"""
+        action = rng.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        admin = {'X-Admin-Pin': ADMIN_PIN}
+
+        with self.lock:
+            if action == 'cancel' and self.reserved:
+                return action, 'POST', f'/api/orders/{self.reserved.popleft()}/cancel', None, {}
+            if action == 'pick' and self.reserved:
+                return action, 'POST', f'/api/admin/orders/{self.reserved.popleft()}/pick', None, admin
+            if action == 'complete' and self.picked:
+                return action, 'POST', f'/api/admin/orders/{self.picked.popleft()}/complete', None, admin
+            if action == 'create':
+                self.phones += 1
+                phone = f'7{self.phones:09d}'
+            elif action == 'stats':
+                return action, 'GET', '/api/admin/stats', None, admin
+            else:
+                # catalog, or a lifecycle action with nothing to act on yet
+                headers = {'If-None-Match': self.etag} if self.etag and rng.random() < 0.5 else {}
+                return 'catalog', 'GET', '/api/products', None, headers
+
+        product_id = self.hot_id if rng.random() < self.hot_share else rng.choice(self.product_ids)
+        product = self.catalog[product_id]
+        body = {
+            'customerName': LOADTEST_CUSTOMER,
+            'phoneNumber': phone,
+            'roomNumber': str(rng.randint(100, 450)),
+            'items': [{
+                'productId': product_id,
+                'name': product['name'],
+                'price': product['price'],
+                'qty': rng.choice([1, 1, 1, 2]),
+            }],
+        }
+        return action, 'POST', '/api/orders', body, {}
+
+    def record_response(self, action, path, response):
+        with self.lock:
+            if action == 'catalog' and response.status_code == 200:
+                self.etag = response.headers.get('ETag')
+            elif action == 'create' and response.status_code == 201:
+                order_id = response.json()['orderId']
+                self.created.append(order_id)
+                self.reserved.append(order_id)
+            elif action == 'pick' and response.status_code == 200:
+                self.picked.append(path.split('/')[-2])
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def add(self, action, seconds, status_code):
+        with self.lock:
+            self.samples[action].append((seconds, status_code))
+
+    def summary(self, elapsed):
+        actions = {}
+        for action, samples in sorted(self.samples.items()):
+            latencies = [seconds * 1000 for seconds, _ in samples]
+            actions[action] = {
+                'requests': len(samples),
+                'ok': sum(1 for _, code in samples if code and code < 400),
+                'rejected': sum(1 for _, code in samples if code and 400 <= code < 500),
+                'errors': sum(1 for _, code in samples if not code or code >= 500),
+                'p50_ms': round(percentile(latencies, 50), 2),
+                'p95_ms': round(percentile(latencies, 95), 2),
+                'p99_ms': round(percentile(latencies, 99), 2),
+            }
+        everything = [seconds * 1000 for samples in self.samples.values() for seconds, _ in samples]
+        total = len(everything)
+        return {
+            'requests': total,
+            'elapsed_s': round(elapsed, 3),
+            'throughput_rps': round(total / elapsed, 1) if elapsed else None,
+            'errors': sum(a['errors'] for a in actions.values()),
+            'p50_ms': round(percentile(everything, 50), 2) if total else None,
+            'p95_ms': round(percentile(everything, 95), 2) if total else None,
+            'p99_ms': round(percentile(everything, 99), 2) if total else None,
+            'actions': actions,
+        }
+
+
+def _host():
+    hosts = [host for host in settings.ALLOWED_HOSTS if host and host != '*' and not host.startswith('.')]
+    return hosts[0] if hosts else 'localhost'
+
+
+def run_wsgi(scenario, recorder, requests, concurrency, seed):
+    """Drive the WSGI application from ``concurrency`` threads"""
+    application = get_internal_wsgi_application()
+    remaining = iter(range(requests))
+    remaining_lock = threading.Lock()
+
+    def worker(index):
+        rng = random.Random(seed * 1000 + index)
+        client = httpx.Client(transport=httpx.WSGITransport(app=application), base_url=f'https://{_host()}')
+        try:
+            while True:
+                with remaining_lock:
+                    if next(remaining, None) is None:
+                        return
+                action, method, path, body, headers = scenario.next_request(rng)
+                started = time.perf_counter()
+                try:
+                    response = client.request(method, path, json=body, headers=headers)
+                except Exception:
+                    recorder.add(action, time.perf_counter() - started, None)
+                    continue
+                recorder.add(action, time.perf_counter() - started, response.status_code)
+                scenario.record_response(action, path, response)
+        finally:
+            client.close()
+            connections.close_all()
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def run_asgi(scenario, recorder, requests, concurrency, seed):
+    """Drive the ASGI application from ``concurrency`` tasks on one event loop"""
+    application = import_string(getattr(settings, 'ASGI_APPLICATION', None) or 'backend.asgi.application')
+
+    async def main():
+        remaining = iter(range(requests))
+        transport = httpx.ASGITransport(app=application)
+        async with httpx.AsyncClient(transport=transport, base_url=f'https://{_host()}') as client:
+
+            async def worker(index):
+                rng = random.Random(seed * 1000 + index)
+                while next(remaining, None) is not None:
+                    action, method, path, body, headers = scenario.next_request(rng)
+                    started = time.perf_counter()
+                    try:
+                        response = await client.request(method, path, json=body, headers=headers)
+                    except Exception:
+                        recorder.add(action, time.perf_counter() - started, None)
+                        continue
+                    recorder.add(action, time.perf_counter() - started, response.status_code)
+                    scenario.record_response(action, path, response)
+
+            await asyncio.gather(*(worker(index) for index in range(concurrency)))
+
+    asyncio.run(main())
+
+
+class TelegramHarness:
+    """Point the bot at a FakeTelegramServer and drain the outbox in a background thread"""
+
+    def __init__(self, **fake_options):
+        self.server = FakeTelegramServer(**fake_options)
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.saved = None
+
+    def __enter__(self):
+        self.server.start()
+        self.saved = (telegram_bot.BOT_TOKEN, telegram_bot.CHAT_ID, telegram_bot.API_BASE)
+        telegram_bot.BOT_TOKEN, telegram_bot.CHAT_ID, telegram_bot.API_BASE = 'loadtest', LOADTEST_CHAT_ID, self.server.url
+        self.thread = threading.Thread(target=self.drain, daemon=True)
+        self.thread.start()
+        return self
+
+    def drain(self):
+        # Generous limits: the test measures the API, not Telegram's quotas
+        worker = OutboxWorker(
+            client=httpx.Client(timeout=5.0),
+            limiter=RateLimiter(rate=10000, per=1, burst=10000),
+            breaker=CircuitBreaker(threshold=50, cooldown=1.0)
+        )
+        try:
+            while not self.stop_event.is_set():
+                close_old_connections()
+                wait = worker.drain_once()
+                self.stop_event.wait(0.05 if wait is None else min(max(wait, 0.01), 0.5))
+        finally:
+            connections.close_all()
+
+    def finish(self, timeout=10.0):
+        """Wait for the outbox to empty (up to timeout), then stop the worker"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and loadtest_outbox().filter(status='pending').exists():
+            time.sleep(0.1)
+        self.stop_event.set()
+        self.thread.join()
+
+    def __exit__(self, *exc):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        telegram_bot.BOT_TOKEN, telegram_bot.CHAT_ID, telegram_bot.API_BASE = self.saved
+        self.server.stop()
+
+
+def loadtest_orders():
+    return Order.objects.filter(customer_name=LOADTEST_CUSTOMER)
+
+
+def loadtest_outbox():
+    return TelegramOutbox.objects.filter(chat_id=LOADTEST_CHAT_ID)
+
+
+def check_stock(catalog):
+    """
+    Compare stock with the orders holding it. Returns (oversold, drift):
+    units held beyond a product's initial stock, and units unaccounted for
+    (initial - final - held), summed over the seeded products.
+    """
+    held = defaultdict(int)
+    rows = loadtest_orders().exclude(status='cancelled').values_list('items', flat=True)
+    for items in rows.iterator():
+        for item in items:
+            held[item['productId']] += int(item['qty'])
+
+    final = available(list(catalog))
+    oversold = sum(max(0, held[pk] - product['stock']) for pk, product in catalog.items())
+    drift = sum(abs(product['stock'] - final.get(pk, 0) - held[pk]) for pk, product in catalog.items())
+    return oversold, drift
+
+
+def telegram_summary(server):
+    calls = server.state.calls
+    return {
+        'calls': len(calls),
+        'rejected_429': server.state.rejected,
+        'outbox_sent': loadtest_outbox().filter(status='sent').count(),
+        'outbox_pending': loadtest_outbox().filter(status='pending').count(),
+        'outbox_failed': loadtest_outbox().filter(status='failed').count(),
+        'boards': TelegramBoard.objects.filter(chat_id=LOADTEST_CHAT_ID).count(),
+    }
+
+
+def cleanup():
+    loadtest_outbox().delete()
+    OrderEvent.objects.filter(data__customerName=LOADTEST_CUSTOMER).delete()
+    loadtest_orders().delete()
+    TelegramBoard.objects.filter(chat_id=LOADTEST_CHAT_ID).delete()
+    products = Product.objects.filter(name__startswith=LOADTEST_PREFIX, category='Loadtest')
+    product_ids = list(products.values_list('id', flat=True))
+    StockMovement.objects.filter(product_id__in=product_ids).delete()
+    StockSnapshot.objects.filter(product_id__in=product_ids).delete()
+    products.delete()
+    rollups.rebuild()
+
+
+def run(entry='wsgi', requests=2000, concurrency=20, products=20, stock=50, hot_stock=100,
+        hot_share=0.7, mix=None, seed=1, telegram_latency=0.0, keep=False, stripes=0):
+    """Run one load test and return its report as a dict"""
+    if Product.objects.filter(name__startswith=LOADTEST_PREFIX, category='Loadtest').exists():
+        cleanup()
+    catalog = seed_catalog(products, stock, hot_stock)
+    # Snapshots to reconcile the ledger against afterwards
+    stock_ledger.compact(list(catalog), stripes=0)
+    if stripes:
+        stock_ledger.compact(list(catalog)[:1], stripes=stripes)
+    scenario = Scenario(catalog, mix or DEFAULT_MIX, hot_share=hot_share)
+    recorder = Recorder()
+    runner = {'wsgi': run_wsgi, 'asgi': run_asgi}[entry]
+
+    try:
+        # One client address sends everything: measure the application, not the rate limits
+        with override_settings(THROTTLE_RATES={}, LOAD_SHED_LATENCY=0), \
+                TelegramHarness(latency=telegram_latency) as telegram:
+            started = time.perf_counter()
+            runner(scenario, recorder, requests, concurrency, seed)
+            elapsed = time.perf_counter() - started
+            telegram.finish()
+            telegram_report = telegram_summary(telegram.server)
+
+        oversold, drift = check_stock(catalog)
+        ledger = stock_ledger.reconcile(list(catalog))
+        report = recorder.summary(elapsed)
+        report.update({
+            'entry': entry,
+            'database': connections['default'].vendor,
+            'config': {
+                'requests': requests, 'concurrency': concurrency, 'products': products, 'stock': stock,
+                'hot_stock': hot_stock, 'hot_share': hot_share, 'mix': mix or DEFAULT_MIX, 'seed': seed,
+                'stripes': stripes,
+            },
+            'orders_created': len(scenario.created),
+            'oversold_units': oversold,
+            'stock_drift_units': drift,
+            'ledger_discrepancies': len(ledger.discrepancies),
+            'telegram': telegram_report,
+        })
+        return report
+    finally:
+        if not keep:
+            cleanup()
+
+
+def compare(report, baseline, tolerance=0.25):
+    """Return a list of regressions of report against a saved baseline"""
+    regressions = []
+    for metric in ('p50_ms', 'p95_ms', 'p99_ms'):
+        old, new = baseline.get(metric), report.get(metric)
+        if old and new and new > old * (1 + tolerance):
+            regressions.append(f'{metric}: {old} -> {new}')
+    for action, stats in report['actions'].items():
+        old = baseline.get('actions', {}).get(action, {}).get('p95_ms')
+        if old and stats['p95_ms'] > old * (1 + tolerance):
+            regressions.append(f'{action} p95_ms: {old} -> {stats["p95_ms"]}')
+    old_rps = baseline.get('throughput_rps')
+    if old_rps and report['throughput_rps'] < old_rps * (1 - tolerance):
+        regressions.append(f'throughput_rps: {old_rps} -> {report["throughput_rps"]}')
+    for metric in ('errors', 'oversold_units', 'stock_drift_units', 'ledger_discrepancies'):
+        if report.get(metric, 0) > baseline.get(metric, 0):
+            regressions.append(f'{metric}: {baseline.get(metric, 0)} -> {report[metric]}')
+    return regressions
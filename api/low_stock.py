@@ -0,0 +1,163 @@
+"""
+Low-stock alerts
+
+A product is low once its stock is at or below its threshold: the
+AdminSettings key 'low_stock_threshold:<product id>' if there is one, else
+'low_stock_threshold' (DEFAULT_THRESHOLD if neither is set).
+
+Crossings are caught where stock changes, from the values stock.py already
+has in hand: an order's reservation, an admin edit or bulk update
+(set_stock), and the compaction that writes a striped product's total into
+Product.stock. A change taking a product from above its threshold to at or
+below it queues a 'low_stock' row in the Telegram outbox once its
+transaction commits. Each product alerts at most once per DEBOUNCE seconds.
+
+The outbox worker holds those rows for LOW_STOCK_DIGEST_INTERVAL and then
+sends all of a chat's queued alerts as one digest message, leaving out
+products restocked in the meantime. A rush that runs 30 items low sends
+one message, not 30.
+"""
+
+import logging
+import threading
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+
+from . import telegram_bot
+from .models import AdminSettings, Product
+
+
+logger = logging.getLogger(__name__)
+
+THRESHOLD_KEY = 'low_stock_threshold'
+PRODUCT_THRESHOLD_KEY = 'low_stock_threshold:{}'
+DEFAULT_THRESHOLD = 5
+
+DEBOUNCE = 3600
+ALERTED_KEY = 'low-stock:alerted:{}'
+# Thresholds are read from AdminSettings at most this often per process
+THRESHOLDS_TTL = 30.0
+
+
+class Thresholds:
+    """The default threshold and the per-product ones, reloaded every THRESHOLDS_TTL"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = None
+
+    def load(self):
+        default = DEFAULT_THRESHOLD
+        products = {}
+        prefix = PRODUCT_THRESHOLD_KEY.format('')
+        rows = AdminSettings.objects.filter(Q(key=THRESHOLD_KEY) | Q(key__startswith=prefix)).values_list('key', 'value')
+        for key, value in rows:
+            try:
+                threshold = int(value)
+            except ValueError:
+                logger.warning("Ignoring non-integer AdminSettings %s=%r", key, value)
+                continue
+            if key == THRESHOLD_KEY:
+                default = threshold
+            elif key[len(prefix):].isdigit():
+                products[int(key[len(prefix):])] = threshold
+        return default, products
+
+    def get(self):
+        """(default threshold, {product id: threshold})"""
+        with self.lock:
+            if self.loaded is None or time.monotonic() - self.loaded[0] > THRESHOLDS_TTL:
+                self.loaded = (time.monotonic(), *self.load())
+            return self.loaded[1:]
+
+    def reset(self):
+        with self.lock:
+            self.loaded = None
+
+
+thresholds = Thresholds()
+
+
+def threshold_for(product_id):
+    default, products = thresholds.get()
+    return products.get(product_id, default)
+
+
+def low_condition(threshold=None):
+    """
+    Q for products at or below their threshold (or all at or below
+    ``threshold``), for filters and aggregates on Product.
+    """
+    if threshold is not None:
+        return Q(stock__lte=threshold)
+    default, products = thresholds.get()
+    condition = Q(stock__lte=default) & ~Q(id__in=list(products))
+    for product_id, product_threshold in products.items():
+        condition |= Q(id=product_id, stock__lte=product_threshold)
+    return condition
+
+
+def alerts_enabled():
+    return bool(telegram_bot.BOT_TOKEN and telegram_bot.CHAT_ID)
+
+
+def record_changes(levels):
+    """
+    Queue alerts for the products whose stock just fell to or below their
+    threshold. ``levels`` is {product id: (stock before, stock after)}; call
+    it inside the transaction that made the change. The alerts are queued
+    once it commits, so a rolled-back change neither alerts nor mutes the
+    product's next alert. Returns the product ids that crossed.
+    """
+    if not alerts_enabled():
+        return []
+    default, products = thresholds.get()
+    crossed = [
+        product_id for product_id, (before, after) in levels.items()
+        if before > products.get(product_id, default) >= after
+    ]
+    if not crossed:
+        return []
+
+    alerts = [
+        (product, levels[product.id][1], products.get(product.id, default))
+        for product in Product.objects.filter(id__in=crossed, active=True).only('id', 'name', 'category')
+    ]
+    # The stock change stands even if queueing its alert fails; that is logged
+    transaction.on_commit(lambda: send_alerts(alerts), robust=True)
+    return [product.id for product, _, _ in alerts]
+
+
+def send_alerts(alerts):
+    """Queue (product, stock, threshold) alerts, skipping products alerted within DEBOUNCE"""
+    for product, stock, threshold in alerts:
+        if cache.add(ALERTED_KEY.format(product.id), True, DEBOUNCE):
+            telegram_bot.send_low_stock_alert(product, stock, threshold)
+
+
+def record_reserved(quantities):
+    """
+    record_changes for a reservation that took ``quantities`` ({product id:
+    units}) from the products' rows; reads their new stock, which this
+    transaction holds locked.
+    """
+    if not alerts_enabled() or not quantities:
+        return []
+    after = dict(Product.objects.filter(id__in=quantities).values_list('id', 'stock'))
+    return record_changes({
+        product_id: (stock + quantities[product_id], stock) for product_id, stock in after.items()
+    })
+
+
+def still_low(product_ids):
+    """{product id: stock} for the products still at or below their threshold"""
+    from .stock import available
+
+    default, products = thresholds.get()
+    return {
+        product_id: stock for product_id, stock in available(product_ids).items()
+        if stock <= products.get(product_id, default)
+    }
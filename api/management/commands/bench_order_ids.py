@@ -0,0 +1,124 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from api.models import Order, Sequence
+from api import metrics, order_ids
+import random
+import string
+import time
+
+
+class Rollback(Exception):
+    pass
+
+
+# Share of the occupied IDs whose order is still inside the quiet period,
+# which must be skipped rather than archived
+RECENT_SHARE = 0.1
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark order ID allocation after the counter has wrapped, as the order table fills up '
+        '(changes are rolled back)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--occupancy',
+            type=int,
+            nargs='+',
+            default=[0, 50, 90],
+            help='Share of the ID space still held by orders, in percent (default: 0 50 90)'
+        )
+        parser.add_argument(
+            '--orders',
+            type=int,
+            default=500,
+            help='Orders to allocate at each level (default: 500)'
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'ID space: {order_ids.ID_SPACE} IDs, {options["orders"]} allocations per level\n')
+        self.stdout.write(
+            f'{"occupancy":>10} {"alloc us/id":>12} {"create ms/order":>16} {"collisions/id":>14} '
+            f'{"archived/id":>12} {"skipped/id":>11} {"legacy probes/id":>17} {"legacy us/id":>13}'
+        )
+
+        for occupancy in options['occupancy']:
+            try:
+                with transaction.atomic():
+                    row = self.measure(occupancy, options['orders'])
+                    raise Rollback
+            except Rollback:
+                pass
+            finally:
+                order_ids.reset_block()
+            self.stdout.write('%9d%% %12.1f %16.2f %14.2f %12.2f %11.2f %17.2f %13.1f' % row)
+
+    def measure(self, occupancy, count):
+        """
+        The counter has gone round once and points at the oldest IDs again.
+        ``occupancy`` percent of them still belong to orders: most finished
+        before the quiet period (archived on collision), RECENT_SHARE of them
+        finished recently (skipped for the next value).
+        """
+        Order.objects.all().delete()
+        now = timezone.now()
+        stale = now - timedelta(days=settings.ORDER_ID_QUIET_DAYS + 1)
+        occupied = [n for n in range(order_ids.ID_SPACE) if n % 100 < occupancy]
+        rng = random.Random(occupancy)
+
+        Order.objects.bulk_create(
+            (
+                Order(
+                    order_id=order_ids.order_id_for(n), customer_name='Bench', phone_number='0000000000',
+                    room_number='0', items=[], total_amount=0, status='completed', expires_at=now,
+                    completed_at=now - timedelta(hours=1) if rng.random() < RECENT_SHARE else stale
+                )
+                for n in occupied
+            ),
+            batch_size=2000
+        )
+        Sequence.objects.update_or_create(name=order_ids.SEQUENCE_NAME, defaults={'value': order_ids.ID_SPACE})
+        order_ids.reset_block()
+
+        # Allocation alone (counter block + permutation). Inside this
+        # transaction SQLite reserves a block per ID (see order_ids)
+        start = time.perf_counter()
+        for _ in range(count):
+            order_ids.next_order_id()
+        alloc_us = (time.perf_counter() - start) / count * 1e6
+
+        # Full order creation, including the INSERT and any collision handling
+        before = dict(metrics.ORDER_ID_COLLISIONS.values)
+        start = time.perf_counter()
+        for _ in range(count):
+            Order.objects.create(
+                customer_name='Bench', phone_number='0000000000', room_number='0',
+                items=[], total_amount=0
+            )
+        create_ms = (time.perf_counter() - start) / count * 1e3
+        archived, skipped = (
+            metrics.ORDER_ID_COLLISIONS.values.get((outcome,), 0) - before.get((outcome,), 0)
+            for outcome in ('archived', 'skipped')
+        )
+
+        # The previous random-ID loop, for comparison (ID selection only)
+        probes = 0
+        start = time.perf_counter()
+        for _ in range(count):
+            while True:
+                probes += 1
+                letters = ''.join(random.choices(string.ascii_uppercase, k=2))
+                digits = ''.join(random.choices(string.digits, k=2))
+                if not Order.objects.filter(order_id=f"{letters}{digits}").exists():
+                    break
+        legacy_us = (time.perf_counter() - start) / count * 1e6
+
+        return (
+            occupancy, alloc_us, create_ms, (archived + skipped) / count, archived / count, skipped / count,
+            probes / count, legacy_us
+        )
@@ -0,0 +1,163 @@
+from decimal import Decimal
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from api.fast_serializers import PRODUCT_COLUMNS, order_columns, serialize_orders, serialize_products
+from api.models import Order, Product
+from api.renderers import render_rows
+from api.serializers import OrderSerializer, ProductSerializer
+from api import order_ids
+import time
+
+
+class Rollback(Exception):
+    pass
+
+
+# Values that exercise escaping and formatting: non-ASCII text, the two
+# characters JSONRenderer escapes, quotes, and prices without cents
+AWKWARD_TEXT = ['Maggi', 'Chai "special"', 'Café ☕', 'Line\u2028break\u2029', 'Tab\tand \\ slash', '']
+
+
+class Command(BaseCommand):
+    help = 'Check the fast serializers produce the same bytes as the DRF serializers and time both (changes are rolled back)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=1000, help='Orders to serialize (default: 1000)')
+        parser.add_argument('--products', type=int, default=200, help='Products to serialize (default: 200)')
+        parser.add_argument('--repeat', type=int, default=5, help='Timing runs; the best one counts (default: 5)')
+        parser.add_argument(
+            '--min-speedup',
+            type=float,
+            default=5.0,
+            help='Fail if the order list speedup is below this (default: 5)'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                results = self.measure(options['orders'], options['products'], options['repeat'])
+                raise Rollback
+        except Rollback:
+            pass
+
+        self.stdout.write(
+            f'{"payload":<22} {"bytes":>8} {"DRF fetch":>9} {"DRF ser":>8} {"fast fetch":>10} {"fast ser":>8} '
+            f'{"speedup":>8} {"overall":>8}  identical'
+        )
+        failures = []
+        for name, size, (slow_fetch, slow), (fast_fetch, fast), identical in results:
+            self.stdout.write(
+                f'{name:<22} {size:>8} {slow_fetch * 1000:>9.2f} {slow * 1000:>8.2f} {fast_fetch * 1000:>10.2f} '
+                f'{fast * 1000:>8.2f} {slow / fast:>7.1f}x {(slow_fetch + slow) / (fast_fetch + fast):>7.1f}x  {identical}'
+            )
+            if not identical:
+                failures.append(f'{name}: output differs from the DRF serializer')
+        # Serialization and rendering only; fetching the rows costs about the same either way
+        speedup = results[0][2][1] / results[0][3][1]
+        if speedup < options['min_speedup']:
+            failures.append(f'order list speedup {speedup:.1f}x is below {options["min_speedup"]}x')
+
+        if failures:
+            for failure in failures:
+                self.stdout.write(self.style.ERROR(failure))
+            raise CommandError(f'{len(failures)} check(s) failed')
+        self.stdout.write(self.style.SUCCESS('Fast serializers match'))
+
+    def measure(self, orders, products, repeat):
+        Order.objects.all().delete()
+        self.create_orders(orders)
+        self.create_products(products)
+
+        orders = Order.objects.order_by('-created_at', '-order_id')
+        products = Product.objects.filter(active=True)
+        projection = ['orderId', 'status', 'totalAmount', 'createdAt']
+        cases = [
+            (
+                f'{orders.count()} orders',
+                lambda: list(orders.all()),
+                lambda objects: JSONRenderer().render(OrderSerializer(objects, many=True).data),
+                lambda: list(orders.values_list(*order_columns(), named=True)),
+                lambda rows: render_rows(serialize_orders(rows)),
+            ),
+            (
+                f'{orders.count()} orders, 4 fields',
+                lambda: list(orders.all()),
+                lambda objects: JSONRenderer().render(OrderSerializer(objects, many=True, fields=projection).data),
+                lambda: list(orders.values_list(*order_columns(projection), named=True)),
+                lambda rows: render_rows(serialize_orders(rows, projection)),
+            ),
+            (
+                f'{products.count()} products',
+                lambda: list(products.all()),
+                lambda objects: JSONRenderer().render(ProductSerializer(objects, many=True).data),
+                lambda: list(products.values_list(*PRODUCT_COLUMNS, named=True)),
+                lambda rows: render_rows(serialize_products(rows)),
+            ),
+        ]
+
+        results = []
+        for name, slow_fetch, slow, fast_fetch, fast in cases:
+            objects, rows = slow_fetch(), fast_fetch()
+            expected, actual = slow(objects), fast(rows)
+            results.append((
+                name,
+                len(actual),
+                (self.best(slow_fetch, repeat), self.best(lambda: slow(objects), repeat)),
+                (self.best(fast_fetch, repeat), self.best(lambda: fast(rows), repeat)),
+                expected == actual,
+            ))
+        return results
+
+    def best(self, function, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - started)
+        return min(timings)
+
+    def create_orders(self, count):
+        now = timezone.now()
+        statuses = ['reserved', 'picked', 'completed', 'cancelled']
+        Order.objects.bulk_create([
+            Order(
+                order_id=order_ids.order_id_for(n),
+                customer_name=AWKWARD_TEXT[n % len(AWKWARD_TEXT)] or 'Student',
+                phone_number='9%09d' % n,
+                room_number=f'B-{n % 300}',
+                notes=AWKWARD_TEXT[n % len(AWKWARD_TEXT)] if n % 3 else None,
+                items=[
+                    {'productId': n % 50, 'name': AWKWARD_TEXT[n % len(AWKWARD_TEXT)], 'price': 20, 'qty': 1},
+                    {'productId': n % 50 + 1, 'name': 'Samosa', 'price': 12.5, 'qty': n % 4 + 1},
+                ],
+                total_amount=Decimal(20) + Decimal('12.5') * (n % 4 + 1),
+                status=statuses[n % len(statuses)],
+                expires_at=now + timedelta(minutes=15),
+            )
+            for n in range(count)
+        ])
+        # Spread the timestamps and fill in the optional ones, with and without microseconds
+        for n, order_id in enumerate(Order.objects.values_list('order_id', flat=True)):
+            created_at = now - timedelta(minutes=n, microseconds=(n * 7919) % 1000000 if n % 2 else 0)
+            Order.objects.filter(order_id=order_id).update(
+                created_at=created_at,
+                picked_at=created_at + timedelta(minutes=5) if n % 4 in (1, 2) else None,
+                completed_at=created_at + timedelta(minutes=9) if n % 4 == 2 else None,
+                cancelled_at=created_at + timedelta(minutes=15) if n % 4 == 3 else None,
+            )
+
+    def create_products(self, count):
+        Product.objects.bulk_create([
+            Product(
+                name=f'{AWKWARD_TEXT[n % len(AWKWARD_TEXT)]} {n}',
+                category=['Snacks', 'Drinks', 'Instant Food'][n % 3],
+                price=Decimal(n % 90 + 10) + Decimal(n % 4) / 4,
+                stock=n % 40,
+                image=['', None, 'https://example.com/p.png'][n % 3],
+                image_digest=f'{n:064x}' if n % 5 == 0 else None,
+            )
+            for n in range(count)
+        ])
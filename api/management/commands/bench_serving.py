@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand, CommandError
+from api import serving_bench
+
+
+class Command(BaseCommand):
+    help = 'Compare gunicorn sync (WSGI) and uvicorn (ASGI) workers at the same memory budget under slow clients'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--memory-mb',
+            type=float,
+            default=400,
+            help='Memory budget per mode, master included; sets the worker count (default: 400)'
+        )
+        parser.add_argument('--duration', type=float, default=15, help='Seconds of probing per mode (default: 15)')
+        parser.add_argument('--slow-clients', type=int, default=50, help='Connections trickling their headers (default: 50)')
+        parser.add_argument('--probes', type=int, default=10, help='Concurrent probe clients (default: 10)')
+        parser.add_argument('--trickle', type=float, default=1.0, help='Seconds between a slow client\'s header lines (default: 1)')
+
+    def handle(self, *args, **options):
+        paths = serving_bench.probe_paths()
+        reports = []
+        try:
+            for mode in serving_bench.MODES:
+                master, worker = serving_bench.worker_memory(mode, paths)
+                workers = serving_bench.workers_for_budget(options['memory_mb'], master, worker)
+                self.stdout.write(
+                    f'{mode.upper()}: master {master:.0f} MB, {worker:.0f} MB per worker -> {workers} worker(s); '
+                    f'{options["slow_clients"]} slow clients, {options["probes"]} probes for {options["duration"]:.0f}s...'
+                )
+                reports.append(serving_bench.run(
+                    mode, workers, paths,
+                    duration=options['duration'],
+                    slow_clients=options['slow_clients'],
+                    probes=options['probes'],
+                    trickle=options['trickle'],
+                ))
+        except serving_bench.ServerError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(
+            f'{"mode":<6} {"workers":>7} {"RSS MB":>8} {"done":>7} {"errors":>6} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8}'
+        )
+        for report in reports:
+            self.stdout.write(
+                f'{report["mode"]:<6} {report["workers"]:>7} {report["rss_mb"]:>8} {report["completed"]:>7} '
+                f'{report["errors"]:>6} {report["throughput_rps"]:>8} {report["p50_ms"]!s:>8} {report["p95_ms"]!s:>8}'
+            )
+        self.stdout.write(self.style.SUCCESS('Benchmark finished'))
@@ -0,0 +1,100 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from api.models import Product, StockMovement, StockSnapshot
+from api.stock import InsufficientStock, available, record_movements, reserve, set_stock
+from api import stock_ledger
+from types import SimpleNamespace
+import itertools
+import threading
+import time
+
+
+BENCH_NAME = 'Bench stock'
+
+
+class Command(BaseCommand):
+    help = 'Time concurrent reservations of one product with its stock on one row and split over stripes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=16, help='Concurrent order transactions (default: 16)')
+        parser.add_argument('--orders', type=int, default=400, help='Units to sell, one per order (default: 400)')
+        parser.add_argument(
+            '--stripes',
+            type=int,
+            nargs='+',
+            default=[0, 8],
+            help='Stripe counts to compare; 0 keeps the stock on the product row (default: 0 8)'
+        )
+        parser.add_argument(
+            '--hold',
+            type=float,
+            default=0.005,
+            help='Seconds each transaction stays open after reserving, like the rest of order creation (default: 0.005)'
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor == 'sqlite':
+            self.stdout.write(self.style.WARNING(
+                'SQLite runs one write transaction at a time, so stripes cannot help here; '
+                'run this against PostgreSQL (DATABASE_URL) to see them scale'
+            ))
+
+        # Committed for real, so the worker threads see it; removed at the end
+        product = Product.objects.create(name=BENCH_NAME, category='Bench', price=1, stock=options['orders'])
+        failures = []
+        try:
+            self.stdout.write(f'{"stripes":>8} {"orders/s":>10} {"refused":>8} {"left":>6}')
+            for stripes in options['stripes']:
+                set_stock({product.id: options['orders']})
+                stock_ledger.compact([product.id], stripes=stripes)
+                sold, refused, elapsed = self.run(product.id, options['orders'] + options['workers'], options)
+                left = available([product.id])[product.id]
+                self.stdout.write(f'{stripes:>8} {sold / elapsed:>10.1f} {refused:>8} {left:>6}')
+                if sold != options['orders'] or left != 0:
+                    failures.append(f'{stripes} stripe(s): sold {sold} of {options["orders"]} units, {left} left')
+
+            result = stock_ledger.reconcile([product.id])
+            if result.discrepancies:
+                failures.append(f'ledger does not match the stock: {result.discrepancies}')
+        finally:
+            StockMovement.objects.filter(product_id=product.id).delete()
+            StockSnapshot.objects.filter(product_id=product.id).delete()
+            product.delete()
+
+        if failures:
+            for failure in failures:
+                self.stdout.write(self.style.ERROR(failure))
+            raise CommandError(f'{len(failures)} check(s) failed')
+        self.stdout.write(self.style.SUCCESS('No unit was oversold and the ledger matches'))
+
+    def run(self, product_id, attempts, options):
+        """Try ``attempts`` one-unit orders from concurrent workers; returns (sold, refused, seconds)"""
+        counter = itertools.count()
+        results = {'sold': 0, 'refused': 0}
+        lock = threading.Lock()
+        items = [{'productId': product_id, 'qty': 1}]
+        order = SimpleNamespace(order_id='', items=items)
+
+        def work():
+            try:
+                while next(counter) < attempts:
+                    try:
+                        with transaction.atomic():
+                            reserve(items)
+                            record_movements('reserve', [order])
+                            time.sleep(options['hold'])
+                        outcome = 'sold'
+                    except InsufficientStock:
+                        outcome = 'refused'
+                    with lock:
+                        results[outcome] += 1
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=work) for _ in range(options['workers'])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results['sold'], results['refused'], time.perf_counter() - started
@@ -0,0 +1,166 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.test import override_settings
+from api.models import Order, OrderEvent, TelegramBoard, TelegramOutbox, TelegramUpdate
+from api.telegram_fake import FakeTelegramServer
+from api.telegram_outbox import CircuitBreaker, OutboxWorker, RateLimiter
+from api.telegram_updates import process_pending_updates
+from api import telegram_bot
+from collections import Counter
+from decimal import Decimal
+import httpx
+import time
+
+
+BENCH_CUSTOMER = 'Bench Telegram'
+BENCH_CHAT_PREFIX = 'bench-'
+
+
+class Command(BaseCommand):
+    help = (
+        'Deliver an order rush to a rate-limited fake Telegram API, one message per order and on a live board, '
+        'then press half the pick buttons'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=40, help='Orders in the rush (default: 40)')
+        parser.add_argument(
+            '--rate-limit',
+            type=int,
+            default=20,
+            help='Messages and edits the fake API accepts per chat per --window (default: 20, like a Telegram group)'
+        )
+        parser.add_argument(
+            '--window',
+            type=float,
+            default=3.0,
+            help="Seconds standing in for Telegram's one-minute window, to keep the run short (default: 3)"
+        )
+        parser.add_argument(
+            '--board-rate',
+            type=int,
+            default=settings.TELEGRAM_BOARD_RATE or 10,
+            help='New orders a minute that switch to the live board (default: TELEGRAM_BOARD_RATE)'
+        )
+        parser.add_argument('--pick-share', type=float, default=0.5, help='Share of orders picked from Telegram (default: 0.5)')
+        parser.add_argument('--timeout', type=float, default=120.0, help='Seconds to wait for the outbox to drain (default: 120)')
+
+    def handle(self, *args, **options):
+        failures = []
+        self.stdout.write(
+            f'{"mode":>10} {"messages":>9} {"edits":>6} {"429s":>5} {"seconds":>8} {"unreachable":>12} {"stale":>6}'
+        )
+        try:
+            for mode, board_rate in (('per-order', 0), ('board', options['board_rate'])):
+                result = self.run(mode, board_rate, options)
+                self.stdout.write(
+                    f'{mode:>10} {result["messages"]:>9} {result["edits"]:>6} {result["rejected"]:>5} '
+                    f'{result["seconds"]:>8.1f} {result["unreachable"]:>12} {result["stale"]:>6}'
+                )
+                if result['pending']:
+                    failures.append(f'{mode}: {result["pending"]} notification(s) still pending after {options["timeout"]}s')
+                if result['unreachable']:
+                    failures.append(f'{mode}: {result["unreachable"]} reserved order(s) without a pick button')
+                if result['stale']:
+                    failures.append(f'{mode}: {result["stale"]} picked order(s) still showing a pick button')
+                if result['not_picked']:
+                    failures.append(f'{mode}: {result["not_picked"]} button press(es) did not pick the order')
+        finally:
+            self.cleanup()
+
+        if failures:
+            for failure in failures:
+                self.stdout.write(self.style.ERROR(failure))
+            raise CommandError(f'{len(failures)} check(s) failed')
+        self.stdout.write(self.style.SUCCESS('Every order had a reachable pick button and every press was shown'))
+
+    def run(self, mode, board_rate, options):
+        chat_id = f'{BENCH_CHAT_PREFIX}{mode}'
+        window = options['window']
+        saved = (telegram_bot.BOT_TOKEN, telegram_bot.CHAT_ID, telegram_bot.API_BASE)
+        with FakeTelegramServer(rate_limit=options['rate_limit'], rate_window=window) as server, \
+                override_settings(TELEGRAM_BOARD_RATE=board_rate):
+            telegram_bot.BOT_TOKEN, telegram_bot.CHAT_ID, telegram_bot.API_BASE = 'bench', chat_id, server.url
+            worker = OutboxWorker(
+                client=httpx.Client(timeout=5.0),
+                limiter=RateLimiter(rate=options['rate_limit'], per=window, burst=3),
+                breaker=CircuitBreaker(threshold=50, cooldown=1.0)
+            )
+            try:
+                started = time.perf_counter()
+                orders = [self.place_order(index) for index in range(options['orders'])]
+                self.drain(worker, chat_id, options['timeout'])
+
+                buttons = server.state.buttons(chat_id)
+                unreachable = sum(f'pick_{order.order_id}' not in buttons for order in orders)
+                picked = [order for order in orders[:int(len(orders) * options['pick_share'])] if f'pick_{order.order_id}' in buttons]
+                self.press(chat_id, picked, buttons)
+                pending = self.drain(worker, chat_id, options['timeout'])
+                seconds = time.perf_counter() - started
+
+                buttons = server.state.buttons(chat_id)
+                stale = sum(f'pick_{order.order_id}' in buttons for order in picked)
+                not_picked = len(picked) - Order.objects.filter(pk__in=[order.pk for order in picked], status='picked').count()
+                calls = Counter(call['method'] for call in server.state.calls)
+            finally:
+                telegram_bot.BOT_TOKEN, telegram_bot.CHAT_ID, telegram_bot.API_BASE = saved
+                worker.client.close()
+
+        return {
+            'messages': calls['sendMessage'],
+            'edits': calls['editMessageText'],
+            'rejected': server.state.rejected,
+            'seconds': seconds,
+            'pending': pending,
+            'unreachable': unreachable,
+            'stale': stale,
+            'not_picked': not_picked,
+        }
+
+    def place_order(self, index):
+        with transaction.atomic():
+            order = Order.objects.create(
+                customer_name=BENCH_CUSTOMER,
+                phone_number=f'9{index:09d}',
+                room_number=str(100 + index),
+                items=[{'productId': 0, 'name': 'Bench snack', 'qty': 1, 'price': 20}],
+                total_amount=Decimal('20'),
+            )
+            telegram_bot.send_order_notification(order)
+        return order
+
+    def press(self, chat_id, orders, buttons):
+        """Record the button presses as webhook updates, as the webhook view would"""
+        update_id = (TelegramUpdate.objects.aggregate(last=Max('update_id'))['last'] or 0) + 1
+        TelegramUpdate.objects.bulk_create([
+            TelegramUpdate(update_id=update_id + index, chat_id=chat_id, payload={
+                'update_id': update_id + index,
+                'callback_query': {
+                    'id': f'bench-{update_id + index}',
+                    'data': f'pick_{order.order_id}',
+                    'message': {'chat': {'id': chat_id}, 'message_id': buttons[f'pick_{order.order_id}']},
+                },
+            })
+            for index, order in enumerate(orders)
+        ])
+
+    def drain(self, worker, chat_id, timeout):
+        """Run the worker until the chat's updates and outbox are done; returns the rows left pending"""
+        outbox = TelegramOutbox.objects.filter(chat_id=chat_id, status='pending')
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            process_pending_updates()
+            wait = worker.drain_once()
+            if not outbox.exists() and not TelegramUpdate.objects.filter(chat_id=chat_id, status='pending').exists():
+                return 0
+            time.sleep(min(max(wait or 0.05, 0.01), 0.5))
+        return outbox.count()
+
+    def cleanup(self):
+        TelegramOutbox.objects.filter(chat_id__startswith=BENCH_CHAT_PREFIX).delete()
+        TelegramUpdate.objects.filter(chat_id__startswith=BENCH_CHAT_PREFIX).delete()
+        OrderEvent.objects.filter(data__customerName=BENCH_CUSTOMER).delete()
+        Order.objects.filter(customer_name=BENCH_CUSTOMER).delete()
+        TelegramBoard.objects.filter(chat_id__startswith=BENCH_CHAT_PREFIX).delete()
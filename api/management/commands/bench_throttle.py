@@ -0,0 +1,170 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client, override_settings
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from api import throttling
+from api.middleware import shedder
+from api.throttling import TokenBucketThrottle, memory_buckets
+from api.views import ADMIN_PIN
+import logging
+import time
+
+
+# Documentation address range, so the checks never share buckets with real clients
+CLIENT_IP = '198.51.100.{}'
+
+
+class Command(BaseCommand):
+    help = 'Time the rate limit and load shedding checks and try them against the views (no data is changed)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=100000, help='Checks per timing (default: 100000)')
+        parser.add_argument(
+            '--max-us',
+            type=float,
+            default=20.0,
+            help='Fail if a request\'s rate limit and load shedding checks take longer than this (default: 20)'
+        )
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        failures = []
+
+        timings = self.measure(iterations)
+        self.stdout.write(f'{"check":<40} {"us/call":>8}')
+        for name, seconds in timings.items():
+            self.stdout.write(f'{name:<40} {seconds * 1e6:>8.2f}')
+        hot_path = timings['throttle, in memory'] + timings['load shedding']
+        self.stdout.write(f'Per request on the hot path: {hot_path * 1e6:.2f} us')
+        if hot_path * 1e6 > options['max_us']:
+            failures.append(f'hot path checks take {hot_path * 1e6:.2f} us, over {options["max_us"]} us')
+
+        # The refusals are expected; keep django.request from logging each one
+        request_logger = logging.getLogger('django.request')
+        level = request_logger.level
+        request_logger.setLevel(logging.CRITICAL)
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'], THROTTLE_SHARED=False):
+            memory_buckets.clear()
+            try:
+                failures += self.check_limits()
+                failures += self.check_shedding()
+            finally:
+                memory_buckets.clear()
+                request_logger.setLevel(level)
+
+        if failures:
+            for failure in failures:
+                self.stdout.write(self.style.ERROR(failure))
+            raise CommandError(f'{len(failures)} check(s) failed')
+        self.stdout.write(self.style.SUCCESS('Rate limits and load shedding work'))
+
+    def measure(self, iterations):
+        factory = APIRequestFactory()
+        request = Request(factory.get('/api/orders', REMOTE_ADDR=CLIENT_IP.format(1)))
+        throttle = TokenBucketThrottle()
+        # Plenty of tokens, so every call takes the allow path like normal traffic
+        rates = {'default': {'ip': f'{iterations * 10}/s'}}
+
+        def allow():
+            for _ in range(iterations):
+                throttle.allow_request(request, None)
+
+        def shed_check():
+            target = settings.LOAD_SHED_LATENCY or 1.0
+            for _ in range(iterations):
+                shedder.shed_share(target)
+                shedder.observe(0.01)
+
+        def bucket():
+            for n in range(iterations):
+                memory_buckets.take('bench:ip:%d' % (n % 1000), iterations * 10, iterations * 10.0)
+
+        timings = {}
+        saved = shedder.average, shedder.updated
+        try:
+            timings['token bucket alone'] = self.per_call(bucket, iterations)
+            with override_settings(THROTTLE_RATES=rates, THROTTLE_SHARED=False):
+                timings['throttle, in memory'] = self.per_call(allow, iterations)
+            # A round trip per call: time fewer of them
+            shared = max(iterations // 100, 10)
+            with override_settings(THROTTLE_RATES=rates, THROTTLE_SHARED=True):
+                timings[f'throttle, shared cache ({settings.CACHES["default"]["BACKEND"].rsplit(".", 1)[-1]})'] = (
+                    self.per_call(lambda: [throttle.allow_request(request, None) for _ in range(shared)], shared)
+                )
+            timings['load shedding'] = self.per_call(shed_check, iterations)
+        finally:
+            shedder.average, shedder.updated = saved
+            memory_buckets.clear()
+        return timings
+
+    def per_call(self, function, calls):
+        started = time.perf_counter()
+        function()
+        return (time.perf_counter() - started) / calls
+
+    def check_limits(self):
+        failures = []
+        client = Client()
+
+        # PIN guesses: the bucket allows its size, then 429 with Retry-After
+        size, _ = throttling.parse_rate(settings.THROTTLE_RATES['admin-pin']['ip'])
+        codes = [
+            client.post('/api/admin/verify-pin', {'pin': 'wrong'}, content_type='application/json',
+                        REMOTE_ADDR=CLIENT_IP.format(2))
+            for _ in range(size + 1)
+        ]
+        self.report('admin-pin', [response.status_code for response in codes])
+        if any(response.status_code != 401 for response in codes[:size]):
+            failures.append('admin-pin: requests within the limit were refused')
+        if codes[-1].status_code != 429 or not codes[-1].get('Retry-After'):
+            failures.append('admin-pin: no 429 with Retry-After past the limit')
+        other = client.post('/api/admin/verify-pin', {'pin': 'wrong'}, content_type='application/json',
+                            REMOTE_ADDR=CLIENT_IP.format(3))
+        if other.status_code != 401:
+            failures.append('admin-pin: another IP was refused')
+
+        # One phone from many addresses: the phone bucket stops it (the items
+        # are invalid, so nothing is created)
+        size, _ = throttling.parse_rate(settings.THROTTLE_RATES['order-create']['phone'])
+        body = {'customerName': 'Bench', 'phoneNumber': '9000000000', 'roomNumber': 'B-1', 'items': []}
+        codes = [
+            client.post('/api/orders', body, content_type='application/json', REMOTE_ADDR=CLIENT_IP.format(10 + n))
+            for n in range(size + 1)
+        ]
+        self.report('order-create (phone)', [response.status_code for response in codes])
+        if any(response.status_code == 429 for response in codes[:size]):
+            failures.append('order-create: requests within the phone limit were refused')
+        if codes[-1].status_code != 429:
+            failures.append('order-create: no 429 past the phone limit')
+        return failures
+
+    def check_shedding(self):
+        failures = []
+        client = Client()
+        target = settings.LOAD_SHED_LATENCY
+        if not target:
+            self.stdout.write('Load shedding is disabled (LOAD_SHED_LATENCY=0)')
+            return failures
+
+        saved = shedder.average, shedder.updated
+        try:
+            # Pretend the worker is at three times its latency target
+            shedder.average, shedder.updated = target * 3, time.monotonic()
+            public = [client.get('/api/orders?limit=1', REMOTE_ADDR=CLIENT_IP.format(50)).status_code for _ in range(50)]
+            shedder.average, shedder.updated = target * 3, time.monotonic()
+            admin = [client.get(f'/api/admin/stats?pin={ADMIN_PIN}', REMOTE_ADDR=CLIENT_IP.format(51)).status_code for _ in range(20)]
+        finally:
+            shedder.average, shedder.updated = saved
+
+        self.report('overloaded, public', public)
+        self.report('overloaded, admin', admin)
+        if 503 not in public or all(code == 503 for code in public):
+            failures.append('load shedding: expected part of the public requests refused with 503')
+        if 503 in admin:
+            failures.append('load shedding: admin requests were refused')
+        return failures
+
+    def report(self, name, codes):
+        counts = {code: codes.count(code) for code in sorted(set(codes))}
+        self.stdout.write(f'{name:<24} ' + ', '.join(f'{count} x {code}' for code, count in counts.items()))
@@ -0,0 +1,134 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from api.models import Order, TelegramOutbox
+from api import rollups
+from api.order_ids import order_id_for
+from api.timeutils import local_day_range
+from datetime import timedelta
+import random
+
+
+STATUSES = ['reserved', 'picked', 'completed', 'cancelled']
+
+
+def hot_queries():
+    """The order lifecycle queries that must be served by an index"""
+    now = timezone.now()
+    today_start, _ = local_day_range()
+    cursor_time = now - timedelta(hours=1)
+
+    return [
+        ('active order for phone (order_list POST)',
+         Order.objects.filter(phone_number='9000000001', status__in=['reserved', 'picked']).order_by().only('order_id')[:1]),
+        ('due reservations (expiry sweep)',
+         Order.objects.filter(status='reserved', expires_at__lt=now).order_by().values_list('order_id', 'items', 'expires_at', 'created_at', 'total_amount', 'customer_name', 'room_number')),
+        ('reserved deadlines (expiry scheduler)',
+         Order.objects.filter(status='reserved').order_by().values_list('order_id', 'expires_at')),
+        ('stats rollups (admin_stats)', rollups.totals(today_start)),
+        ('active orders (admin_active_orders)',
+         Order.objects.filter(status__in=['reserved', 'picked']).order_by('-created_at', '-order_id')[:51]),
+        ('order page after cursor (order_list GET)',
+         Order.objects.filter(created_at__lte=cursor_time)
+         .filter(Q(created_at__lt=cursor_time) | Q(order_id__lt='MM50'))
+         .order_by('-created_at', '-order_id')[:51]),
+        ('pending outbox rows (telegram_worker)',
+         TelegramOutbox.objects.filter(status='pending').order_by('id')[:100]),
+    ]
+
+
+def is_sequential_scan(plan, vendor, limited=False):
+    """
+    Detect a full table scan. A full walk of an index counts too, unless the
+    query has a LIMIT (e.g. a keyset page reading the index in order).
+    """
+    for line in plan.splitlines():
+        if vendor == 'postgresql':
+            if 'Seq Scan' in line:
+                return True
+        elif vendor == 'sqlite':
+            detail = line.split(None, 3)[-1]
+            if detail.startswith('SCAN ') and 'CONSTANT ROW' not in detail:
+                if 'USING' not in detail or not limited:
+                    return True
+    return False
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'EXPLAIN the hot order queries on a seeded dataset and fail if any uses a sequential scan'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--orders',
+            type=int,
+            default=5000,
+            help='Number of orders to seed (rolled back afterwards, default: 5000)'
+        )
+        parser.add_argument(
+            '--verbose-plans',
+            action='store_true',
+            help='Print the full plan of every query'
+        )
+
+    def handle(self, *args, **options):
+        vendor = connection.vendor
+        if vendor not in ('sqlite', 'postgresql'):
+            raise CommandError(f'Unsupported database backend: {vendor}')
+
+        failures = []
+        try:
+            with transaction.atomic():
+                self.seed(options['orders'])
+                with connection.cursor() as cursor:
+                    cursor.execute('ANALYZE')
+                    if vendor == 'postgresql':
+                        # Small seeded tables make seq scans look cheap; check that an index is usable at all
+                        cursor.execute('SET LOCAL enable_seqscan = off')
+
+                for name, queryset in hot_queries():
+                    plan = queryset.explain()
+                    if is_sequential_scan(plan, vendor, limited=queryset.query.high_mark is not None):
+                        failures.append(name)
+                        self.stdout.write(self.style.ERROR(f'SEQ SCAN  {name}'))
+                        self.stdout.write(plan)
+                    else:
+                        self.stdout.write(self.style.SUCCESS(f'index     {name}'))
+                        if options['verbose_plans']:
+                            self.stdout.write(plan)
+                raise Rollback
+        except Rollback:
+            pass
+
+        if failures:
+            raise CommandError(f'{len(failures)} hot quer{"y" if len(failures) == 1 else "ies"} fell back to a sequential scan')
+        self.stdout.write(self.style.SUCCESS(f'All hot queries use an index ({vendor})'))
+
+    def seed(self, count):
+        now = timezone.now()
+        orders = [
+            Order(
+                order_id=order_id_for(n),
+                customer_name='Plan Check',
+                phone_number=f'9{n % 1000:09d}',
+                room_number=str(n % 200),
+                items=[{'productId': 1, 'name': 'Item', 'price': 10, 'qty': 1}],
+                total_amount=10,
+                status=random.choice(STATUSES),
+                expires_at=now + timedelta(minutes=random.randint(-60, 15)),
+            )
+            for n in range(count)
+        ]
+        Order.objects.bulk_create(orders, batch_size=1000, ignore_conflicts=True)
+
+        # created_at is auto_now_add; spread it over past days so date ranges are selective
+        for start in range(0, count, 100):
+            batch = [order.order_id for order in orders[start:start + 100]]
+            Order.objects.filter(order_id__in=batch).update(created_at=now - timedelta(hours=start // 100))
+
+        # Rollup rows for those orders, so admin_stats is planned against a populated table
+        rollups.rebuild()
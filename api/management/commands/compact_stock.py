@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from api import stock_ledger
+import time
+
+
+class Command(BaseCommand):
+    help = 'Compact the stock ledger once: update striped products\' stock, stripe or fold them back, and take snapshots'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--product',
+            type=int,
+            action='append',
+            help='Only this product id (repeatable); default: every product that moved since the last run'
+        )
+        parser.add_argument(
+            '--stripes',
+            type=int,
+            help='Split the --product(s) into this many stock counters (0 folds them back), e.g. before a sale; '
+                 'the scheduler still folds a product back once it is quiet'
+        )
+        parser.add_argument('--prune', action='store_true', help='Also delete ledger rows past the retention period')
+
+    def handle(self, *args, **options):
+        if options['stripes'] is not None and not options['product']:
+            raise CommandError('--stripes needs --product')
+        if options['stripes'] is not None and options['stripes'] < 0:
+            raise CommandError('--stripes must be 0 or more')
+
+        started = time.monotonic()
+        result = stock_ledger.compact(options['product'], options['stripes'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Compacted {result.products} product(s) in {time.monotonic() - started:.2f}s: '
+            f'{result.snapshots} snapshot(s), {result.striped} striped, {result.unstriped} folded back'
+        ))
+        if options['prune']:
+            snapshots, movements = stock_ledger.prune()
+            self.stdout.write(self.style.SUCCESS(f'Pruned {snapshots} snapshot(s) and {movements} movement(s)'))
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from api.telegram_fake import FakeTelegramServer
+import time
+
+
+class Command(BaseCommand):
+    help = 'Run a local fake Telegram Bot API (set TELEGRAM_API_BASE to its URL)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=8081, help='Port to listen on (default: 8081)')
+        parser.add_argument('--latency', type=float, default=0.0, help='Seconds to delay every call')
+        parser.add_argument('--fail-rate', type=float, default=0.0, help='Fraction of calls answered with 502')
+        parser.add_argument(
+            '--rate-limit',
+            type=int,
+            default=None,
+            help='Max sendMessage/editMessageText calls per chat per --rate-window before answering 429'
+        )
+        parser.add_argument('--rate-window', type=float, default=60.0, help='Rate limit window in seconds (default: 60)')
+
+    def handle(self, *args, **options):
+        server = FakeTelegramServer(
+            port=options['port'],
+            latency=options['latency'],
+            fail_rate=options['fail_rate'],
+            rate_limit=options['rate_limit'],
+            rate_window=options['rate_window'],
+        ).start()
+        self.stdout.write(self.style.SUCCESS(f'Fake Telegram API listening on {server.url}'))
+
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            server.stop()
+            self.stdout.write(self.style.WARNING(f'Stopped after {len(server.state.calls)} call(s)'))
@@ -0,0 +1,132 @@
+from django.core.management.base import BaseCommand, CommandError
+from api import loadtest
+import json
+import logging
+
+
+class Command(BaseCommand):
+    help = 'Replay an "order rush" against the WSGI/ASGI app with a fake Telegram API and report latency, errors and oversells'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--entry',
+            choices=['wsgi', 'asgi', 'both'],
+            default='wsgi',
+            help='Application entry point to drive (default: wsgi)'
+        )
+        parser.add_argument('--requests', type=int, default=2000, help='Total requests per entry point (default: 2000)')
+        parser.add_argument('--concurrency', type=int, default=20, help='Concurrent clients (default: 20)')
+        parser.add_argument('--products', type=int, default=20, help='Products to seed (default: 20)')
+        parser.add_argument('--stock', type=int, default=50, help='Stock of each ordinary product (default: 50)')
+        parser.add_argument('--hot-stock', type=int, default=100, help='Stock of the contended "Maggi" product (default: 100)')
+        parser.add_argument('--hot-share', type=float, default=0.7, help='Share of orders for the hot product (default: 0.7)')
+        parser.add_argument(
+            '--stripes',
+            type=int,
+            default=0,
+            help='Split the hot product\'s stock into this many counters (default: 0, one row)'
+        )
+        parser.add_argument(
+            '--mix',
+            help='Request mix as action=weight pairs, e.g. catalog=45,create=25,cancel=5,pick=8,complete=7,stats=10'
+        )
+        parser.add_argument('--seed', type=int, default=1, help='Random seed (default: 1)')
+        parser.add_argument('--telegram-latency', type=float, default=0.0, help='Fake Telegram API latency in seconds')
+        parser.add_argument('--save', help='Write the report to this JSON file (a baseline)')
+        parser.add_argument('--compare', help='Compare against a saved JSON baseline and fail on regressions')
+        parser.add_argument(
+            '--tolerance',
+            type=float,
+            default=0.25,
+            help='Allowed latency/throughput regression against the baseline (default: 0.25 = 25%%)'
+        )
+        parser.add_argument('--keep', action='store_true', help='Keep the seeded products and orders')
+
+    def handle(self, *args, **options):
+        mix = self.parse_mix(options['mix']) if options['mix'] else None
+        entries = ['wsgi', 'asgi'] if options['entry'] == 'both' else [options['entry']]
+
+        # Rejected orders (sold out) are expected; don't log a warning for each
+        logging.getLogger('django.request').setLevel(logging.ERROR)
+
+        reports = {}
+        for entry in entries:
+            self.stdout.write(f'Running {options["requests"]} requests against {entry.upper()} '
+                              f'with {options["concurrency"]} clients...')
+            reports[entry] = loadtest.run(
+                entry=entry,
+                requests=options['requests'],
+                concurrency=options['concurrency'],
+                products=options['products'],
+                stock=options['stock'],
+                hot_stock=options['hot_stock'],
+                hot_share=options['hot_share'],
+                mix=mix,
+                seed=options['seed'],
+                telegram_latency=options['telegram_latency'],
+                keep=options['keep'],
+                stripes=options['stripes'],
+            )
+            self.print_report(reports[entry])
+
+        if options['save']:
+            with open(options['save'], 'w') as f:
+                json.dump(reports, f, indent=2, sort_keys=True)
+            self.stdout.write(self.style.SUCCESS(f'Saved baseline to {options["save"]}'))
+
+        failures = [
+            f'{entry}: {report[metric]} {label}'
+            for entry, report in reports.items()
+            for metric, label in (
+                ('oversold_units', 'unit(s) oversold'),
+                ('stock_drift_units', 'unit(s) of stock drift'),
+                ('ledger_discrepancies', 'stock ledger discrepancy(ies)'),
+            )
+            if report[metric]
+        ]
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+            for entry, report in reports.items():
+                if entry not in baseline:
+                    self.stdout.write(self.style.WARNING(f'No {entry} baseline in {options["compare"]}'))
+                    continue
+                regressions = loadtest.compare(report, baseline[entry], options['tolerance'])
+                failures += [f'{entry}: {regression}' for regression in regressions]
+
+        if failures:
+            for failure in failures:
+                self.stdout.write(self.style.ERROR(failure))
+            raise CommandError(f'{len(failures)} check(s) failed')
+        self.stdout.write(self.style.SUCCESS('Load test passed'))
+
+    def parse_mix(self, value):
+        try:
+            mix = {name: float(weight) for name, weight in (pair.split('=') for pair in value.split(','))}
+        except ValueError:
+            raise CommandError('--mix must look like catalog=45,create=25')
+        unknown = set(mix) - set(loadtest.DEFAULT_MIX)
+        if unknown:
+            raise CommandError(f'Unknown action(s) in --mix: {", ".join(sorted(unknown))}')
+        return mix
+
+    def print_report(self, report):
+        self.stdout.write(
+            f'{"action":<10} {"requests":>8} {"ok":>6} {"4xx":>6} {"errors":>6} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}'
+        )
+        for action, stats in report['actions'].items():
+            self.stdout.write(
+                f'{action:<10} {stats["requests"]:>8} {stats["ok"]:>6} {stats["rejected"]:>6} {stats["errors"]:>6} '
+                f'{stats["p50_ms"]:>8} {stats["p95_ms"]:>8} {stats["p99_ms"]:>8}'
+            )
+        self.stdout.write(
+            f'{report["requests"]} requests in {report["elapsed_s"]}s = {report["throughput_rps"]} req/s, '
+            f'p50 {report["p50_ms"]} ms, p95 {report["p95_ms"]} ms, p99 {report["p99_ms"]} ms, {report["errors"]} error(s)'
+        )
+        telegram = report['telegram']
+        self.stdout.write(
+            f'{report["orders_created"]} orders created, {report["oversold_units"]} unit(s) oversold, '
+            f'{report["stock_drift_units"]} unit(s) of stock drift, {report["ledger_discrepancies"]} ledger discrepancy(ies); '
+            f'Telegram: {telegram["calls"]} call(s), '
+            f'{telegram["outbox_pending"]} pending, {telegram["outbox_failed"]} failed, {telegram["boards"]} live board(s)'
+        )
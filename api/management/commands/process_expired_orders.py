@@ -1,63 +1,86 @@
+from django.conf import settings
 from django.core.management.base import BaseCommand
 from django.utils import timezone
-from api.models import Order
+from api import metrics, stock_ledger
+from api.expiry import ExpiryScheduler, expire_due_orders
 import time
 
 
 class Command(BaseCommand):
-    help = 'Process expired orders and restore stock'
+    help = 'Process expired orders and restore stock as soon as each reservation lapses, and compact the stock ledger'
 
     def add_arguments(self, parser):
         parser.add_argument(
             '--interval',
             type=int,
             default=300,  # 5 minutes
-            help='Check interval in seconds (default: 300)'
+            help='Full resync interval in seconds; deadlines are tracked between resyncs (default: 300)'
+        )
+        parser.add_argument(
+            '--poll',
+            type=float,
+            default=1.0,
+            help='How often to check for new or cancelled orders while sleeping, in seconds (default: 1)'
+        )
+        parser.add_argument(
+            '--compact-interval',
+            type=float,
+            default=settings.STOCK_COMPACT_INTERVAL,
+            help=f'How often to compact the stock ledger, in seconds; 0 disables (default: {settings.STOCK_COMPACT_INTERVAL:g})'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Expire due orders and compact the stock ledger once, then exit (for cron)'
         )
 
     def handle(self, *args, **options):
+        metrics.registry.publish_as('process_expired_orders')
+        if options['once']:
+            self.report(expire_due_orders(timezone.now()))
+            if options['compact_interval']:
+                self.report_compaction(stock_ledger.compact())
+            metrics.registry.flush()
+            return
+
         interval = options['interval']
-        self.stdout.write(self.style.SUCCESS(f'Starting order expiration checker (interval: {interval}s)'))
-        
+        self.stdout.write(self.style.SUCCESS(
+            f'Starting order expiration scheduler (resync: {interval}s, wake-up check: {options["poll"]}s)'
+        ))
+
+        scheduler = ExpiryScheduler(
+            resync_interval=interval,
+            poll_interval=options['poll'],
+            on_expired=self.report,
+            compact_interval=options['compact_interval'],
+            on_compacted=self.report_compaction
+        )
+
         while True:
             try:
-                self.check_expired_orders()
-                time.sleep(interval)
+                scheduler.run()
             except KeyboardInterrupt:
-                self.stdout.write(self.style.WARNING('Stopping order expiration checker'))
+                self.stdout.write(self.style.WARNING('Stopping order expiration scheduler'))
                 break
             except Exception as e:
                 self.stdout.write(self.style.ERROR(f'Error: {e}'))
-                time.sleep(interval)
-
-    def check_expired_orders(self):
-        """Find and cancel expired orders"""
-        now = timezone.now()
-        
-        # Find expired reserved orders
-        expired_orders = Order.objects.filter(
-            status='reserved',
-            expires_at__lt=now
-        )
-        
-        count = expired_orders.count()
-        
-        if count > 0:
-            self.stdout.write(f'Found {count} expired order(s)')
-            
-            for order in expired_orders:
-                # Cancel order and restore stock
-                if order.cancel():
-                    self.stdout.write(
-                        self.style.SUCCESS(
-                            f'Cancelled order {order.order_id} - Restored stock'
-                        )
-                    )
-                else:
-                    self.stdout.write(
-                        self.style.WARNING(
-                            f'Failed to cancel order {order.order_id}'
-                        )
-                    )
+                time.sleep(options['poll'])
+
+    def report(self, result):
+        """Log one sweep with its release lag"""
+        if result.orders > 0:
+            lag_avg = sum(result.lags) / len(result.lags)
+            self.stdout.write(self.style.SUCCESS(
+                f'Cancelled {result.orders} expired order(s) - Restored {result.units} unit(s) of stock '
+                f'(lag avg {lag_avg:.2f}s, max {max(result.lags):.2f}s)'
+            ))
         else:
+            now = timezone.now()
             self.stdout.write(self.style.SUCCESS(f'[{now.strftime("%Y-%m-%d %H:%M:%S")}] No expired orders'))
+
+    def report_compaction(self, result):
+        """Log a compaction that changed how a product's stock is kept"""
+        if result.striped or result.unstriped:
+            self.stdout.write(self.style.SUCCESS(
+                f'Compacted stock of {result.products} product(s): {result.striped} striped, {result.unstriped} folded back'
+            ))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from api.rollups import rebuild
+import time
+
+
+class Command(BaseCommand):
+    help = 'Recompute the sales rollups behind the admin dashboard from all current and archived orders'
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        rows = rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt {rows} rollup row(s) in {time.monotonic() - started:.2f}s'
+        ))
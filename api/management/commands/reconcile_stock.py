@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+from api import stock_ledger
+import time
+
+
+class Command(BaseCommand):
+    help = 'Check the stock ledger against its snapshots and the current stock of every product'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--product', type=int, action='append', help='Only this product id (repeatable)')
+        parser.add_argument(
+            '--compact',
+            action='store_true',
+            help='Compact first, so products created since the last compaction get a snapshot to check against'
+        )
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        if options['compact']:
+            stock_ledger.compact(options['product'])
+        result = stock_ledger.reconcile(options['product'])
+
+        for discrepancy in result.discrepancies:
+            where = (
+                f'snapshot at movement {discrepancy.movement_id}' if discrepancy.check == 'history'
+                else f'current stock (last movement {discrepancy.movement_id})'
+            )
+            self.stdout.write(self.style.ERROR(
+                f'Product {discrepancy.product_id}: {where} is {discrepancy.actual}, '
+                f'the ledger says {discrepancy.expected} ({discrepancy.actual - discrepancy.expected:+d})'
+            ))
+        if result.unchecked:
+            self.stdout.write(self.style.WARNING(
+                f'{result.unchecked} product(s) have no snapshot yet (run compact_stock or --compact)'
+            ))
+        if result.discrepancies:
+            raise CommandError(f'{len(result.discrepancies)} discrepancy(ies) in {result.checked} product(s)')
+        self.stdout.write(self.style.SUCCESS(
+            f'Ledger matches the stock of {result.checked} product(s) ({time.monotonic() - started:.2f}s)'
+        ))
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from api.images import render_missing_thumbnails
+
+
+class Command(BaseCommand):
+    help = 'Write the product thumbnails missing from media storage (e.g. after a redeploy) from the stored originals'
+
+    def handle(self, *args, **options):
+        images, thumbnails = render_missing_thumbnails()
+        self.stdout.write(self.style.SUCCESS(f'Rendered {thumbnails} thumbnail(s) for {images} image(s)'))
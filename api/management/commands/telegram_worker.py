@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from api import metrics
+from api.telegram_outbox import OutboxWorker
+from api.telegram_updates import process_pending_updates
+import time
+
+
+class Command(BaseCommand):
+    help = 'Handle incoming webhook updates and deliver queued Telegram notifications from the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--poll',
+            type=float,
+            default=1.0,
+            help='Seconds between outbox checks when idle (default: 1)'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Deliver what is ready and exit'
+        )
+
+    def handle(self, *args, **options):
+        worker = OutboxWorker()
+        metrics.registry.publish_as('telegram_worker')
+
+        if options['once']:
+            if not worker.acquire_lease():
+                self.stdout.write(self.style.WARNING('Another Telegram worker is draining the outbox; nothing done'))
+                return
+            try:
+                handled = process_pending_updates()
+                worker.drain_once()
+            finally:
+                worker.release_lease()
+            metrics.registry.flush()
+            self.stdout.write(self.style.SUCCESS(f'Handled {handled} update(s); sent {worker.sent}, failed {worker.failed}'))
+            return
+
+        self.stdout.write(self.style.SUCCESS(f'Starting Telegram outbox worker (poll: {options["poll"]}s)'))
+        while True:
+            try:
+                worker.run(poll_interval=options['poll'])
+            except KeyboardInterrupt:
+                self.stdout.write(self.style.WARNING('Stopping Telegram outbox worker'))
+                break
+            except Exception as e:
+                self.stdout.write(self.style.ERROR(f'Error: {e}'))
+                time.sleep(options['poll'])
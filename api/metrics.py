@@ -0,0 +1,330 @@
+"""
+Process-local metrics with a Prometheus text exporter
+
+Every process (each gunicorn worker, telegram_worker, the expiry scheduler)
+counts into its own in-memory registry and writes a snapshot of it to
+METRICS_DIR at most once per FLUSH_INTERVAL. Worker commands also publish
+their snapshot to the shared cache, so it is visible even when they run on
+another machine. /metrics merges every snapshot, summing counters and
+histogram buckets, so any worker can answer a scrape with totals for the
+whole deployment.
+
+Each process leaves a hostname-pid file behind when it exits. Once such a
+file is RETIRE_AFTER old and its process is gone (on this host: its pid is
+not running; from another host sharing METRICS_DIR: STALE_AFTER old), a
+scrape folds it into one retired.json, so the totals never go down and the
+directory does not grow with every restart.
+"""
+
+import atexit
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+FLUSH_INTERVAL = 1.0
+PUBLISHERS_KEY = 'metrics:publishers'
+PUBLISH_KEY = 'metrics:process:{}'
+
+RETIRED = 'retired'
+RETIRE_AFTER = 600
+# A live process only flushes when it does something, so one on another host
+# is only taken for gone after this long
+STALE_AFTER = 24 * 3600
+RETIRE_KEY = 'metrics:retire'
+RETIRE_INTERVAL = 300
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Metric:
+    def __init__(self, registry, name, help, kind, labelnames=(), buckets=None):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) if buckets else None
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            counts, total, count = self.values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            counts = [c + (1 if value <= bound else 0) for c, bound in zip(counts, self.buckets)]
+            self.values[key] = (counts, total + value, count + 1)
+
+    def snapshot(self):
+        return {
+            'help': self.help,
+            'kind': self.kind,
+            'labels': list(self.labelnames),
+            'buckets': list(self.buckets) if self.buckets else None,
+            'values': [[list(key), value] for key, value in self.values.items()],
+        }
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.process = f'{socket.gethostname()}-{os.getpid()}'
+        self.publish_name = None
+        self.last_flush = 0.0
+
+    def counter(self, name, help, labelnames=()):
+        return self.metrics.setdefault(name, Metric(self, name, help, 'counter', labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.metrics.setdefault(name, Metric(self, name, help, 'histogram', labelnames, buckets))
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'process': self.process,
+                'time': time.time(),
+                'metrics': {name: metric.snapshot() for name, metric in self.metrics.items()},
+            }
+
+    def flush(self):
+        """Write this process's snapshot to METRICS_DIR (and the cache, for published workers)"""
+        # A forked gunicorn worker inherits the parent's registry; give it its own file
+        if not self.process.endswith(f'-{os.getpid()}'):
+            self.process = f'{socket.gethostname()}-{os.getpid()}'
+        snapshot = self.snapshot()
+        self.last_flush = time.monotonic()
+
+        directory = metrics_dir()
+        os.makedirs(directory, exist_ok=True)
+        write_snapshot(directory, f'{self.process}.json', snapshot)
+
+        if self.publish_name:
+            cache.set(PUBLISH_KEY.format(self.publish_name), snapshot, None)
+
+    def maybe_flush(self):
+        if time.monotonic() - self.last_flush >= FLUSH_INTERVAL:
+            try:
+                self.flush()
+            except (OSError, ValueError):
+                pass
+
+    def publish_as(self, name):
+        """Also share this process's metrics through the cache under ``name`` (for worker commands)"""
+        self.publish_name = name
+        publishers = set(cache.get(PUBLISHERS_KEY) or ())
+        if name not in publishers:
+            cache.set(PUBLISHERS_KEY, sorted(publishers | {name}), None)
+
+
+def metrics_dir():
+    return getattr(settings, 'METRICS_DIR', None) or os.path.join(tempfile.gettempdir(), 'gograbit-metrics')
+
+
+registry = Registry()
+atexit.register(registry.maybe_flush)
+
+
+# HTTP
+REQUEST_SECONDS = registry.histogram(
+    'http_request_duration_seconds', 'Request latency by route', ('route', 'method', 'status'))
+REQUEST_QUERIES = registry.histogram(
+    'http_request_db_queries', 'Database queries per request', ('route',), QUERY_BUCKETS)
+REQUEST_DB_SECONDS = registry.histogram(
+    'http_request_db_seconds', 'Time spent in database queries per request', ('route',))
+REQUEST_RENDER_SECONDS = registry.histogram(
+    'http_request_render_seconds', 'Time spent rendering (serializing) the response body', ('route',))
+RESPONSE_BYTES = registry.histogram(
+    'http_response_size_bytes', 'Response body size', ('route',), SIZE_BUCKETS)
+REQUESTS_THROTTLED = registry.counter(
+    'http_requests_throttled_total', 'Requests refused with 429 by a rate limit', ('scope', 'key'))
+REQUESTS_SHED = registry.counter(
+    'http_requests_shed_total', 'Requests refused with 503 while the worker was overloaded')
+IDEMPOTENT_REPLAYS = registry.counter(
+    'http_idempotent_replays_total', 'Stored responses returned for a repeated Idempotency-Key', ('scope',))
+
+# Telegram
+TELEGRAM_CALLS = registry.counter(
+    'telegram_api_calls_total', 'Bot API calls by method and outcome', ('method', 'outcome'))
+TELEGRAM_SECONDS = registry.histogram(
+    'telegram_api_call_duration_seconds', 'Bot API call latency', ('method',))
+TELEGRAM_BOARD_FOLDED = registry.counter(
+    'telegram_board_notifications_total', 'Order notifications delivered as part of a live board edit')
+
+# Orders and stock
+ORDERS_EXPIRED = registry.counter('orders_expired_total', 'Reservations cancelled because they lapsed')
+STOCK_RESTORED = registry.counter('stock_restored_units_total', 'Units returned to stock', ('reason',))
+EXPIRY_LAG = registry.histogram('expiry_lag_seconds', 'Delay between a reservation deadline and its release')
+STOCK_CONFLICTS = registry.counter('stock_conflicts_total', 'Order reservations rejected for insufficient stock')
+STOCK_STRIPE_WAITS = registry.counter(
+    'stock_stripe_waits_total', 'Striped reservations that found no free stripe and locked them all')
+ORDER_ID_COLLISIONS = registry.counter(
+    'order_id_collisions_total', 'New order IDs already taken after the counter wrapped, by what was done',
+    ('outcome',))
+
+
+def read_snapshots(directory):
+    """{filename: snapshot} for the snapshot files in ``directory``"""
+    snapshots = {}
+    if os.path.isdir(directory):
+        for filename in os.listdir(directory):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(directory, filename)) as f:
+                    snapshots[filename] = json.load(f)
+            except (OSError, ValueError):
+                continue
+    return snapshots
+
+
+def process_gone(process, now):
+    """Whether the process behind a snapshot has exited (see the module docstring)"""
+    host, _, pid = process['process'].rpartition('-')
+    age = now - process['time']
+    if age < RETIRE_AFTER:
+        return False
+    if host != socket.gethostname() or not pid.isdigit():
+        return age >= STALE_AFTER
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        pass  # Running, as another user
+    return False
+
+
+def write_snapshot(directory, filename, snapshot):
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp, os.path.join(directory, filename))
+
+
+def retire_snapshots(directory, files, now=None):
+    """
+    Fold the snapshots of processes that are gone into retired.json and
+    delete their files; returns the processes folded. ``files`` is
+    read_snapshots(directory), and is updated to match.
+    """
+    now = now or time.time()
+    retired = files.get(f'{RETIRED}.json') or {'process': RETIRED, 'metrics': {}, 'processes': []}
+    done = set(retired['processes'])
+    gone = {
+        filename: snapshot for filename, snapshot in files.items()
+        if snapshot['process'] != RETIRED and snapshot['process'] != registry.process and process_gone(snapshot, now)
+    }
+    folded = [snapshot for snapshot in gone.values() if snapshot['process'] not in done]
+    if folded:
+        merged = merge([retired, *folded])
+        retired = {
+            'process': RETIRED,
+            'time': now,
+            'metrics': {
+                name: {**metric, 'values': [[list(key), value] for key, value in metric['values'].items()]}
+                for name, metric in merged.items()
+            },
+            'processes': sorted(done | {snapshot['process'] for snapshot in folded}),
+        }
+        write_snapshot(directory, f'{RETIRED}.json', retired)
+        files[f'{RETIRED}.json'] = retired
+    # Only once they are counted in retired.json
+    for filename in gone:
+        try:
+            os.remove(os.path.join(directory, filename))
+        except OSError:
+            pass
+        del files[filename]
+    return [snapshot['process'] for snapshot in folded]
+
+
+def load_snapshots():
+    """Every process's latest snapshot, keyed by process (own live state wins)"""
+    directory = metrics_dir()
+    files = read_snapshots(directory)
+    if files and cache.add(RETIRE_KEY, True, RETIRE_INTERVAL):
+        try:
+            retire_snapshots(directory, files)
+        except OSError:
+            pass
+
+    snapshots = {snapshot['process']: snapshot for snapshot in files.values()}
+    retired = set(snapshots.get(RETIRED, {}).get('processes', ()))
+    for name in cache.get(PUBLISHERS_KEY) or ():
+        snapshot = cache.get(PUBLISH_KEY.format(name))
+        # A stopped worker's last snapshot stays in the cache after its file is retired
+        if snapshot and snapshot['process'] not in retired:
+            snapshots.setdefault(snapshot['process'], snapshot)
+
+    snapshots[registry.process] = registry.snapshot()
+    return list(snapshots.values())
+
+
+def merge(snapshots):
+    """Sum counters and histograms across snapshots"""
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot['metrics'].items():
+            target = merged.setdefault(name, {**metric, 'values': {}})
+            for labels, value in metric['values']:
+                key = tuple(labels)
+                if metric['kind'] == 'counter':
+                    target['values'][key] = target['values'].get(key, 0) + value
+                else:
+                    counts, total, count = target['values'].get(key) or ([0] * len(metric['buckets']), 0.0, 0)
+                    target['values'][key] = (
+                        [a + b for a, b in zip(counts, value[0])], total + value[1], count + value[2]
+                    )
+    return merged
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in (*zip(names, values), *extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(merged, gauges=()):
+    """Prometheus text exposition format (0.0.4); gauges are (name, help, value) triples"""
+    lines = []
+    for name, metric in sorted(merged.items()):
+        lines.append(f'# HELP {name} {metric["help"]}')
+        lines.append(f'# TYPE {name} {metric["kind"]}')
+        for key, value in sorted(metric['values'].items()):
+            if metric['kind'] == 'counter':
+                lines.append(f'{name}{_labels(metric["labels"], key)} {_number(value)}')
+                continue
+            counts, total, count = value
+            for bound, bucket_count in zip(metric['buckets'], counts):
+                lines.append(f'{name}_bucket{_labels(metric["labels"], key, [("le", _number(bound))])} {bucket_count}')
+            lines.append(f'{name}_bucket{_labels(metric["labels"], key, [("le", "+Inf")])} {count}')
+            lines.append(f'{name}_sum{_labels(metric["labels"], key)} {_number(float(total))}')
+            lines.append(f'{name}_count{_labels(metric["labels"], key)} {count}')
+    for name, help, value in gauges:
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} gauge')
+        lines.append(f'{name} {_number(value)}')
+    return '\n'.join(lines) + '\n'
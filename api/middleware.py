@@ -0,0 +1,248 @@
+import math
+import os
+import random
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+from whitenoise.middleware import WhiteNoiseMiddleware
+from whitenoise.string_utils import ensure_leading_trailing_slash
+
+from . import metrics
+from .images import IMAGE_DIR
+
+
+# Per-request timings filled in by time_query and TimedJSONRenderer. A
+# ContextVar follows the request into sync_to_async threads, so queries made
+# by async views are counted too.
+request_timings = ContextVar('request_timings', default=None)
+
+# Load shedding: the latency average covers about SHED_WINDOW seconds; at
+# twice the target MAX_SHED of the requests are refused
+SHED_WINDOW = 5.0
+MAX_SHED = 0.9
+SHED_RETRY_AFTER = 5
+
+
+def time_query(execute, sql, params, many, context):
+    """Execute wrapper installed on every DB connection (see install_query_timer)"""
+    timings = request_timings.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings['queries'] += 1
+        timings['db'] += time.perf_counter() - started
+
+
+def install_query_timer(sender, connection, **kwargs):
+    """connection_created handler"""
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_query)
+
+
+def _route(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    return match.route or match.view_name or 'unmatched'
+
+
+class MetricsMiddleware:
+    """Record latency, DB queries and time, render time and response size per route"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        timings = {'queries': 0, 'db': 0.0, 'render': 0.0}
+        token = request_timings.set(timings)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            request_timings.reset(token)
+
+        self.record(request, response, time.perf_counter() - started, timings)
+        return response
+
+    async def __acall__(self, request):
+        timings = {'queries': 0, 'db': 0.0, 'render': 0.0}
+        token = request_timings.set(timings)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            request_timings.reset(token)
+
+        self.record(request, response, time.perf_counter() - started, timings)
+        return response
+
+    def record(self, request, response, elapsed, timings):
+        route = _route(request)
+        metrics.REQUEST_SECONDS.observe(elapsed, route=route, method=request.method, status=response.status_code)
+        metrics.REQUEST_QUERIES.observe(timings['queries'], route=route)
+        metrics.REQUEST_DB_SECONDS.observe(timings['db'], route=route)
+        if timings['render']:
+            metrics.REQUEST_RENDER_SECONDS.observe(timings['render'], route=route)
+        if not response.streaming:
+            metrics.RESPONSE_BYTES.observe(len(response.content), route=route)
+        metrics.registry.maybe_flush()
+
+
+class LoadShedder:
+    """
+    This worker's recent latency, as an average that weighs each request by
+    the time since the previous one, so it covers about SHED_WINDOW seconds
+    of traffic and decays while the worker is idle.
+    """
+
+    def __init__(self, window=SHED_WINDOW):
+        self.window = window
+        self.average = 0.0
+        self.updated = time.monotonic()
+
+    def observe(self, seconds):
+        now = time.monotonic()
+        weight = 1.0 - math.exp((self.updated - now) / self.window)
+        self.average += (seconds - self.average) * weight
+        self.updated = now
+
+    def current(self):
+        return self.average * math.exp((self.updated - time.monotonic()) / self.window)
+
+    def shed_share(self, target):
+        """Share of requests to refuse: none up to ``target`` seconds, MAX_SHED from twice that"""
+        average = self.current()
+        if average <= target:
+            return 0.0
+        return min(MAX_SHED, (average - target) / target * MAX_SHED)
+
+
+shedder = LoadShedder()
+
+
+class LoadShedMiddleware:
+    """
+    Refuse a share of requests with 503 while this worker's recent latency is
+    above settings.LOAD_SHED_LATENCY (see LoadShedder), so an
+    overloaded worker catches up instead of queueing ever more work. Paths in
+    LOAD_SHED_EXEMPT (admin, webhook, metrics) are always served.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        if not self.applies(request):
+            return self.get_response(request)
+        if self.overloaded():
+            return self.refuse()
+        started = time.perf_counter()
+        response = self.get_response(request)
+        self.observe(response, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        if not self.applies(request):
+            return await self.get_response(request)
+        if self.overloaded():
+            return self.refuse()
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        self.observe(response, time.perf_counter() - started)
+        return response
+
+    def applies(self, request):
+        return bool(settings.LOAD_SHED_LATENCY) and not request.path.startswith(settings.LOAD_SHED_EXEMPT)
+
+    def overloaded(self):
+        share = shedder.shed_share(settings.LOAD_SHED_LATENCY)
+        return share > 0 and random.random() < share
+
+    def refuse(self):
+        metrics.REQUESTS_SHED.inc()
+        response = JsonResponse({'error': 'Server busy, please try again in a few seconds'}, status=503)
+        response['Retry-After'] = str(SHED_RETRY_AFTER)
+        return response
+
+    def observe(self, response, elapsed):
+        # Streams (event feeds, exports) stay open by design
+        if not response.streaming:
+            shedder.observe(elapsed)
+
+
+class StaticFilesMiddleware(WhiteNoiseMiddleware):
+    """
+    WhiteNoise that also runs natively under ASGI. The stock middleware is
+    sync-only, which would make Django run every request, async views
+    included, through a worker thread.
+
+    It serves MEDIA_ROOT too, for the product thumbnails (api/images.py).
+    Those are written while the app runs, so a media URL missing from the
+    startup index is looked up on disk; the content-addressed images/ files
+    are immutable.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, *args, **kwargs):
+        super().__init__(get_response, *args, **kwargs)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+        self.media_prefix = ensure_leading_trailing_slash(settings.MEDIA_URL)
+        media_root = os.path.join(os.path.abspath(settings.MEDIA_ROOT), '')
+        if os.path.isdir(media_root):
+            self.add_files(media_root, prefix=self.media_prefix)
+        if (media_root, self.media_prefix) not in self.directories:
+            self.directories.append((media_root, self.media_prefix))
+
+    def lookup(self, path):
+        if self.autorefresh:
+            return self.find_file(path)
+        static_file = self.files.get(path)
+        if static_file is None and path.startswith(self.media_prefix):
+            static_file = self.find_file(path)
+            if static_file is not None:
+                self.files[path] = static_file
+        return static_file
+
+    def immutable_file_test(self, path, url):
+        if url.startswith(f'{self.media_prefix}{IMAGE_DIR}/'):
+            return True
+        return super().immutable_file_test(path, url)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        static_file = self.lookup(request.path_info)
+        if static_file is not None:
+            return self.serve(static_file, request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        static_file = self.files.get(request.path_info)
+        if static_file is None and (self.autorefresh or request.path_info.startswith(self.media_prefix)):
+            # Looks on disk
+            static_file = await sync_to_async(self.lookup)(request.path_info)
+        if static_file is not None:
+            return self.serve(static_file, request)
+        return await self.get_response(request)
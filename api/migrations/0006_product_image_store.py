@@ -0,0 +1,73 @@
+# Generated by Django 5.1.4 on 2026-10-18 00:17
+
+import base64
+import binascii
+import hashlib
+
+from django.db import migrations, models
+
+
+def decode_data_url(data_url):
+    """(content_type, bytes) of a ``data:<type>;base64,...`` URL, or None if malformed"""
+    try:
+        header, encoded = data_url.split(',', 1)
+        content_type = header[len('data:'):].split(';')[0] or 'image/jpeg'
+        return content_type, base64.b64decode(encoded)
+    except (ValueError, binascii.Error):
+        return None
+
+
+def move_base64_images(apps, schema_editor):
+    """Move inline base64 images into ProductImage (render_thumbnails writes their thumbnails)"""
+    Product = apps.get_model('api', 'Product')
+    ProductImage = apps.get_model('api', 'ProductImage')
+
+    products = Product.objects.filter(image__startswith='data:').only('id', 'image')
+    for product in products.iterator(chunk_size=50):
+        decoded = decode_data_url(product.image)
+        if decoded is None:
+            continue
+        content_type, data = decoded
+        digest = hashlib.sha256(data).hexdigest()
+        ProductImage.objects.get_or_create(
+            digest=digest,
+            defaults={'content_type': content_type, 'data': data}
+        )
+        Product.objects.filter(pk=product.pk).update(image=None, image_digest=digest)
+
+
+def restore_base64_images(apps, schema_editor):
+    Product = apps.get_model('api', 'Product')
+    ProductImage = apps.get_model('api', 'ProductImage')
+
+    for product in Product.objects.exclude(image_digest=None).only('id', 'image_digest'):
+        image = ProductImage.objects.filter(digest=product.image_digest).first()
+        if image is None:
+            continue
+        encoded = base64.b64encode(bytes(image.data)).decode('utf-8')
+        Product.objects.filter(pk=product.pk).update(image=f"data:{image.content_type};base64,{encoded}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_create_cache_table'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductImage',
+            fields=[
+                ('digest', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('content_type', models.CharField(max_length=50)),
+                ('data', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='image_digest',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.RunPython(move_base64_images, restore_base64_images),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.4 on 2026-10-18 00:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_telegram_outbox'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['-created_at', '-order_id'], name='order_created_keyset_idx'),
+        ),
+    ]
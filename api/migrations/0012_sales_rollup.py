@@ -0,0 +1,38 @@
+# Generated by Django 5.1.4 on 2026-10-18 00:26
+
+from django.db import migrations, models
+
+from api.rollups import rebuild
+
+
+def backfill_rollups(apps, schema_editor):
+    rebuild(apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_order_lifecycle_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SalesRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day'), ('all', 'All time')], max_length=10)),
+                ('bucket_start', models.DateTimeField()),
+                ('category', models.CharField(blank=True, default='', max_length=100)),
+                ('orders', models.IntegerField(default=0)),
+                ('completed', models.IntegerField(default=0)),
+                ('cancellations', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('units', models.IntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['granularity', '-bucket_start', 'category'],
+                'constraints': [models.UniqueConstraint(fields=('granularity', 'bucket_start', 'category'), name='sales_rollup_bucket_unique')],
+            },
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
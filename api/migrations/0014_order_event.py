@@ -0,0 +1,27 @@
+# Generated by Django 5.1.4 on 2026-10-18 00:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_telegram_update'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderEvent',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('order_id', models.CharField(max_length=4)),
+                ('kind', models.CharField(choices=[('created', 'Created'), ('picked', 'Picked'), ('completed', 'Completed'), ('cancelled', 'Cancelled'), ('expired', 'Expired')], max_length=20)),
+                ('data', models.JSONField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['order_id', 'id'], name='order_event_order_idx'), models.Index(fields=['created_at'], name='order_event_created_idx')],
+            },
+        ),
+    ]
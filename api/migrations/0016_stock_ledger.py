@@ -0,0 +1,61 @@
+# Generated by Django 5.1.4 on 2026-10-18 01:09
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_product_delta_sync'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='stock_stripes',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='StockMovement',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('product_id', models.IntegerField()),
+                ('kind', models.CharField(choices=[('reserve', 'Reserve'), ('release', 'Release'), ('restock', 'Restock'), ('adjust', 'Adjust')], max_length=20)),
+                ('quantity', models.IntegerField()),
+                ('order_id', models.CharField(blank=True, default='', max_length=4)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['product_id', 'id'], name='stock_movement_product_idx'), models.Index(fields=['created_at'], name='stock_movement_created_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='StockSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('product_id', models.IntegerField()),
+                ('stock', models.IntegerField()),
+                ('movement_id', models.BigIntegerField()),
+                ('taken_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['product_id', 'id'], name='stock_snapshot_product_idx'), models.Index(fields=['taken_at'], name='stock_snapshot_taken_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='StockStripe',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stripe', models.PositiveSmallIntegerField()),
+                ('quantity', models.IntegerField(default=0)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.product')),
+            ],
+            options={
+                'ordering': ['product', 'stripe'],
+                'constraints': [models.UniqueConstraint(fields=('product', 'stripe'), name='stock_stripe_unique'), models.CheckConstraint(condition=models.Q(('quantity__gte', 0)), name='stock_stripe_non_negative')],
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.4 on 2026-10-18 01:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0016_stock_ledger'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['active', 'stock'], name='product_low_stock_idx'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.1.4 on 2026-10-18 01:18
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0017_product_low_stock_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TelegramBoard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chat_id', models.CharField(max_length=50)),
+                ('message_id', models.BigIntegerField(blank=True, null=True)),
+                ('text', models.TextField(blank=True, default='')),
+                ('open', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='telegramoutbox',
+            index=models.Index(fields=['chat_id', 'kind', 'created_at'], name='outbox_chat_kind_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='telegramboard',
+            index=models.Index(fields=['chat_id', 'open'], name='telegram_board_chat_idx'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='telegram_board',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='orders', to='api.telegramboard'),
+        ),
+    ]
@@ -1,9 +1,5 @@
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
-import random
-import string
-import base64
-from django.core.files.base import ContentFile
 
 
 class Product(models.Model):
@@ -13,24 +9,167 @@ class Product(models.Model):
     category = models.CharField(max_length=100)
     price = models.DecimalField(max_digits=10, decimal_places=2)
     stock = models.IntegerField(default=0)
-    image = models.TextField(blank=True, null=True)  # Store base64 encoded image
+    # 0: stock is kept on this row. N: it is split over N StockStripe rows and
+    # ``stock`` is their total as of the last compaction (see stock.py)
+    stock_stripes = models.PositiveSmallIntegerField(default=0)
+    image = models.TextField(blank=True, null=True)  # External image URL (uploads go to image_digest)
+    image_digest = models.CharField(max_length=64, blank=True, null=True)  # ProductImage key
     active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
     @property
     def image_url(self):
-        """Return base64 data URL for direct use in frontend"""
+        """Return the default thumbnail URL (or external image URL) for the frontend"""
+        if self.image_digest:
+            from .images import thumbnail_url
+            return thumbnail_url(self.image_digest)
         if self.image:
             return self.image
         return None
 
     class Meta:
         ordering = ['name']
+        constraints = [
+            models.CheckConstraint(condition=models.Q(stock__gte=0), name='product_stock_non_negative'),
+        ]
+        indexes = [
+            # Delta catalog sync (GET /api/products?since=)
+            models.Index(fields=['updated_at'], name='product_updated_idx'),
+            # Low-stock listing and count (see low_stock.py)
+            models.Index(fields=['active', 'stock'], name='product_low_stock_idx'),
+        ]
 
     def __str__(self):
         return f"{self.name} - ₹{self.price}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_stock = instance.__dict__.get('stock')
+        return instance
+
+    def save(self, *args, **kwargs):
+        # Never keep inline base64 images on the row; move them to the image store
+        if self.image and self.image.startswith('data:'):
+            from .images import store_data_url
+            self.image_digest = store_data_url(self.image)
+            self.image = None
+        
+        from .stock import record_restock, set_stock
+        if self._state.adding:
+            with transaction.atomic():
+                super().save(*args, **kwargs)
+                record_restock(self)
+            self._loaded_stock = self.stock
+            return
+
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None:
+            deferred = self.get_deferred_fields()
+            update_fields = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.attname not in deferred
+            ]
+        # Orders and compaction may have moved stock since this instance was
+        # loaded: stock_stripes is left to compaction, and stock is written
+        # only when it was edited, through set_stock so the ledger has it
+        kwargs['update_fields'] = [name for name in update_fields if name not in ('stock', 'stock_stripes')]
+        if 'stock' not in update_fields:
+            super().save(*args, **kwargs)
+            return
+
+        with transaction.atomic():
+            if self.stock != getattr(self, '_loaded_stock', None):
+                set_stock({self.pk: self.stock})
+                self._loaded_stock = self.stock
+            super().save(*args, **kwargs)
+
+
+class ProductTombstone(models.Model):
+    """A deleted product, so delta catalog syncs can tell clients to drop it"""
+    product_id = models.IntegerField(primary_key=True)
+    deleted_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"Product {self.product_id} deleted {self.deleted_at}"
+
+
+class StockStripe(models.Model):
+    """One share of a striped product's stock (see stock.py)"""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    stripe = models.PositiveSmallIntegerField()
+    quantity = models.IntegerField(default=0)
+
+    class Meta:
+        ordering = ['product', 'stripe']
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'stripe'], name='stock_stripe_unique'),
+            models.CheckConstraint(condition=models.Q(quantity__gte=0), name='stock_stripe_non_negative'),
+        ]
+
+    def __str__(self):
+        return f"Product {self.product_id} stripe {self.stripe}: {self.quantity}"
+
+
+class StockMovement(models.Model):
+    """Append-only record of one change to a product's stock (see stock.py)"""
+    KIND_CHOICES = [
+        ('reserve', 'Reserve'),
+        ('release', 'Release'),
+        ('restock', 'Restock'),
+        ('adjust', 'Adjust'),
+    ]
+
+    id = models.BigAutoField(primary_key=True)
+    # Not a foreign key: the ledger outlives deleted products
+    product_id = models.IntegerField()
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    quantity = models.IntegerField()  # Signed: negative takes stock away
+    order_id = models.CharField(max_length=4, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            # Summing a product's movements after a snapshot
+            models.Index(fields=['product_id', 'id'], name='stock_movement_product_idx'),
+            # Hot product detection and pruning
+            models.Index(fields=['created_at'], name='stock_movement_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"Product {self.product_id} {self.kind} {self.quantity:+d}"
+
+
+class StockSnapshot(models.Model):
+    """A product's stock at compaction time and the last movement it includes (see stock_ledger.py)"""
+    product_id = models.IntegerField()
+    stock = models.IntegerField()
+    movement_id = models.BigIntegerField()
+    taken_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['product_id', 'id'], name='stock_snapshot_product_idx'),
+            models.Index(fields=['taken_at'], name='stock_snapshot_taken_idx'),
+        ]
+
+    def __str__(self):
+        return f"Product {self.product_id}: {self.stock} at movement {self.movement_id}"
+
+
+class ProductImage(models.Model):
+    """Original product image bytes, stored once by SHA-256 digest"""
+    digest = models.CharField(max_length=64, primary_key=True)
+    content_type = models.CharField(max_length=50)
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.digest
+
 
 class Order(models.Model):
     """Order model with status tracking"""
@@ -60,53 +199,75 @@ class Order(models.Model):
     cancelled_at = models.DateTimeField(blank=True, null=True)
     
     telegram_message_id = models.IntegerField(blank=True, null=True)
+    # Set when the order was announced on a live board rather than in its own message
+    telegram_board = models.ForeignKey(
+        'TelegramBoard', blank=True, null=True, on_delete=models.SET_NULL, related_name='orders'
+    )
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Keyset pagination order for order listings; also serves created_at ranges (stats)
+            models.Index(fields=['-created_at', '-order_id'], name='order_created_keyset_idx'),
+            # Duplicate active-order check in order_list
+            models.Index(fields=['phone_number', 'status'], name='order_phone_status_idx'),
+            # Expiry sweep and scheduler; only reserved orders can expire
+            models.Index(fields=['expires_at'], condition=models.Q(status='reserved'), name='order_reserved_expiry_idx'),
+            # Status counts
+            models.Index(fields=['status'], name='order_status_idx'),
+        ]
 
     def __str__(self):
         return f"Order {self.order_id} - {self.customer_name}"
 
     def save(self, *args, **kwargs):
-        if not self.order_id:
-            # Generate simple order ID: 2 uppercase letters + 2 digits (e.g., AB12)
-            while True:
-                letters = ''.join(random.choices(string.ascii_uppercase, k=2))
-                digits = ''.join(random.choices(string.digits, k=2))
-                order_id = f"{letters}{digits}"
-                
-                # Check if this ID already exists
-                if not Order.objects.filter(order_id=order_id).exists():
-                    self.order_id = order_id
-                    break
-        
         if not self.expires_at:
             # Set expiration to 15 minutes from now
             self.expires_at = timezone.now() + timezone.timedelta(minutes=15)
         
+        if not self.order_id:
+            # Simple order ID: 2 uppercase letters + 2 digits (e.g., AB12), taken from
+            # a keyed permutation of a shared counter so the table is never probed
+            from .order_ids import insert_with_new_id
+            kwargs['force_insert'] = True
+            insert_with_new_id(self, lambda: super(Order, self).save(*args, **kwargs))
+            return
+        
         super().save(*args, **kwargs)
 
     def is_expired(self):
         """Check if order has expired"""
         return timezone.now() > self.expires_at and self.status == 'reserved'
 
+    def _transition(self, from_statuses, to_status, timestamp_field):
+        """Move to a new status only if the row is still in one of from_statuses"""
+        now = timezone.now()
+        updated = Order.objects.filter(pk=self.pk, status__in=from_statuses).update(
+            status=to_status, **{timestamp_field: now}
+        )
+        if not updated:
+            return False
+        
+        self.status = to_status
+        setattr(self, timestamp_field, now)
+        return True
+
     def cancel(self):
         """Cancel order and restore stock"""
         if self.status in ['cancelled', 'completed']:
             return False
         
-        # Restore stock for all items
-        for item in self.items:
-            try:
-                product = Product.objects.get(id=item['productId'])
-                product.stock += item['qty']
-                product.save()
-            except Product.DoesNotExist:
-                pass
-        
-        self.status = 'cancelled'
-        self.cancelled_at = timezone.now()
-        self.save()
+        from .stock import record_movements, release
+        from .expiry import notify_deadlines_changed
+        from . import metrics, order_events, rollups
+        with transaction.atomic():
+            if not self._transition(['reserved', 'picked'], 'cancelled', 'cancelled_at'):
+                return False
+            metrics.STOCK_RESTORED.inc(release(self.items), reason='cancelled')
+            record_movements('release', [self])
+            rollups.record('cancelled', [self])
+            order_events.record('cancelled', [self])
+            transaction.on_commit(notify_deadlines_changed)
         return True
 
     def mark_picked(self):
@@ -114,9 +275,11 @@ class Order(models.Model):
         if self.status != 'reserved':
             return False
         
-        self.status = 'picked'
-        self.picked_at = timezone.now()
-        self.save()
+        from . import order_events
+        with transaction.atomic():
+            if not self._transition(['reserved'], 'picked', 'picked_at'):
+                return False
+            order_events.record('picked', [self])
         return True
 
     def mark_completed(self):
@@ -124,12 +287,196 @@ class Order(models.Model):
         if self.status not in ['reserved', 'picked']:
             return False
         
-        self.status = 'completed'
-        self.completed_at = timezone.now()
-        self.save()
+        from . import order_events, rollups
+        with transaction.atomic():
+            if not self._transition(['reserved', 'picked'], 'completed', 'completed_at'):
+                return False
+            rollups.record('completed', [self])
+            order_events.record('completed', [self])
         return True
 
 
+class ArchivedOrder(models.Model):
+    """Finished order moved out of Order so its short ID can be reused"""
+    order_id = models.CharField(max_length=4, db_index=True)
+    customer_name = models.CharField(max_length=255)
+    phone_number = models.CharField(max_length=15)
+    room_number = models.CharField(max_length=50)
+    notes = models.TextField(blank=True, null=True)
+    items = models.JSONField()
+    total_amount = models.DecimalField(max_digits=10, decimal_places=2)
+    status = models.CharField(max_length=20, choices=Order.STATUS_CHOICES)
+    created_at = models.DateTimeField()
+    expires_at = models.DateTimeField()
+    picked_at = models.DateTimeField(blank=True, null=True)
+    completed_at = models.DateTimeField(blank=True, null=True)
+    cancelled_at = models.DateTimeField(blank=True, null=True)
+    telegram_message_id = models.IntegerField(blank=True, null=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"Archived order {self.order_id} - {self.customer_name}"
+
+
+class Sequence(models.Model):
+    """Named counter shared by all workers (e.g. the order ID allocator)"""
+    name = models.CharField(max_length=50, primary_key=True)
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name}: {self.value}"
+
+
+class TelegramOutbox(models.Model):
+    """Outgoing Telegram API call, written in the same transaction as the change it reports"""
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    ]
+
+    kind = models.CharField(max_length=30)
+    method = models.CharField(max_length=50)
+    chat_id = models.CharField(max_length=50)
+    payload = models.JSONField()
+    order = models.ForeignKey(Order, blank=True, null=True, on_delete=models.SET_NULL, related_name='telegram_messages')
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, null=True)
+    message_id = models.BigIntegerField(blank=True, null=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['status', 'id'], name='outbox_status_idx'),
+            # A chat's recent new-order rate (see telegram_board.py)
+            models.Index(fields=['chat_id', 'kind', 'created_at'], name='outbox_chat_kind_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} to {self.chat_id} ({self.status})"
+
+
+class TelegramBoard(models.Model):
+    """One message listing a rush's orders with a pick button each, edited in place (see telegram_board.py)"""
+    chat_id = models.CharField(max_length=50)
+    message_id = models.BigIntegerField(blank=True, null=True)
+    # Last text sent, so an edit that changes nothing is skipped
+    text = models.TextField(blank=True, default='')
+    # Open boards take new orders; closed ones are only kept up to date
+    open = models.BooleanField(default=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['chat_id', 'open'], name='telegram_board_chat_idx'),
+        ]
+
+    def __str__(self):
+        return f"Board {self.pk} in {self.chat_id} ({'open' if self.open else 'closed'})"
+
+
+class TelegramUpdate(models.Model):
+    """Incoming webhook update, recorded once per update_id and processed by the worker"""
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+
+    update_id = models.BigIntegerField(primary_key=True)
+    chat_id = models.CharField(max_length=50, blank=True, default='')
+    payload = models.JSONField()
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    error = models.TextField(blank=True, null=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['update_id']
+        indexes = [
+            models.Index(fields=['status', 'update_id'], name='update_status_idx'),
+        ]
+
+    def __str__(self):
+        return f"Update {self.update_id} ({self.status})"
+
+
+class OrderEvent(models.Model):
+    """Order state change, pushed to the order's customer and the admin feed (see order_events.py)"""
+    KIND_CHOICES = [
+        ('created', 'Created'),
+        ('picked', 'Picked'),
+        ('completed', 'Completed'),
+        ('cancelled', 'Cancelled'),
+        ('expired', 'Expired'),
+    ]
+
+    # Also the SSE event id, so clients can resume with Last-Event-ID
+    id = models.BigAutoField(primary_key=True)
+    # Not a foreign key: events outlive the order when it is archived
+    order_id = models.CharField(max_length=4)
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    data = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            # Resuming one order's stream
+            models.Index(fields=['order_id', 'id'], name='order_event_order_idx'),
+            # Late commits picked up by the stream poller, and pruning
+            models.Index(fields=['created_at'], name='order_event_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"Order {self.order_id} {self.kind}"
+
+
+class SalesRollup(models.Model):
+    """
+    Sales counters per hour, day and all time, kept up to date on order
+    state transitions. Rows with an empty category hold order-level totals;
+    the others count the same things for the items of one category.
+    """
+    GRANULARITY_CHOICES = [
+        ('hour', 'Hour'),
+        ('day', 'Day'),
+        ('all', 'All time'),
+    ]
+
+    granularity = models.CharField(max_length=10, choices=GRANULARITY_CHOICES)
+    bucket_start = models.DateTimeField()
+    category = models.CharField(max_length=100, blank=True, default='')
+
+    orders = models.IntegerField(default=0)
+    completed = models.IntegerField(default=0)
+    cancellations = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    units = models.IntegerField(default=0)
+
+    class Meta:
+        ordering = ['granularity', '-bucket_start', 'category']
+        constraints = [
+            models.UniqueConstraint(fields=['granularity', 'bucket_start', 'category'], name='sales_rollup_bucket_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.granularity} {self.bucket_start:%Y-%m-%d %H:%M} {self.category or 'all categories'}"
+
+
 class AdminSettings(models.Model):
     """Store admin settings"""
     key = models.CharField(max_length=100, unique=True, primary_key=True)
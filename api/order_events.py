@@ -0,0 +1,258 @@
+"""
+Live order updates over Server-Sent Events
+
+Every state transition on Order writes an OrderEvent row in the same
+transaction, so an event exists exactly when the change commits. Streams
+never query per client: one EventHub per process (per event loop) polls the
+table every POLL_INTERVAL while anyone is listening and fans new events out
+to all open streams. A client that reconnects with Last-Event-ID first gets
+the events it missed from the table.
+
+Auto-increment ids can commit out of order, so the hub also re-reads the
+last GRACE seconds of events and skips the ones it has already seen.
+
+Streams need the ASGI server (see README_PRODUCTION.md). Under WSGI they
+answer 204, which tells EventSource to stop reconnecting, and the page keeps
+working without live updates.
+"""
+
+import asyncio
+import contextvars
+import logging
+import weakref
+from collections import deque
+from datetime import timedelta
+
+import orjson
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIRequest
+from django.db import close_old_connections, transaction
+from django.db.models import Max, Q
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+from .models import OrderEvent
+
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 1.0
+GRACE = timedelta(seconds=5)
+HEARTBEAT = 15.0
+# Streams end after this long and EventSource reconnects with Last-Event-ID,
+# so no connection is held forever through proxies that cut long requests
+MAX_STREAM_SECONDS = 300
+RETRY_MS = 3000
+BUFFER_SIZE = 1000
+BACKLOG_LIMIT = 500
+
+RETENTION = timedelta(days=1)
+PRUNE_KEY = 'order-events:prune'
+PRUNE_INTERVAL = 3600
+
+STATUS_AFTER = {
+    'created': 'reserved',
+    'picked': 'picked',
+    'completed': 'completed',
+    'cancelled': 'cancelled',
+    'expired': 'cancelled',
+}
+FINAL_KINDS = {'completed', 'cancelled', 'expired'}
+# What the customer stream shows; the admin feed gets the whole event
+PUBLIC_FIELDS = ('orderId', 'status', 'at')
+
+
+def record(kind, orders):
+    """
+    Write a ``kind`` event for each order (Order instances or rows with the
+    same attribute names). Call it inside the transaction making the change.
+    """
+    now = timezone.localtime()
+    OrderEvent.objects.bulk_create([
+        OrderEvent(
+            order_id=order.order_id,
+            kind=kind,
+            data={
+                'orderId': order.order_id,
+                'status': STATUS_AFTER[kind],
+                'at': now.isoformat(),
+                'customerName': order.customer_name,
+                'roomNumber': order.room_number,
+                'totalAmount': f'{order.total_amount:.2f}',
+                'itemCount': sum(int(item.get('qty', 0)) for item in order.items),
+            },
+        )
+        for order in orders
+    ])
+    if cache.add(PRUNE_KEY, True, PRUNE_INTERVAL):
+        # Housekeeping: a failure is logged, not raised from the committed change
+        transaction.on_commit(prune, robust=True)
+
+
+def prune():
+    """Delete events older than RETENTION"""
+    return OrderEvent.objects.filter(created_at__lt=timezone.now() - RETENTION).delete()[0]
+
+
+def format_event(event, public=False):
+    data = {key: event.data.get(key) for key in PUBLIC_FIELDS} if public else event.data
+    return b'id: %d\nevent: %s\ndata: %s\n\n' % (event.id, event.kind.encode(), orjson.dumps(data))
+
+
+def _fetch_new(after_id, since):
+    close_old_connections()
+    return list(
+        OrderEvent.objects.filter(Q(id__gt=after_id) | Q(created_at__gte=since)).order_by('id')[:BUFFER_SIZE]
+    )
+
+
+def _latest_id():
+    close_old_connections()
+    return OrderEvent.objects.aggregate(latest=Max('id'))['latest'] or 0
+
+
+def _fetch_backlog(after_id, order_id):
+    close_old_connections()
+    events = OrderEvent.objects.filter(id__gt=after_id)
+    if order_id is not None:
+        events = events.filter(order_id=order_id)
+    return list(events.order_by('id')[:BACKLOG_LIMIT])
+
+
+class EventHub:
+    """Polls OrderEvent for every open stream in this event loop"""
+
+    def __init__(self):
+        self.events = deque(maxlen=BUFFER_SIZE)  # (sequence, event)
+        self.sequence = 0
+        self.last_id = None
+        self.seen = {}  # id -> created_at, for events inside the grace window
+        self.changed = asyncio.Event()
+        self.listeners = 0
+        self.task = None
+
+    def subscribe(self):
+        self.listeners += 1
+        if self.task is None:
+            # A fresh context: the poller outlives the request that started it
+            self.task = asyncio.get_running_loop().create_task(self.run(), context=contextvars.Context())
+
+    def unsubscribe(self):
+        self.listeners -= 1
+
+    async def run(self):
+        try:
+            if self.last_id is None:
+                self.last_id = await sync_to_async(_latest_id)()
+                # Events committed before anyone was listening are not news
+                for event in await sync_to_async(_fetch_new)(self.last_id, timezone.now() - GRACE):
+                    self.seen[event.id] = event.created_at
+            while self.listeners > 0:
+                try:
+                    await self.poll()
+                except Exception:
+                    logger.exception("Order event poll failed")
+                await asyncio.sleep(POLL_INTERVAL)
+        finally:
+            self.task = None
+
+    async def poll(self):
+        since = timezone.now() - GRACE
+        events = await sync_to_async(_fetch_new)(self.last_id, since)
+        fresh = [event for event in events if event.id not in self.seen]
+        for event in fresh:
+            self.sequence += 1
+            self.events.append((self.sequence, event))
+            self.seen[event.id] = event.created_at
+        if events:
+            self.last_id = max(self.last_id, events[-1].id)
+        self.seen = {event_id: created_at for event_id, created_at in self.seen.items() if created_at >= since}
+
+        if fresh:
+            self.changed.set()
+            self.changed = asyncio.Event()
+
+    async def wait(self, after, timeout):
+        """Wait until there are events past sequence ``after``; False on timeout"""
+        if self.sequence > after:
+            return True
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def since(self, after):
+        return [(sequence, event) for sequence, event in self.events if sequence > after]
+
+
+_hubs = weakref.WeakKeyDictionary()
+
+
+def get_hub():
+    loop = asyncio.get_running_loop()
+    hub = _hubs.get(loop)
+    if hub is None:
+        hub = _hubs[loop] = EventHub()
+    return hub
+
+
+def is_streamable(request):
+    """Only the ASGI server can hold a stream open without tying up a worker"""
+    return isinstance(request, ASGIRequest)
+
+
+def event_stream_response(events):
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Don't let nginx-style proxies hold events back in a buffer
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def last_event_id(request):
+    value = request.headers.get('Last-Event-ID') or request.GET.get('lastEventId')
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+
+async def stream(order_id=None, after_id=None, snapshot=None):
+    """
+    SSE body for one order (customer page) or for all orders (admin feed,
+    ``order_id=None``). Sends the events after ``after_id`` first (a
+    reconnect), or ``snapshot`` as a ``status`` event without an id for a new
+    client; a customer stream ends once the order is finished.
+    """
+    hub = get_hub()
+    hub.subscribe()
+    public = order_id is not None
+    try:
+        yield b'retry: %d\n\n' % RETRY_MS
+        position = hub.sequence
+        sent = set()
+        if after_id is not None:
+            for event in await sync_to_async(_fetch_backlog)(after_id, order_id):
+                sent.add(event.id)
+                yield format_event(event, public)
+                if public and event.kind in FINAL_KINDS:
+                    return
+        elif snapshot is not None:
+            yield b'event: status\ndata: %s\n\n' % orjson.dumps(snapshot)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + MAX_STREAM_SECONDS
+        while loop.time() < deadline:
+            if not await hub.wait(position, min(HEARTBEAT, max(deadline - loop.time(), 0))):
+                yield b': heartbeat\n\n'
+                continue
+            for position, event in hub.since(position):
+                if event.id in sent or (public and event.order_id != order_id):
+                    continue
+                yield format_event(event, public)
+                if public and event.kind in FINAL_KINDS:
+                    return
+    finally:
+        hub.unsubscribe()
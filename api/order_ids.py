@@ -0,0 +1,203 @@
+"""
+Order ID allocator
+
+Order IDs stay short and human friendly (two letters + two digits, e.g.
+AB12), but instead of guessing random IDs and probing the table, each new
+order takes the next value of a shared counter and maps it through a keyed
+permutation of the 67,600 possible IDs. Within one pass over the ID space
+every value is distinct, so no lookup is needed. Workers reserve counter
+values in small blocks, so most allocations do not touch the database.
+Blocks are reserved in their own short transaction, on a separate
+connection if the caller is inside one, so the counter row is never held
+for the length of an order (see _first_of_new_block for SQLite).
+
+Once the counter wraps, an ID may still belong to an old order. Finished
+orders past the quiet period (ORDER_ID_QUIET_DAYS) are moved to
+ArchivedOrder so their ID can be reused; IDs of recent or active orders are
+skipped.
+"""
+
+import hashlib
+import hmac
+import threading
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connection, connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import metrics
+
+
+LETTERS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+RADIX = 260  # IDs are split into two halves of 260 values (26 letters x 10 digits)
+ID_SPACE = RADIX * RADIX  # 67,600
+ROUNDS = 4
+SEQUENCE_NAME = 'order_id'
+BLOCK_SIZE = 20
+MAX_ATTEMPTS = 100
+
+
+class OrderIdSpaceExhausted(Exception):
+    """Raised when no free order ID could be found"""
+
+
+def _round_tables():
+    key = getattr(settings, 'ORDER_ID_KEY', '') or settings.SECRET_KEY
+    tables = []
+    for round_no in range(ROUNDS):
+        table = []
+        for value in range(RADIX):
+            mac = hmac.new(key.encode(), f"{round_no}:{value}".encode(), hashlib.sha256).digest()
+            table.append(int.from_bytes(mac[:4], 'big') % RADIX)
+        tables.append(table)
+    return tables
+
+
+_tables = None
+
+
+def permute(index):
+    """Keyed bijection on [0, ID_SPACE): a Feistel network over Z_260 x Z_260"""
+    global _tables
+    if _tables is None:
+        _tables = _round_tables()
+    left, right = divmod(index, RADIX)
+    for table in _tables:
+        left, right = right, (left + table[right]) % RADIX
+    return left * RADIX + right
+
+
+def format_order_id(index):
+    """Render an index in [0, ID_SPACE) as two letters and two digits"""
+    letters, digits = divmod(index, 100)
+    return f"{LETTERS[letters // 26]}{LETTERS[letters % 26]}{digits:02d}"
+
+
+def order_id_for(sequence_value):
+    return format_order_id(permute(sequence_value % ID_SPACE))
+
+
+def _reserve_block(conn, size):
+    """Advance the counter by ``size`` on ``conn`` and return the reserved values"""
+    from .models import Sequence
+
+    table = conn.ops.quote_name(Sequence._meta.db_table)
+    advance = f"UPDATE {table} SET value = value + %s WHERE name = %s RETURNING value"
+    with conn.cursor() as cursor:
+        cursor.execute(advance, [size, SEQUENCE_NAME])
+        row = cursor.fetchone()
+        if row is None:
+            cursor.execute(
+                f"INSERT INTO {table} (name, value) VALUES (%s, 0) ON CONFLICT (name) DO NOTHING", [SEQUENCE_NAME]
+            )
+            cursor.execute(advance, [size, SEQUENCE_NAME])
+            row = cursor.fetchone()
+    end = row[0]
+    return iter(range(end - size, end))
+
+
+# One block (and reservation connection) per thread, as each thread has its
+# own connection and transaction
+_local = threading.local()
+
+
+def _sequence_connection():
+    """
+    A connection in autocommit mode, so the counter row is locked only for
+    the one UPDATE and never by a caller's order transaction
+    """
+    if not connection.in_atomic_block:
+        return connection
+    conn = getattr(_local, 'connection', None)
+    if conn is None:
+        conn = _local.connection = connections.create_connection(DEFAULT_DB_ALIAS)
+    conn.close_if_unusable_or_obsolete()
+    return conn
+
+
+def _keep_block(block):
+    _local.block = block
+
+
+def _first_of_new_block():
+    if connection.in_atomic_block and connection.vendor == 'sqlite':
+        # SQLite has a single writer: a second connection would wait for this
+        # transaction's own lock. Reserve inside the transaction, and keep the
+        # rest of the block only once it commits; a rollback takes the
+        # reservation back, so the rest must not be used.
+        _local.block = None
+        block = _reserve_block(connection, BLOCK_SIZE)
+        value = next(block)
+        transaction.on_commit(partial(_keep_block, block))
+        return value
+    block = _local.block = _reserve_block(_sequence_connection(), BLOCK_SIZE)
+    return next(block)
+
+
+def next_order_id():
+    """Return the next order ID; only every BLOCK_SIZE-th call hits the database"""
+    block = getattr(_local, 'block', None)
+    value = next(block, None) if block is not None else None
+    if value is None:
+        value = _first_of_new_block()
+    return order_id_for(value)
+
+
+def reset_block():
+    """Forget this thread's reserved counter block"""
+    _local.block = None
+
+
+def archive_if_stale(order_id):
+    """
+    Move a finished order out of the way so its ID can be reused.
+
+    Returns True if the ID is now free.
+    """
+    from .models import ArchivedOrder, Order
+
+    cutoff = timezone.now() - timedelta(days=settings.ORDER_ID_QUIET_DAYS)
+    with transaction.atomic():
+        order = Order.objects.select_for_update().filter(
+            Q(status='completed', completed_at__lt=cutoff) | Q(status='cancelled', cancelled_at__lt=cutoff),
+            order_id=order_id
+        ).first()
+        if order is None:
+            return False
+        # The live board link is not kept: the board only lists current orders
+        kept = {field.attname for field in ArchivedOrder._meta.concrete_fields}
+        ArchivedOrder.objects.create(
+            **{field.attname: getattr(order, field.attname) for field in Order._meta.concrete_fields if field.attname in kept}
+        )
+        order.delete()
+    return True
+
+
+def insert_with_new_id(order, insert):
+    """
+    Assign a fresh ID to ``order`` and run ``insert()``, which must do a
+    forced INSERT. Retries on ID collisions after the counter has wrapped.
+    """
+    from .models import Order
+
+    order_id = next_order_id()
+    for attempt in range(MAX_ATTEMPTS):
+        order.order_id = order_id
+        try:
+            with transaction.atomic():
+                insert()
+            return
+        except IntegrityError:
+            if not Order.objects.filter(order_id=order_id).exists():
+                raise
+            if archive_if_stale(order_id):
+                metrics.ORDER_ID_COLLISIONS.inc(outcome='archived')
+            else:
+                metrics.ORDER_ID_COLLISIONS.inc(outcome='skipped')
+                order_id = next_order_id()
+
+    order.order_id = None
+    raise OrderIdSpaceExhausted(f"No free order ID after {MAX_ATTEMPTS} attempts")
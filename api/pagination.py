@@ -0,0 +1,98 @@
+"""
+Keyset pagination and filters for order listings
+
+Pages are ordered by (created_at, order_id) descending and the cursor holds
+the last row's key, so every page is an index range scan no matter how far
+back the client pages. The response body stays a plain list; the cursor for
+the next page is returned in the X-Next-Cursor and Link headers.
+"""
+
+import base64
+from datetime import datetime, time, timedelta
+
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def encode_cursor(created_at, order_id):
+    raw = f"{created_at.isoformat()}|{order_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return (created_at, order_id); raises ValueError for a bad cursor"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, order_id = raw.split('|', 1)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError('Invalid cursor')
+    value = parse_datetime(created_at)
+    if value is None:
+        raise ValueError('Invalid cursor')
+    return value, order_id
+
+
+def _parse_bound(value, end=False):
+    """Parse a date (whole local day) or ISO datetime query parameter"""
+    moment = parse_datetime(value)
+    if moment is not None:
+        return moment if timezone.is_aware(moment) else timezone.make_aware(moment)
+
+    day = parse_date(value)
+    if day is None:
+        raise ValueError(f"Invalid date: {value}")
+    if end:
+        day += timedelta(days=1)
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def filter_orders(queryset, params):
+    """Apply status, since/until, room and phone filters from query parameters"""
+    if params.get('status'):
+        queryset = queryset.filter(status__in=params['status'].split(','))
+    if params.get('since'):
+        queryset = queryset.filter(created_at__gte=_parse_bound(params['since']))
+    if params.get('until'):
+        until = params['until']
+        # A bare date includes that whole day
+        if parse_datetime(until) is None:
+            queryset = queryset.filter(created_at__lt=_parse_bound(until, end=True))
+        else:
+            queryset = queryset.filter(created_at__lte=_parse_bound(until))
+    if params.get('room'):
+        queryset = queryset.filter(room_number=params['room'])
+    if params.get('phone'):
+        queryset = queryset.filter(phone_number=params['phone'])
+    return queryset
+
+
+def page_size(params):
+    try:
+        size = int(params.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise ValueError('limit must be a number')
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def paginate_orders(queryset, params):
+    """Return (orders, next_cursor) for the page after params['cursor']"""
+    size = page_size(params)
+    queryset = queryset.order_by('-created_at', '-order_id')
+
+    if params.get('cursor'):
+        created_at, order_id = decode_cursor(params['cursor'])
+        # (created_at, order_id) < cursor, written so the index can seek on created_at
+        queryset = queryset.filter(created_at__lte=created_at).filter(
+            Q(created_at__lt=created_at) | Q(order_id__lt=order_id)
+        )
+
+    orders = list(queryset[:size + 1])
+    if len(orders) <= size:
+        return orders, None
+    orders = orders[:size]
+    return orders, encode_cursor(orders[-1].created_at, orders[-1].order_id)
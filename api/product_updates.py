@@ -0,0 +1,126 @@
+"""
+Batched product updates for the admin panel
+
+All rows are validated before anything is written, the products are loaded
+in one query, and only the fields that actually change are written with
+bulk_update() inside one transaction, so a batch applies completely or not
+at all. Stock goes through stock.set_stock instead, so the ledger records
+each change and striped products get their stripes rewritten.
+"""
+
+from collections import defaultdict
+
+from django.db import transaction
+from django.utils import timezone
+
+from .catalog import invalidate_catalog
+from .models import Product
+from .serializers import ProductSerializer
+from .stock import batched_invalidation, set_stock
+
+
+EDITABLE_FIELDS = ('name', 'category', 'price', 'stock', 'active')
+BATCH_SIZE = 100
+
+
+def validate_updates(updates):
+    """
+    Return (changes, errors): changes maps product id to validated field
+    values, errors maps the index of each bad row to its error messages.
+    """
+    changes = {}
+    errors = {}
+    if not isinstance(updates, list):
+        return changes, {None: {'updates': ['Expected a list of updates.']}}
+
+    for index, update in enumerate(updates):
+        if not isinstance(update, dict) or 'id' not in update:
+            errors[index] = {'id': ['This field is required.']}
+            continue
+        try:
+            product_id = int(update['id'])
+        except (TypeError, ValueError):
+            errors[index] = {'id': ['A valid integer is required.']}
+            continue
+        if product_id in changes:
+            errors[index] = {'id': ['Duplicate product id in this batch.']}
+            continue
+
+        data = {key: value for key, value in update.items() if key != 'id'}
+        unknown = set(data) - set(EDITABLE_FIELDS)
+        if unknown:
+            errors[index] = {key: ['This field cannot be bulk updated.'] for key in sorted(unknown)}
+            continue
+
+        serializer = ProductSerializer(data=data, partial=True)
+        if not serializer.is_valid():
+            errors[index] = serializer.errors
+            continue
+        values = serializer.validated_data
+        if values.get('stock', 0) < 0:
+            errors[index] = {'stock': ['Stock cannot be negative.']}
+            continue
+        changes[product_id] = dict(values)
+
+    return changes, errors
+
+
+def apply_updates(updates):
+    """
+    Validate and apply a batch of {'id': ..., field: value} updates.
+
+    Returns (applied, results) where results has one entry per row with its
+    id, status ('updated', 'unchanged' or 'error'; 'skipped' for valid rows of
+    a rejected batch) and the changed fields or errors. Nothing is written
+    unless every row is valid and exists.
+    """
+    changes, errors = validate_updates(updates)
+    if None in errors:
+        return False, [{'id': None, 'status': 'error', 'errors': errors[None]}]
+
+    with transaction.atomic():
+        products = Product.objects.select_for_update().only('id', *EDITABLE_FIELDS).in_bulk(list(changes))
+
+        results = []
+        groups = defaultdict(list)
+        levels = {}
+        now = timezone.now()
+        for index, update in enumerate(updates):
+            if index in errors:
+                results.append({'id': update.get('id') if isinstance(update, dict) else None, 'status': 'error', 'errors': errors[index]})
+                continue
+
+            product_id = int(update['id'])
+            product = products.get(product_id)
+            if product is None:
+                errors[index] = {'id': ['Product not found.']}
+                results.append({'id': product_id, 'status': 'error', 'errors': errors[index]})
+                continue
+
+            changed = [name for name, value in changes[product_id].items() if getattr(product, name) != value]
+            for name in changed:
+                setattr(product, name, changes[product_id][name])
+            if 'stock' in changed:
+                levels[product_id] = product.stock
+            fields = tuple(sorted(name for name in changed if name != 'stock'))
+            if fields:
+                product.updated_at = now
+                # Group by changed fields so no row is rewritten with values it did not change
+                groups[fields].append(product)
+            results.append({'id': product_id, 'status': 'updated' if changed else 'unchanged', 'fields': changed})
+
+        if errors:
+            for result in results:
+                if result['status'] != 'error':
+                    result['status'] = 'skipped'
+            return False, results
+
+        for fields, group in groups.items():
+            Product.objects.bulk_update(group, [*fields, 'updated_at'], batch_size=BATCH_SIZE)
+        with batched_invalidation():
+            stock_changes = set_stock(levels) if levels else {}
+        # One invalidation for the whole batch
+        if groups or stock_changes:
+            transaction.on_commit(invalidate_catalog)
+
+    return True, results
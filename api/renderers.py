@@ -0,0 +1,67 @@
+import time
+
+import orjson
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+from .middleware import request_timings
+
+
+# Datetimes go through DRF's encoder like every other type orjson does not
+# handle natively (Decimal, lazy strings, ...), so the output matches
+# JSONRenderer's.
+ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+# For fast_serializers output, whose datetimes stand for DateTimeField
+# values: ISO 8601 with microseconds and 'Z' for UTC, like DateTimeField
+ROW_OPTIONS = orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS
+
+_encoder = JSONEncoder()
+
+
+def _escape(body):
+    # Like JSONRenderer, keep the output a strict JavaScript subset
+    return body.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+
+
+def _add_render_time(started):
+    timings = request_timings.get()
+    if timings is not None:
+        timings['render'] += time.perf_counter() - started
+
+
+def dumps(data):
+    """Compact JSON bytes, the same as JSONRenderer's default output; None if orjson cannot encode ``data``"""
+    try:
+        return _escape(orjson.dumps(data, default=_encoder.default, option=ORJSON_OPTIONS))
+    except orjson.JSONEncodeError:
+        return None
+
+
+def render_rows(data):
+    """Render fast_serializers output; the bytes match the DRF serializer rendered by JSONRenderer"""
+    started = time.perf_counter()
+    try:
+        return _escape(orjson.dumps(data, default=_encoder.default, option=ROW_OPTIONS))
+    finally:
+        _add_render_time(started)
+
+
+class TimedJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer that encodes with orjson and adds its render time to the
+    request's metrics. Indented or non-default output falls back to the
+    standard encoder, as does anything orjson rejects (e.g. integers wider
+    than 64 bits).
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        started = time.perf_counter()
+        try:
+            if (data is not None and self.compact and not self.ensure_ascii
+                    and self.get_indent(accepted_media_type, renderer_context or {}) is None):
+                body = dumps(data)
+                if body is not None:
+                    return body
+            return super().render(data, accepted_media_type, renderer_context)
+        finally:
+            _add_render_time(started)
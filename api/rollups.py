@@ -0,0 +1,145 @@
+"""
+Incrementally maintained sales rollups
+
+Every order state transition adds its deltas to SalesRollup rows for the
+order's local hour, local day and all time, once for the order as a whole
+(category '') and once per product category in it. The admin dashboard then
+reads a couple of small rows instead of counting the Order table.
+
+Orders are bucketed by their created_at, so a completion or cancellation is
+counted against the hour and day the order was placed. Status changes made
+outside these hooks (e.g. editing an order in the Django admin) are not
+tracked; ``manage.py rebuild_rollups`` recomputes everything from history.
+"""
+
+from collections import defaultdict
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
+
+from django.apps import apps as global_apps
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Product, SalesRollup
+from .timeutils import local_day_range
+
+
+ALL_TIME = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+UNKNOWN_CATEGORY = 'Unknown'
+
+
+def buckets(created_at):
+    """Return [(granularity, bucket_start)] for an order created at created_at"""
+    local = timezone.localtime(created_at)
+    return [
+        ('hour', local.replace(minute=0, second=0, microsecond=0)),
+        ('day', local_day_range(local.date())[0]),
+        ('all', ALL_TIME),
+    ]
+
+
+def item_categories(items):
+    """Map the productIds in items to their current category"""
+    ids = {item['productId'] for item in items}
+    return dict(Product.objects.filter(pk__in=ids).values_list('id', 'category'))
+
+
+def order_deltas(event, created_at, items, total_amount, categories, deltas=None):
+    """
+    Add the counter changes of one order event ('created', 'completed' or
+    'cancelled') to deltas, keyed by (granularity, bucket_start, category).
+    """
+    deltas = deltas if deltas is not None else defaultdict(lambda: defaultdict(int))
+
+    per_category = defaultdict(lambda: {'revenue': Decimal('0'), 'units': 0})
+    for item in items:
+        category = categories.get(item['productId']) or UNKNOWN_CATEGORY
+        per_category[category]['revenue'] += Decimal(str(item['price'])) * int(item['qty'])
+        per_category[category]['units'] += int(item['qty'])
+
+    scopes = [('', Decimal(str(total_amount)), sum(c['units'] for c in per_category.values()))]
+    scopes += [(category, c['revenue'], c['units']) for category, c in per_category.items()]
+
+    for granularity, bucket_start in buckets(created_at):
+        for category, revenue, units in scopes:
+            counters = deltas[(granularity, bucket_start, category)]
+            if event == 'created':
+                counters['orders'] += 1
+            elif event == 'completed':
+                counters['completed'] += 1
+                counters['revenue'] += revenue
+                counters['units'] += units
+            elif event == 'cancelled':
+                counters['cancellations'] += 1
+    return deltas
+
+
+def apply_deltas(deltas):
+    """Add deltas to the rollup rows, creating missing rows"""
+    # Touch rows in a fixed order so concurrent transactions cannot deadlock
+    for (granularity, bucket_start, category), counters in sorted(deltas.items()):
+        counters = {name: value for name, value in counters.items() if value}
+        if not counters:
+            continue
+        rows = SalesRollup.objects.filter(granularity=granularity, bucket_start=bucket_start, category=category)
+        changes = {name: F(name) + value for name, value in counters.items()}
+        if rows.update(**changes):
+            continue
+        try:
+            with transaction.atomic():
+                SalesRollup.objects.create(
+                    granularity=granularity, bucket_start=bucket_start, category=category, **counters
+                )
+        except IntegrityError:
+            # Another transaction created the row first
+            rows.update(**changes)
+
+
+def record(event, orders):
+    """Record one event for each order (anything with created_at, items and total_amount)"""
+    orders = list(orders)
+    if not orders:
+        return
+    categories = item_categories([item for order in orders for item in order.items])
+    deltas = None
+    for order in orders:
+        deltas = order_deltas(event, order.created_at, order.items, order.total_amount, categories, deltas)
+    apply_deltas(deltas)
+
+
+def totals(day_start):
+    """
+    The order-level rows for the local day starting at ``day_start`` and for
+    all time: two exact lookups on the unique key, in no particular order.
+    """
+    return SalesRollup.objects.filter(category='').filter(
+        Q(granularity='day', bucket_start=day_start) | Q(granularity='all', bucket_start=ALL_TIME)
+    ).order_by()
+
+
+def rebuild(apps=global_apps):
+    """Recompute every rollup row from Order and ArchivedOrder; returns the number of rows"""
+    product_model = apps.get_model('api', 'Product')
+    rollup_model = apps.get_model('api', 'SalesRollup')
+
+    categories = dict(product_model.objects.values_list('id', 'category'))
+    deltas = defaultdict(lambda: defaultdict(int))
+    for model_name in ('Order', 'ArchivedOrder'):
+        model = apps.get_model('api', model_name)
+        rows = model.objects.order_by().values_list('created_at', 'items', 'total_amount', 'status')
+        for created_at, items, total_amount, status in rows.iterator(chunk_size=2000):
+            order_deltas('created', created_at, items, total_amount, categories, deltas)
+            if status in ('completed', 'cancelled'):
+                order_deltas(status, created_at, items, total_amount, categories, deltas)
+
+    with transaction.atomic():
+        rollup_model.objects.all().delete()
+        rollup_model.objects.bulk_create(
+            [
+                rollup_model(granularity=granularity, bucket_start=bucket_start, category=category, **counters)
+                for (granularity, bucket_start, category), counters in deltas.items()
+            ],
+            batch_size=500
+        )
+    return len(deltas)
@@ -1,18 +1,28 @@
+from django.db import transaction
 from rest_framework import serializers
 from .models import Product, Order
+from .images import thumbnail_urls
+from .stock import InsufficientStock, record_movements, reserve
+from .expiry import notify_deadlines_changed
+from . import order_events, rollups
 
 
 class ProductSerializer(serializers.ModelSerializer):
     image = serializers.SerializerMethodField()
+    thumbnails = serializers.SerializerMethodField()
     
     class Meta:
         model = Product
-        fields = ['id', 'name', 'category', 'price', 'stock', 'image', 'active', 'created_at', 'updated_at']
+        fields = ['id', 'name', 'category', 'price', 'stock', 'image', 'thumbnails', 'active', 'created_at', 'updated_at']
     
     def get_image(self, obj):
-        """Return base64 data URL directly"""
-        if obj.image:
-            return obj.image  # Already in data:image format
+        """Return the default thumbnail URL (or external image URL)"""
+        return obj.image_url
+    
+    def get_thumbnails(self, obj):
+        """Return {size: url} for stored images, for use in srcset"""
+        if obj.image_digest:
+            return thumbnail_urls(obj.image_digest)
         return None
 
 
@@ -37,6 +47,18 @@ class OrderSerializer(serializers.ModelSerializer):
         ]
         read_only_fields = ['orderId', 'totalAmount', 'status', 'createdAt', 'expiresAt', 'pickedAt', 'completedAt', 'cancelledAt']
 
+    def __init__(self, *args, **kwargs):
+        # Optional projection: OrderSerializer(orders, many=True, fields=['orderId', 'status'])
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+        
+        if fields is not None:
+            unknown = set(fields) - set(self.fields)
+            if unknown:
+                raise ValueError(f"Unknown field(s): {', '.join(sorted(unknown))}")
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
     def validate_items(self, value):
         """Validate items structure"""
         if not isinstance(value, list) or len(value) == 0:
@@ -46,6 +68,9 @@ class OrderSerializer(serializers.ModelSerializer):
             if not all(key in item for key in ['productId', 'name', 'price', 'qty']):
                 raise serializers.ValidationError("Each item must have productId, name, price, and qty")
             
+            if not isinstance(item['productId'], int) or not isinstance(item['qty'], int):
+                raise serializers.ValidationError("productId and qty must be integers")
+            
             if item['qty'] <= 0:
                 raise serializers.ValidationError("Quantity must be positive")
         
@@ -58,31 +83,23 @@ class OrderSerializer(serializers.ModelSerializer):
         return value
 
     def create(self, validated_data):
-        """Create order and deduct stock"""
+        """Create order and reserve stock in one transaction"""
         items = validated_data['items']
         
         # Calculate total amount (ensure values are numeric)
         total_amount = sum(float(item['price']) * int(item['qty']) for item in items)
         validated_data['total_amount'] = total_amount
         
-        # Check stock availability
-        for item in items:
+        with transaction.atomic():
             try:
-                product = Product.objects.get(id=item['productId'])
-                if product.stock < int(item['qty']):
-                    raise serializers.ValidationError(
-                        f"Insufficient stock for {product.name}. Available: {product.stock}"
-                    )
-            except Product.DoesNotExist:
-                raise serializers.ValidationError(f"Product with ID {item['productId']} not found")
-        
-        # Create order
-        order = Order.objects.create(**validated_data)
-        
-        # Deduct stock
-        for item in items:
-            product = Product.objects.get(id=item['productId'])
-            product.stock -= int(item['qty'])
-            product.save()
+                reserve(items)
+            except InsufficientStock as e:
+                raise serializers.ValidationError(e.errors)
+            
+            order = Order.objects.create(**validated_data)
+            record_movements('reserve', [order])
+            rollups.record('created', [order])
+            order_events.record('created', [order])
+            transaction.on_commit(notify_deadlines_changed)
         
         return order
@@ -0,0 +1,224 @@
+"""
+WSGI vs ASGI serving benchmark
+
+Starts the project under gunicorn twice, once with sync workers
+(backend.wsgi) and once with uvicorn workers (backend.asgi), each sized to
+the same memory budget from the measured RSS of one warmed-up worker. Each
+server is then held down by slow clients that trickle their request headers
+(like students on a bad campus connection) while probe clients time
+GET /api/products and GET /api/orders/<id>.
+
+Linux only: RSS is read from /proc.
+"""
+
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+from django.conf import settings
+
+from .loadtest import _host, percentile
+from .models import Order
+
+
+MODES = {
+    'wsgi': ['backend.wsgi:application', '--worker-class', 'sync'],
+    'asgi': ['backend.asgi:application', '--worker-class', 'uvicorn.workers.UvicornWorker'],
+}
+PROBE_TIMEOUT = 5.0
+
+
+class ServerError(Exception):
+    pass
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _rss_kb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def _children(pid):
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name may contain spaces; the parent pid follows the closing paren
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            children.append(int(entry))
+    return children
+
+
+def memory_usage(pid):
+    """(master RSS, [worker RSS, ...]) in MB for a gunicorn master pid"""
+    return _rss_kb(pid) / 1024, [_rss_kb(child) / 1024 for child in _children(pid)]
+
+
+class Server:
+    """A gunicorn process serving the project on a free local port"""
+
+    def __init__(self, mode, workers):
+        self.mode = mode
+        self.workers = workers
+        self.port = _free_port()
+        self.base_url = f'http://127.0.0.1:{self.port}'
+        self.process = None
+
+    def __enter__(self):
+        command = [
+            sys.executable, '-m', 'gunicorn', *MODES[self.mode],
+            '--bind', f'127.0.0.1:{self.port}',
+            '--workers', str(self.workers),
+            '--log-level', 'critical',
+        ]
+        self.process = subprocess.Popen(command, cwd=settings.BASE_DIR, stdout=subprocess.DEVNULL)
+        self.wait_ready()
+        return self
+
+    def __exit__(self, *exc):
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+    def wait_ready(self, timeout=30.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise ServerError(f'{self.mode} server exited with code {self.process.returncode}')
+            master, workers = memory_usage(self.process.pid)
+            if len(workers) >= self.workers:
+                try:
+                    response = httpx.get(f'{self.base_url}/api/products', headers={'Host': _host()}, timeout=2.0)
+                except httpx.HTTPError:
+                    pass
+                else:
+                    if response.is_redirect:
+                        raise ServerError('The server redirects to HTTPS; run the benchmark with DEBUG=True')
+                    return
+            time.sleep(0.2)
+        raise ServerError(f'{self.mode} server did not start within {timeout:.0f}s')
+
+    def memory(self):
+        return memory_usage(self.process.pid)
+
+
+def probe_paths():
+    order_id = Order.objects.values_list('order_id', flat=True).first() or 'MISSING'
+    return ['/api/products', f'/api/orders/{order_id}']
+
+
+def warm_up(server, paths, requests=50):
+    """Load every worker's code paths and caches before measuring its memory"""
+    with httpx.Client(base_url=server.base_url, headers={'Host': _host()}, timeout=PROBE_TIMEOUT) as client:
+        for index in range(requests):
+            client.get(paths[index % len(paths)])
+
+
+def worker_memory(mode, paths):
+    """RSS in MB of the master and of one warmed-up worker"""
+    with Server(mode, 1) as server:
+        warm_up(server, paths)
+        master, workers = server.memory()
+    return master, max(workers)
+
+
+def workers_for_budget(budget_mb, master_mb, worker_mb):
+    return max(1, int((budget_mb - master_mb) // worker_mb))
+
+
+async def _slow_client(port, stop, interval):
+    """Keep a connection busy by sending one header line every ``interval`` seconds"""
+    while not stop.is_set():
+        writer = None
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(f'GET /api/products HTTP/1.1\r\nHost: {_host()}\r\n'.encode())
+            while not stop.is_set() and not reader.at_eof():
+                await writer.drain()
+                try:
+                    await asyncio.wait_for(stop.wait(), interval)
+                except asyncio.TimeoutError:
+                    writer.write(b'X-Slow-Client: 1\r\n')
+        except OSError:
+            await asyncio.sleep(interval)
+        finally:
+            if writer is not None:
+                writer.close()
+
+
+async def _probe(client, paths, stop, latencies, outcomes):
+    index = 0
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            response = await client.get(paths[index % len(paths)])
+        except httpx.HTTPError:
+            outcomes['errors'] += 1
+        else:
+            if response.status_code < 500:
+                outcomes['completed'] += 1
+                latencies.append(time.perf_counter() - started)
+            else:
+                outcomes['errors'] += 1
+        index += 1
+
+
+async def _load(server, paths, duration, slow_clients, probes, trickle):
+    stop = asyncio.Event()
+    latencies = []
+    outcomes = {'completed': 0, 'errors': 0}
+    limits = httpx.Limits(max_connections=probes, max_keepalive_connections=probes)
+    async with httpx.AsyncClient(base_url=server.base_url, headers={'Host': _host()},
+                                 timeout=PROBE_TIMEOUT, limits=limits) as client:
+        tasks = [asyncio.create_task(_slow_client(server.port, stop, trickle)) for _ in range(slow_clients)]
+        # Let the slow clients take their connections before probing
+        await asyncio.sleep(min(1.0, duration / 4))
+        tasks += [asyncio.create_task(_probe(client, paths, stop, latencies, outcomes)) for _ in range(probes)]
+        await asyncio.sleep(duration)
+        stop.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return latencies, outcomes
+
+
+def run(mode, workers, paths, duration=15.0, slow_clients=50, probes=10, trickle=1.0):
+    """Serve ``mode`` with ``workers`` workers under slow-client load and return a report dict"""
+    with Server(mode, workers) as server:
+        warm_up(server, paths)
+        latencies, outcomes = asyncio.run(_load(server, paths, duration, slow_clients, probes, trickle))
+        master, worker_rss = server.memory()
+
+    return {
+        'mode': mode,
+        'workers': workers,
+        'rss_mb': round(master + sum(worker_rss), 1),
+        'completed': outcomes['completed'],
+        'errors': outcomes['errors'],
+        'throughput_rps': round(outcomes['completed'] / duration, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2) if latencies else None,
+    }
@@ -0,0 +1,33 @@
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import AdminSettings, Product
+from . import low_stock
+from .catalog import invalidate_catalog, record_deletion
+from .middleware import install_query_timer
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def product_changed(sender, instance, **kwargs):
+    """Invalidate the catalog cache once the product change is committed"""
+    transaction.on_commit(invalidate_catalog)
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted(sender, instance, **kwargs):
+    """Tell delta catalog syncs (GET /api/products?since=) that the product is gone"""
+    record_deletion(instance.pk)
+
+
+@receiver(post_save, sender=AdminSettings)
+@receiver(post_delete, sender=AdminSettings)
+def settings_changed(sender, instance, **kwargs):
+    """Reload the low-stock thresholds in this process (others pick them up within THRESHOLDS_TTL)"""
+    low_stock.thresholds.reset()
+
+
+# Count queries for the request metrics on every connection, whichever thread opens it
+connection_created.connect(install_query_timer, dispatch_uid='api.install_query_timer')
@@ -0,0 +1,320 @@
+"""
+Stock reservation and release for orders, and the stock ledger
+
+Stock is changed with conditional, set-based UPDATEs (``stock >= qty``)
+instead of read-modify-write on Product instances, so concurrent orders
+cannot oversell and a whole order needs a single statement.
+
+Every change also appends StockMovement rows (reserve, release, restock,
+adjust) in the same transaction, so the ledger says why stock moved.
+Inserts don't contend with each other; stock_ledger.py compacts and
+reconciles the ledger.
+
+A hot product can be striped: its stock is split over Product.stock_stripes
+StockStripe rows, and a reservation takes from any stripe with enough units
+that no other transaction holds (SELECT ... FOR UPDATE SKIP LOCKED), so
+concurrent orders for it no longer queue on one row lock. Only when every
+such stripe is busy, or the stock is spread too thin, does it lock them all.
+Product.stock of a striped product is the stripes' total as of the last
+compaction; reservations never read it.
+
+Each change invalidates the catalog cache on commit. A caller changing many
+products in one go (a bulk update) runs them under batched_invalidation()
+and invalidates the catalog once itself.
+"""
+
+import random
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Q, Sum, Value, When
+from django.utils import timezone
+
+from . import low_stock, metrics
+from .catalog import invalidate_catalog
+from .models import Product, StockMovement, StockStripe
+
+
+# Set while the caller invalidates the catalog once for a whole batch
+_batched = ContextVar('stock_batched_invalidation', default=False)
+
+
+@contextmanager
+def batched_invalidation():
+    """Leave invalidating the catalog to the caller, which does it once for the batch"""
+    token = _batched.set(True)
+    try:
+        yield
+    finally:
+        _batched.reset(token)
+
+
+def invalidate_on_commit():
+    if not _batched.get():
+        transaction.on_commit(invalidate_catalog)
+
+
+class InsufficientStock(Exception):
+    """Raised when an order cannot be reserved; ``errors`` holds one message per item"""
+
+    def __init__(self, errors):
+        super().__init__('; '.join(errors))
+        self.errors = errors
+
+
+def quantities_by_product(items):
+    """Sum order item quantities per product id"""
+    quantities = defaultdict(int)
+    for item in items:
+        quantities[int(item['productId'])] += int(item['qty'])
+    return dict(quantities)
+
+
+def _per_product(quantities):
+    return Case(
+        *[When(id=product_id, then=Value(qty)) for product_id, qty in quantities.items()],
+        output_field=IntegerField()
+    )
+
+
+def spread(total, stripes):
+    """Split ``total`` units as evenly as possible over ``stripes`` stripes"""
+    share, extra = divmod(total, stripes)
+    return [share + 1 if stripe < extra else share for stripe in range(stripes)]
+
+
+def striped_products(product_ids):
+    """{product id: stripe count} for the striped products among product_ids"""
+    return dict(Product.objects.filter(id__in=product_ids, stock_stripes__gt=0).values_list('id', 'stock_stripes'))
+
+
+def available(product_ids):
+    """{product id: units available now}, adding up the stripes of striped products"""
+    products = dict(Product.objects.filter(id__in=product_ids).values_list('id', 'stock'))
+    striped = striped_products(products)
+    totals = dict(
+        StockStripe.objects.filter(product_id__in=striped).order_by()
+        .values('product_id').annotate(total=Sum('quantity')).values_list('product_id', 'total')
+    )
+    return {
+        product_id: totals.get(product_id, 0) if product_id in striped else stock
+        for product_id, stock in products.items()
+    }
+
+
+def write_stripes(product_id, quantities):
+    """Replace a product's stripes with ``quantities`` (its rows must be locked)"""
+    stripes = StockStripe.objects.filter(product_id=product_id)
+    if stripes.count() == len(quantities):
+        stripes.update(quantity=Case(
+            *[When(stripe=stripe, then=Value(qty)) for stripe, qty in enumerate(quantities)],
+            output_field=IntegerField()
+        ))
+        return
+    stripes.delete()
+    StockStripe.objects.bulk_create([
+        StockStripe(product_id=product_id, stripe=stripe, quantity=qty) for stripe, qty in enumerate(quantities)
+    ])
+
+
+def _shortfall_errors(quantities):
+    names = dict(Product.objects.filter(id__in=quantities).values_list('id', 'name'))
+    levels = available(names)
+    errors = []
+    for product_id, qty in quantities.items():
+        if product_id not in names:
+            errors.append(f"Product with ID {product_id} not found")
+        elif levels[product_id] < qty:
+            errors.append(f"Insufficient stock for {names[product_id]}. Available: {levels[product_id]}")
+    return errors or ["Stock changed while placing the order, please try again"]
+
+
+def _take_from_stripes(product_id, qty):
+    """Take ``qty`` units from a striped product; False if it does not have them"""
+    # Any stripe with enough units that another transaction isn't holding
+    stripe_id = (
+        StockStripe.objects.select_for_update(skip_locked=True)
+        .filter(product_id=product_id, quantity__gte=qty)
+        .order_by('?')
+        .values_list('id', flat=True)
+        .first()
+    )
+    if stripe_id is not None:
+        StockStripe.objects.filter(id=stripe_id).update(quantity=F('quantity') - qty)
+        return True
+
+    # Every stripe that could serve it is busy, or no single one can: wait
+    # for all of them and take across stripes
+    metrics.STOCK_STRIPE_WAITS.inc()
+    stripes = (
+        Product.objects.select_for_update().filter(id=product_id)
+        .values_list('stock_stripes', flat=True).first()
+    )
+    if not stripes:
+        # Compaction folded it back into Product.stock meanwhile (or it is gone)
+        invalidate_on_commit()
+        return Product.objects.filter(id=product_id, stock__gte=qty).update(
+            stock=F('stock') - qty, updated_at=timezone.now()
+        ) == 1
+
+    rows = list(
+        StockStripe.objects.select_for_update().filter(product_id=product_id)
+        .order_by('stripe').values_list('id', 'quantity')
+    )
+    if sum(quantity for _, quantity in rows) < qty:
+        return False
+    takes = {}
+    remaining = qty
+    for stripe_id, quantity in sorted(rows, key=lambda row: -row[1]):
+        takes[stripe_id] = min(quantity, remaining)
+        remaining -= takes[stripe_id]
+        if not remaining:
+            break
+    StockStripe.objects.filter(id__in=takes).update(quantity=F('quantity') - Case(
+        *[When(id=stripe_id, then=Value(take)) for stripe_id, take in takes.items()],
+        output_field=IntegerField()
+    ))
+    return True
+
+
+def _add_to_stripes(product_id, stripes, qty):
+    """Give ``qty`` units back to one stripe of a striped product"""
+    if StockStripe.objects.filter(product_id=product_id, stripe=random.randrange(stripes)).update(
+        quantity=F('quantity') + qty
+    ):
+        return
+    # Re-striped or folded back by a compaction meanwhile
+    stripes = (
+        Product.objects.select_for_update().filter(id=product_id)
+        .values_list('stock_stripes', flat=True).first()
+    )
+    if stripes:
+        StockStripe.objects.filter(product_id=product_id, stripe=0).update(quantity=F('quantity') + qty)
+    else:
+        Product.objects.filter(id=product_id).update(stock=F('stock') + qty, updated_at=timezone.now())
+
+
+def reserve(items):
+    """
+    Take stock for all order items, all-or-nothing: one UPDATE for products
+    kept on their row, one stripe each for striped ones.
+
+    Raises InsufficientStock listing every item that could not be reserved.
+    Call inside the transaction that creates the order, and record the
+    order's movements with record_movements('reserve', [order]).
+    """
+    quantities = quantities_by_product(items)
+
+    condition = Q()
+    for product_id, qty in quantities.items():
+        condition |= Q(id=product_id, stock_stripes=0, stock__gte=qty)
+
+    striped = {}
+    try:
+        with transaction.atomic():
+            updated = Product.objects.filter(condition).update(
+                stock=F('stock') - _per_product(quantities),
+                # Delta catalog syncs pick up stock changes by updated_at
+                updated_at=timezone.now(),
+            )
+            if updated != len(quantities):
+                striped = striped_products(quantities)
+                if updated != len(quantities) - len(striped):
+                    raise InsufficientStock([])
+                # In id order, so two orders never wait on each other's stripes
+                for product_id in sorted(striped):
+                    if not _take_from_stripes(product_id, quantities[product_id]):
+                        raise InsufficientStock([])
+    except InsufficientStock:
+        metrics.STOCK_CONFLICTS.inc()
+        # The savepoint is rolled back, so stock read here is the real availability
+        raise InsufficientStock(_shortfall_errors(quantities))
+
+    if updated:
+        # Striped products are checked when compaction updates their stock
+        low_stock.record_reserved({pk: qty for pk, qty in quantities.items() if pk not in striped})
+        invalidate_on_commit()
+
+
+def release(items):
+    """
+    Give back stock for order items (any number of orders) with one grouped
+    UPDATE, plus one per striped product. Record the orders' movements with
+    record_movements('release', orders).
+
+    Returns the number of units restored.
+    """
+    quantities = quantities_by_product(items)
+    if not quantities:
+        return 0
+
+    updated = Product.objects.filter(id__in=quantities, stock_stripes=0).update(
+        stock=F('stock') + _per_product(quantities),
+        updated_at=timezone.now(),
+    )
+    if updated != len(quantities):
+        for product_id, stripes in sorted(striped_products(quantities).items()):
+            _add_to_stripes(product_id, stripes, quantities[product_id])
+    invalidate_on_commit()
+    return sum(quantities.values())
+
+
+def set_stock(levels):
+    """
+    Set products to the stock an admin counted ({product id: units}), and
+    record each difference as a restock (more units) or an adjustment
+    (fewer). Striped products get the new total spread over their stripes.
+
+    Returns {product id: change} for the products that changed.
+    """
+    with transaction.atomic():
+        stripes = dict(
+            Product.objects.select_for_update().filter(id__in=levels).order_by('id')
+            .values_list('id', 'stock_stripes')
+        )
+        # Lock the stripes too, so no reservation lands between the read and the write
+        list(
+            StockStripe.objects.select_for_update().filter(product_id__in=[pk for pk, n in stripes.items() if n])
+            .order_by('product_id', 'stripe').values_list('id', flat=True)
+        )
+        current = available(stripes)
+        changes = {pk: levels[pk] - current[pk] for pk in stripes if levels[pk] != current[pk]}
+        if not changes:
+            return changes
+
+        for product_id in changes:
+            if stripes[product_id]:
+                write_stripes(product_id, spread(levels[product_id], stripes[product_id]))
+        Product.objects.filter(id__in=changes).update(
+            stock=_per_product({pk: levels[pk] for pk in changes}),
+            updated_at=timezone.now(),
+        )
+        StockMovement.objects.bulk_create([
+            StockMovement(product_id=product_id, kind='restock' if change > 0 else 'adjust', quantity=change)
+            for product_id, change in changes.items()
+        ])
+        low_stock.record_changes({pk: (current[pk], levels[pk]) for pk in changes})
+        invalidate_on_commit()
+    return changes
+
+
+def record_restock(product):
+    """Record the opening stock of a newly created product"""
+    if product.stock:
+        StockMovement.objects.create(product_id=product.pk, kind='restock', quantity=product.stock)
+
+
+def record_movements(kind, orders):
+    """
+    Write the ledger rows for orders whose stock was just reserved or
+    released (Order instances or rows with the same attribute names). Call
+    it in the same transaction, after reserve() or release().
+    """
+    sign = -1 if kind == 'reserve' else 1
+    StockMovement.objects.bulk_create([
+        StockMovement(product_id=product_id, kind=kind, quantity=sign * qty, order_id=order.order_id)
+        for order in orders
+        for product_id, qty in quantities_by_product(order.items).items()
+    ])
@@ -0,0 +1,267 @@
+"""
+Stock ledger compaction and reconciliation
+
+stock.py appends a StockMovement for every change to stock. compact() runs
+every STOCK_COMPACT_INTERVAL seconds in the process_expired_orders scheduler
+(compact_stock runs it once) and, for each product that moved:
+
+- writes the stripes' total of a striped product into Product.stock, so the
+  catalog and the admin panel see it, and evens its stripes out again
+- stripes a product taking STOCK_HOT_RATE or more reservations a minute into
+  STOCK_STRIPES counters, and folds it back into Product.stock once it is
+  quiet again
+- writes a StockSnapshot: the product's stock and the last movement it
+  includes
+
+Each product is compacted in its own short transaction holding its row and
+stripe locks, so no reservation is half-way through while it is read.
+
+reconcile() checks that consecutive snapshots differ by exactly the
+movements between them, and that each product's stock is its latest
+snapshot plus the movements since. Stock changed behind the ledger's back
+(a raw UPDATE of Product.stock) shows up as drift.
+"""
+
+import logging
+from collections import namedtuple
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Exists, Max, OuterRef, Q, Sum
+from django.utils import timezone
+
+from . import low_stock
+from .catalog import invalidate_catalog
+from .models import Product, StockMovement, StockSnapshot, StockStripe
+from .stock import spread, write_stripes
+
+
+logger = logging.getLogger(__name__)
+
+WATERMARK_KEY = 'stock-ledger:watermark'
+# Movement ids can commit out of order, so also look at the last GRACE of them
+GRACE = timedelta(seconds=30)
+HOT_WINDOW = timedelta(minutes=1)
+# A striped product is folded back below this share of STOCK_HOT_RATE
+COLD_SHARE = 0.25
+
+RETENTION = timedelta(days=90)
+PRUNE_KEY = 'stock-ledger:prune'
+PRUNE_INTERVAL = 24 * 3600
+
+CompactResult = namedtuple('CompactResult', ['products', 'snapshots', 'striped', 'unstriped'])
+ReconcileResult = namedtuple('ReconcileResult', ['checked', 'unchecked', 'discrepancies'])
+# check is 'history' (two snapshots apart by more or less than the movements
+# between them) or 'live' (stock now vs. the latest snapshot plus movements)
+Discrepancy = namedtuple('Discrepancy', ['product_id', 'check', 'movement_id', 'expected', 'actual'])
+
+
+def reservation_rates(now):
+    """{product id: reservations in the last HOT_WINDOW}"""
+    return dict(
+        StockMovement.objects.filter(kind='reserve', created_at__gte=now - HOT_WINDOW).order_by()
+        .values('product_id').annotate(count=Count('id')).values_list('product_id', 'count')
+    )
+
+
+def stripe_target(current, rate):
+    """How many stripes a product with ``current`` stripes should have at ``rate`` reservations a minute"""
+    if not settings.STOCK_STRIPES:
+        return 0
+    if not settings.STOCK_HOT_RATE:
+        return current
+    threshold = settings.STOCK_HOT_RATE * (COLD_SHARE if current else 1)
+    return settings.STOCK_STRIPES if rate >= threshold else 0
+
+
+def lock_stock(product_id):
+    """
+    Lock a product's row and stripes; returns (stock, stripe quantities) or
+    None if it is gone. Call inside a transaction.
+    """
+    row = (
+        Product.objects.select_for_update().filter(id=product_id)
+        .values_list('stock', 'stock_stripes').first()
+    )
+    if row is None:
+        return None
+    stock, stripes = row
+    quantities = []
+    if stripes:
+        quantities = list(
+            StockStripe.objects.select_for_update().filter(product_id=product_id)
+            .order_by('stripe').values_list('quantity', flat=True)
+        )
+    return stock, quantities
+
+
+def compact_product(product_id, stripes=None, rate=0):
+    """
+    Compact one product (see the module docstring); ``stripes`` forces its
+    stripe count. Returns (stripes before, stripes after, snapshot written)
+    or None if the product is gone.
+    """
+    with transaction.atomic():
+        locked = lock_stock(product_id)
+        if locked is None:
+            return None
+        stock, quantities = locked
+        current = len(quantities)
+        live = sum(quantities) if current else stock
+        if stripes is None:
+            stripes = stripe_target(current, rate)
+
+        if stripes and (stripes != current or max(quantities) - min(quantities) > 1):
+            write_stripes(product_id, spread(live, stripes))
+        elif current and not stripes:
+            StockStripe.objects.filter(product_id=product_id).delete()
+
+        fields = {}
+        if live != stock:
+            fields.update(stock=live, updated_at=timezone.now())
+            low_stock.record_changes({product_id: (stock, live)})
+            transaction.on_commit(invalidate_catalog)
+        if stripes != current:
+            fields['stock_stripes'] = stripes
+        if fields:
+            Product.objects.filter(id=product_id).update(**fields)
+
+        last = StockMovement.objects.filter(product_id=product_id).aggregate(last=Max('id'))['last'] or 0
+        previous = (
+            StockSnapshot.objects.filter(product_id=product_id).order_by('-id')
+            .values_list('stock', 'movement_id').first()
+        )
+        snapshot = previous != (live, last)
+        if snapshot:
+            StockSnapshot.objects.create(product_id=product_id, stock=live, movement_id=last)
+    return current, stripes, snapshot
+
+
+def compact(product_ids=None, stripes=None, now=None):
+    """
+    Compact the products that moved since the last run, the striped ones
+    and the ones without a snapshot yet (or just ``product_ids``).
+    ``stripes`` forces their stripe count instead of going by reservation
+    rate. Returns CompactResult(products, snapshots, striped, unstriped).
+    """
+    now = now or timezone.now()
+    watermark = None
+    if product_ids is None:
+        since = cache.get(WATERMARK_KEY, 0)
+        moved = StockMovement.objects.filter(Q(id__gt=since) | Q(created_at__gte=now - GRACE)).order_by()
+        watermark = moved.aggregate(last=Max('id'))['last']
+        product_ids = set(moved.values_list('product_id', flat=True).distinct())
+        product_ids |= set(
+            Product.objects.filter(
+                Q(stock_stripes__gt=0) | ~Exists(StockSnapshot.objects.filter(product_id=OuterRef('pk')))
+            ).values_list('id', flat=True)
+        )
+
+    rates = reservation_rates(now) if stripes is None else {}
+    products = snapshots = striped = unstriped = 0
+    for product_id in sorted(product_ids):
+        outcome = compact_product(product_id, stripes, rates.get(product_id, 0))
+        if outcome is None:
+            continue
+        before, after, snapshot = outcome
+        products += 1
+        snapshots += snapshot
+        if after and not before:
+            striped += 1
+            logger.info("Striped product %s into %d stock counters", product_id, after)
+        elif before and not after:
+            unstriped += 1
+            logger.info("Folded product %s back into one stock counter", product_id)
+
+    if watermark:
+        cache.set(WATERMARK_KEY, watermark, None)
+    if cache.add(PRUNE_KEY, True, PRUNE_INTERVAL):
+        prune(now)
+    return CompactResult(products, snapshots, striped, unstriped)
+
+
+def prune(now=None):
+    """
+    Delete ledger rows older than RETENTION: snapshots except each
+    product's latest, and movements a later snapshot already includes.
+    Returns (snapshots, movements) deleted.
+    """
+    cutoff = (now or timezone.now()) - RETENTION
+    latest = StockSnapshot.objects.order_by().values('product_id').annotate(latest=Max('id')).values('latest')
+    snapshots = StockSnapshot.objects.filter(taken_at__lt=cutoff).exclude(id__in=latest).delete()[0]
+    covered = StockSnapshot.objects.filter(product_id=OuterRef('product_id'), movement_id__gte=OuterRef('id'))
+    movements = StockMovement.objects.filter(Exists(covered), created_at__lt=cutoff).delete()[0]
+    return snapshots, movements
+
+
+def check_history(product_id, snapshots):
+    """Compare each of a product's snapshots with the previous one plus the movements between them"""
+    discrepancies = []
+    movement_id, expected = snapshots[0]
+    pending = iter(snapshots[1:])
+    checkpoint = next(pending, None)
+    movements = (
+        StockMovement.objects.filter(product_id=product_id, id__gt=movement_id, id__lte=snapshots[-1][0])
+        .order_by('id').values_list('id', 'quantity')
+    )
+    for movement_id, quantity in [*movements.iterator(), (None, 0)]:
+        while checkpoint is not None and (movement_id is None or movement_id > checkpoint[0]):
+            if checkpoint[1] != expected:
+                discrepancies.append(Discrepancy(product_id, 'history', checkpoint[0], expected, checkpoint[1]))
+            # Carry on from the snapshot, so one bad change is reported once
+            expected = checkpoint[1]
+            checkpoint = next(pending, None)
+        expected += quantity
+    return discrepancies
+
+
+def check_live(product_id, snapshot):
+    """Compare a product's stock now with its latest snapshot plus the movements since; None if it is gone"""
+    movement_id, stock = snapshot
+    with transaction.atomic():
+        locked = lock_stock(product_id)
+        if locked is None:
+            return None
+        since = StockMovement.objects.filter(product_id=product_id, id__gt=movement_id).aggregate(
+            total=Sum('quantity'), last=Max('id')
+        )
+    row_stock, quantities = locked
+    live = sum(quantities) if quantities else row_stock
+    expected = stock + (since['total'] or 0)
+    if live != expected:
+        return Discrepancy(product_id, 'live', since['last'] or movement_id, expected, live)
+    return False
+
+
+def reconcile(product_ids=None):
+    """
+    Check the ledger of every product (or just ``product_ids``) against its
+    snapshots and its stock. Products without a snapshot yet are counted as
+    unchecked. Returns ReconcileResult(checked, unchecked, discrepancies).
+    """
+    products = Product.objects.all()
+    snapshots = StockSnapshot.objects.order_by('product_id', 'id')
+    if product_ids is not None:
+        products = products.filter(id__in=product_ids)
+        snapshots = snapshots.filter(product_id__in=product_ids)
+
+    history = {}
+    for product_id, movement_id, stock in snapshots.values_list('product_id', 'movement_id', 'stock').iterator():
+        history.setdefault(product_id, []).append((movement_id, stock))
+
+    checked = unchecked = 0
+    discrepancies = []
+    for product_id in products.order_by('id').values_list('id', flat=True):
+        if product_id not in history:
+            unchecked += 1
+            continue
+        discrepancies += check_history(product_id, history[product_id])
+        discrepancy = check_live(product_id, history[product_id][-1])
+        if discrepancy is None:
+            continue
+        checked += 1
+        if discrepancy:
+            discrepancies.append(discrepancy)
+    return ReconcileResult(checked, unchecked, discrepancies)
@@ -0,0 +1,55 @@
+"""
+Static files storage for the frontend
+
+collectstatic minifies the frontend's own CSS and JavaScript, then WhiteNoise's
+CompressedManifestStaticFilesStorage gives every file a content-hashed name
+(styles.css -> styles.3f2a1b9c0d4e.css), rewrites the references to it and
+writes gzip and brotli copies next to it. Templates link assets through
+{% static %}, which resolves the hashed name from the manifest; WhiteNoise
+serves hashed files with a one-year immutable Cache-Control, so a browser
+downloads each version once, compressed.
+"""
+
+from pathlib import Path
+
+import rcssmin
+import rjsmin
+from django.conf import settings
+from django.core.files.base import ContentFile
+from whitenoise.storage import CompressedManifestStaticFilesStorage
+
+
+MINIFIERS = {
+    '.css': rcssmin.cssmin,
+    '.js': rjsmin.jsmin,
+}
+
+
+def is_frontend_file(source_storage):
+    """True for files collected from STATICFILES_DIRS (not from Django or DRF's apps)"""
+    location = getattr(source_storage, 'location', None)
+    if location is None:
+        return False
+    return any(Path(location).resolve() == Path(directory).resolve() for directory in settings.STATICFILES_DIRS)
+
+
+class FrontendStaticFilesStorage(CompressedManifestStaticFilesStorage):
+    """Minify, fingerprint and precompress (see the module docstring)"""
+
+    def post_process(self, paths, dry_run=False, **options):
+        if not dry_run:
+            paths = dict(paths)
+            for path, (source_storage, source_path) in paths.items():
+                minify = MINIFIERS.get(Path(path).suffix)
+                if minify and not path.endswith(('.min.css', '.min.js')) and is_frontend_file(source_storage):
+                    self.minify(path, source_storage, source_path, minify)
+                    # Hash and compress the minified copy rather than the source
+                    paths[path] = (self, path)
+        yield from super().post_process(paths, dry_run, **options)
+
+    def minify(self, path, source_storage, source_path, minify):
+        # Always start from the source: the collected copy may be minified already
+        with source_storage.open(source_path) as source:
+            text = source.read().decode('utf-8')
+        self.delete(path)
+        self._save(path, ContentFile(minify(text).encode('utf-8')))
@@ -0,0 +1,132 @@
+"""
+Live board: one Telegram message for a rush's orders
+
+Telegram accepts about 20 messages a minute in a group, and each order can
+cost three: the new-order message, the "picked" message and the edit of
+the first. When a chat gets TELEGRAM_BOARD_RATE or more new orders a
+minute, the outbox worker puts new orders on a board instead: one message
+listing them, with a pick button for each reserved order. Every queued
+notification about the board's orders (new, picked from the admin panel or
+from the board's buttons) is delivered as one edit of that message. While
+the rate limiter holds the chat back, notifications pile up and the next
+edit covers all of them.
+
+A board holds BOARD_SIZE orders; the next order starts a new one. Once new
+orders fall below QUIET_SHARE of the rate, each gets its own message again.
+Orders already on a board stay on it and it is still edited when they
+change, so every order keeps a reachable pick button.
+"""
+
+import html
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Order, TelegramBoard, TelegramOutbox
+
+
+# Outbox kinds about one order that a board edit stands in for
+BOARD_KINDS = {'order_created', 'order_picked', 'order_picked_edit', 'board_refresh'}
+# Keeps a board well inside Telegram's 4096 characters and 100 buttons
+BOARD_SIZE = 20
+BUTTONS_PER_ROW = 2
+RATE_WINDOW = timedelta(minutes=1)
+# An open board closes once new orders fall below this share of TELEGRAM_BOARD_RATE
+QUIET_SHARE = 0.5
+
+STATUS_MARKS = {
+    'picked': '✅',
+    'completed': '🏁',
+    'cancelled': '❌',
+}
+
+
+def order_rate(chat_id, now):
+    """New-order notifications queued for the chat in the last RATE_WINDOW"""
+    return TelegramOutbox.objects.filter(
+        chat_id=chat_id, kind='order_created', created_at__gte=now - RATE_WINDOW
+    ).count()
+
+
+def is_busy(chat_id, board_open, now):
+    """True if the chat's new orders should go on a board"""
+    if not settings.TELEGRAM_BOARD_RATE:
+        return False
+    threshold = settings.TELEGRAM_BOARD_RATE * (QUIET_SHARE if board_open else 1)
+    return order_rate(chat_id, now) >= threshold
+
+
+def board_for(row, now=None):
+    """The board an outbox row is delivered on, or None to send it on its own"""
+    if row.kind not in BOARD_KINDS or row.order_id is None:
+        return None
+    board_id = Order.objects.filter(pk=row.order_id).values_list('telegram_board_id', flat=True).first()
+    if board_id:
+        return TelegramBoard.objects.filter(pk=board_id).first()
+    if row.kind != 'order_created':
+        return None
+
+    boards = TelegramBoard.objects.filter(chat_id=row.chat_id, open=True)
+    current = boards.order_by('-id').first()
+    if not is_busy(row.chat_id, current is not None, now or timezone.now()):
+        boards.update(open=False)
+        return None
+    if current is None or current.orders.count() >= BOARD_SIZE:
+        boards.update(open=False)
+        current = TelegramBoard.objects.create(chat_id=row.chat_id)
+    return current
+
+
+def collect(board, row):
+    """
+    Put ``row``'s order and the chat's other waiting new orders on ``board``
+    (while it is open and has room). Returns the ids of the other pending
+    outbox rows about the board's orders, which the board edit delivers too.
+    """
+    pending = TelegramOutbox.objects.filter(status='pending', chat_id=row.chat_id, kind__in=BOARD_KINDS)
+    # No transaction: each step stands on its own, and a read-then-write
+    # transaction would fail at once on a busy SQLite database
+    if board.open:
+        Order.objects.filter(pk=row.order_id, telegram_board__isnull=True).update(telegram_board=board)
+        room = BOARD_SIZE - board.orders.count()
+        waiting = (
+            pending.filter(kind='order_created', order__isnull=False, order__telegram_board__isnull=True)
+            .order_by('id').values_list('order_id', flat=True)
+        )
+        if room > 0:
+            Order.objects.filter(pk__in=list(waiting[:room])).update(telegram_board=board)
+    return list(pending.filter(order__telegram_board=board).exclude(pk=row.pk).values_list('pk', flat=True))
+
+
+def clip(text, width):
+    text = ' '.join(str(text).split())
+    return text if len(text) <= width else text[:width - 1] + '…'
+
+
+def order_line(order):
+    summary = f"<b>{order.order_id}</b> · Room {html.escape(clip(order.room_number, 20))}"
+    if order.status != 'reserved':
+        return f"{STATUS_MARKS.get(order.status, '•')} {summary} · {order.status}"
+    items = ', '.join(f"{item['qty']}× {item['name']}" for item in order.items)
+    return (
+        f"🆕 {summary} · ₹{order.total_amount} · {html.escape(clip(order.customer_name, 24))}\n"
+        f"      {html.escape(clip(items, 60))} · ⏰ {order.expires_at.strftime('%H:%M:%S')}"
+    )
+
+
+def render(board):
+    """(text, reply_markup) of the board for its orders' current state"""
+    orders = list(board.orders.order_by('created_at', 'order_id'))
+    reserved = [order for order in orders if order.status == 'reserved']
+    text = f"""
+📋 <b>Live orders</b>: {len(reserved)} to pick, {len(orders) - len(reserved)} done
+
+{chr(10).join(order_line(order) for order in orders)}
+"""
+    buttons = [
+        {"text": f"✅ {order.order_id} · Room {clip(order.room_number, 12)}", "callback_data": f"pick_{order.order_id}"}
+        for order in reserved
+    ]
+    keyboard = [buttons[start:start + BUTTONS_PER_ROW] for start in range(0, len(buttons), BUTTONS_PER_ROW)]
+    return text, {"inline_keyboard": keyboard}
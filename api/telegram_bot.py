@@ -4,31 +4,108 @@ Telegram Bot Integration for GoGrabit
 Set these environment variables:
 - TELEGRAM_BOT_TOKEN: Your bot token from @BotFather
 - TELEGRAM_CHAT_ID: Chat ID where notifications will be sent
+- TELEGRAM_API_BASE: Bot API base URL (optional, e.g. a local fake server)
+
+Notifications are not sent inline: they are written to the TelegramOutbox
+table in the caller's transaction and delivered by the telegram_worker
+management command (see telegram_outbox.py).
 """
 
+import html
 import os
+import threading
+import time
+from datetime import timedelta
 import httpx
 from urllib.parse import quote
 
+from . import metrics
+
 
 # Get configuration from environment
 BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN', '')
 CHAT_ID = os.environ.get('TELEGRAM_CHAT_ID', '')
+API_BASE = os.environ.get('TELEGRAM_API_BASE', 'https://api.telegram.org')
 
 
-def _send_telegram_request(method, data):
-    """Send synchronous request to Telegram API"""
-    if not BOT_TOKEN:
-        return None
-    
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/{method}"
+class TelegramAPIError(Exception):
+    """Failed Bot API call; retry_after is set when Telegram asks us to slow down"""
+
+    def __init__(self, message, retry_after=None, permanent=False):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.permanent = permanent
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Shared keep-alive HTTP client (one connection pool per process)"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = httpx.Client(
+                timeout=httpx.Timeout(10.0, connect=5.0),
+                limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
+            )
+    return _client
+
+
+def call_api(method, data, client=None):
+    """Call a Bot API method and return its ``result``, raising TelegramAPIError on failure"""
+    url = f"{API_BASE}/bot{BOT_TOKEN}/{method}"
+    started = time.perf_counter()
     try:
-        response = httpx.post(url, json=data, timeout=10.0)
-        response.raise_for_status()
-        return response.json()
-    except Exception as e:
-        print(f"Telegram error: {e}")
-        return None
+        response = (client or get_client()).post(url, json=data)
+    except httpx.HTTPError as e:
+        metrics.TELEGRAM_CALLS.inc(method=method, outcome='network_error')
+        raise TelegramAPIError(f"{type(e).__name__}: {e}")
+    finally:
+        metrics.TELEGRAM_SECONDS.observe(time.perf_counter() - started, method=method)
+    return _result(method, response)
+
+
+def _result(method, response):
+    outcome = 'ok' if response.status_code == 200 else str(response.status_code)
+    metrics.TELEGRAM_CALLS.inc(method=method, outcome=outcome)
+
+    try:
+        body = response.json()
+    except ValueError:
+        body = {}
+
+    if response.status_code == 429:
+        retry_after = (body.get('parameters') or {}).get('retry_after', 1)
+        raise TelegramAPIError(body.get('description', 'Too Many Requests'), retry_after=retry_after)
+    if response.status_code >= 500:
+        raise TelegramAPIError(f"HTTP {response.status_code}")
+    if not body.get('ok'):
+        # Other 4xx errors (bad request, chat not found, ...) will not succeed on retry
+        raise TelegramAPIError(body.get('description', f"HTTP {response.status_code}"), permanent=True)
+    return body.get('result')
+
+
+def enqueue(kind, method, data, order=None, chat_id=None, delay=None):
+    """
+    Queue a Bot API call in the outbox (call inside the transaction it belongs to).
+    chat_id defaults to the payload's; calls without one (e.g. answerCallbackQuery)
+    can name the chat they should be ordered with. ``delay`` holds it back
+    for that many seconds.
+    """
+    from django.utils import timezone
+    from .models import TelegramOutbox
+    
+    extra = {'next_attempt_at': timezone.now() + timedelta(seconds=delay)} if delay else {}
+    return TelegramOutbox.objects.create(
+        kind=kind,
+        method=method,
+        chat_id=str(chat_id or data.get('chat_id', CHAT_ID)),
+        payload=data,
+        order=order,
+        **extra
+    )
 
 
 def send_order_notification(order):
@@ -73,16 +150,12 @@ def send_order_notification(order):
             "reply_markup": inline_keyboard
         }
         
-        result = _send_telegram_request("sendMessage", data)
-        
-        if result and result.get('ok'):
-            # Store message ID for later editing
-            order.telegram_message_id = result['result']['message_id']
-            order.save()
-            print(f"Telegram notification sent for order {order.order_id}")
+        # The worker stores the sent message ID on the order for later editing
+        enqueue('order_created', 'sendMessage', data, order=order)
         
     except Exception as e:
-        print(f"Error sending Telegram notification: {e}")
+        print(f"Error queueing Telegram notification: {e}")
+        raise
 
 
 def send_order_picked_notification(order):
@@ -107,71 +180,56 @@ Status: <b>PICKED - Ready for payment</b>
             "parse_mode": "HTML"
         }
         
-        _send_telegram_request("sendMessage", data)
-        
-        # Edit original message if exists
-        if order.telegram_message_id:
-            edit_message(CHAT_ID, order.telegram_message_id, f"✅ Order {order.order_id} - <b>PICKED</b>")
+        enqueue('order_picked', 'sendMessage', data, order=order)
         
-    except Exception as e:
-        print(f"Error sending picked notification: {e}")
-
-
-def answer_callback_query(callback_query_id, text):
-    """Answer callback query from button press"""
-    if not BOT_TOKEN:
-        return
-    
-    try:
-        data = {
-            "callback_query_id": callback_query_id,
-            "text": text
-        }
-        _send_telegram_request("answerCallbackQuery", data)
-    except Exception as e:
-        print(f"Error answering callback: {e}")
-
-
-def edit_message(chat_id, message_id, text):
-    """Edit existing message"""
-    if not BOT_TOKEN:
-        return
-    
-    try:
-        data = {
-            "chat_id": chat_id,
-            "message_id": message_id,
-            "text": text,
+        # Edit the original message; the worker fills in its message_id at send
+        # time, since the "new order" message may still be in the outbox
+        enqueue('order_picked_edit', 'editMessageText', {
+            "chat_id": CHAT_ID,
+            "message_id": order.telegram_message_id,
+            "text": f"✅ Order {order.order_id} - <b>PICKED</b>",
             "parse_mode": "HTML"
-        }
-        _send_telegram_request("editMessageText", data)
+        }, order=order)
+        
     except Exception as e:
-        print(f"Error editing message: {e}")
+        print(f"Error queueing picked notification: {e}")
+        raise
 
 
-def send_low_stock_alert(product):
-    """Send low stock alert"""
+def send_low_stock_alert(product, stock, threshold):
+    """
+    Queue a low stock alert. The worker holds it for LOW_STOCK_DIGEST_INTERVAL
+    and sends it in one digest with the chat's other alerts (see low_stock.py).
+    """
     if not BOT_TOKEN or not CHAT_ID:
         return
     
-    try:
-        message = f"""
-⚠️ <b>Low Stock Alert</b>
-
-Product: {product.name}
-Category: {product.category}
-Current Stock: <b>{product.stock}</b>
+    from django.conf import settings
+    data = {
+        "chat_id": CHAT_ID,
+        "parse_mode": "HTML",
+        "product": {
+            "id": product.id,
+            "name": product.name,
+            "category": product.category,
+            "stock": stock,
+            "threshold": threshold,
+        },
+    }
+    enqueue('low_stock', 'sendMessage', data, delay=settings.LOW_STOCK_DIGEST_INTERVAL)
+
+
+def format_low_stock_digest(products):
+    """Digest text for a list of {name, category, stock, threshold} dicts, lowest stock first"""
+    lines = [
+        f"  • {html.escape(product['name'])} ({html.escape(product['category'])}): "
+        f"<b>{product['stock']}</b> left (alert at {product['threshold']})"
+        for product in sorted(products, key=lambda product: (product['stock'], product['name']))
+    ]
+    return f"""
+⚠️ <b>Low Stock: {len(products)} product(s)</b>
+
+{chr(10).join(lines)}
 
 Please restock soon!
 """
-        
-        data = {
-            "chat_id": CHAT_ID,
-            "text": message,
-            "parse_mode": "HTML"
-        }
-        
-        _send_telegram_request("sendMessage", data)
-        
-    except Exception as e:
-        print(f"Error sending stock alert: {e}")
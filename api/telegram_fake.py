@@ -0,0 +1,175 @@
+"""
+Local fake of the Telegram Bot API, for development and load tests
+
+Point TELEGRAM_API_BASE at it (e.g. http://127.0.0.1:8081). It accepts the
+methods GoGrabit uses, records every call, and can add latency, random
+failures and Telegram-style per-chat rate limits (HTTP 429 + retry_after).
+It keeps each message's current text and buttons, and refuses edits of
+unknown messages or edits that change nothing, as Telegram does. GET /calls
+returns the recorded calls as JSON, GET /messages the messages.
+"""
+
+import json
+import random
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+METHOD_PATH = re.compile(r'^/bot(?P<token>[^/]*)/(?P<method>\w+)$')
+SUPPORTED_METHODS = {'sendMessage', 'editMessageText', 'answerCallbackQuery', 'setWebhook', 'getMe'}
+
+
+class FakeTelegramState:
+    def __init__(self, latency=0.0, fail_rate=0.0, rate_limit=None, rate_window=60.0):
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.calls = []
+        self.rejected = 0
+        self.message_ids = defaultdict(int)
+        # (chat id, message id) -> {'text': ..., 'reply_markup': ...}
+        self.messages = {}
+        self.recent = defaultdict(deque)
+        self.lock = threading.Lock()
+
+    def handle(self, method, data):
+        """Return (status, body) for one API call"""
+        if self.latency:
+            time.sleep(self.latency)
+
+        if method not in SUPPORTED_METHODS:
+            return 404, {'ok': False, 'error_code': 404, 'description': 'Not Found: method not found'}
+
+        if self.fail_rate and random.random() < self.fail_rate:
+            return 502, {'ok': False, 'error_code': 502, 'description': 'Bad Gateway'}
+
+        chat_id = str(data.get('chat_id', ''))
+        with self.lock:
+            if self.rate_limit and method in ('sendMessage', 'editMessageText'):
+                now = time.monotonic()
+                window = self.recent[chat_id]
+                while window and now - window[0] >= self.rate_window:
+                    window.popleft()
+                if len(window) >= self.rate_limit:
+                    self.rejected += 1
+                    retry_after = max(1, int(self.rate_window - (now - window[0])) + 1)
+                    return 429, {
+                        'ok': False,
+                        'error_code': 429,
+                        'description': f'Too Many Requests: retry after {retry_after}',
+                        'parameters': {'retry_after': retry_after},
+                    }
+                window.append(now)
+
+            if method == 'editMessageText':
+                key = (chat_id, data.get('message_id'))
+                content = {'text': data.get('text'), 'reply_markup': data.get('reply_markup')}
+                if key not in self.messages:
+                    return 400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: message to edit not found'}
+                if self.messages[key] == content:
+                    return 400, {
+                        'ok': False,
+                        'error_code': 400,
+                        'description': 'Bad Request: message is not modified',
+                    }
+
+            self.calls.append({'method': method, 'data': data, 'time': time.time()})
+
+            if method == 'sendMessage':
+                self.message_ids[chat_id] += 1
+                message_id = self.message_ids[chat_id]
+                self.messages[(chat_id, message_id)] = {'text': data.get('text'), 'reply_markup': data.get('reply_markup')}
+                return 200, {'ok': True, 'result': {'message_id': message_id, 'chat': {'id': chat_id}}}
+            if method == 'editMessageText':
+                # Like Telegram, an edit without reply_markup removes the buttons
+                self.messages[key] = content
+                return 200, {'ok': True, 'result': {'message_id': data.get('message_id'), 'chat': {'id': chat_id}}}
+            return 200, {'ok': True, 'result': True}
+
+    def buttons(self, chat_id):
+        """{callback_data: message id} for the buttons now showing in a chat"""
+        chat_id = str(chat_id)
+        with self.lock:
+            return {
+                button['callback_data']: message_id
+                for (message_chat_id, message_id), content in self.messages.items() if message_chat_id == chat_id
+                for row in (content['reply_markup'] or {}).get('inline_keyboard', [])
+                for button in row if 'callback_data' in button
+            }
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _reply(self, status, body):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path == '/calls':
+                with state.lock:
+                    self._reply(200, {'calls': state.calls, 'rejected': state.rejected})
+            elif self.path == '/messages':
+                with state.lock:
+                    messages = [
+                        {'chat_id': chat_id, 'message_id': message_id, **content}
+                        for (chat_id, message_id), content in state.messages.items()
+                    ]
+                self._reply(200, {'messages': messages})
+            else:
+                self._reply(404, {'ok': False, 'description': 'Not Found'})
+
+        def do_POST(self):
+            match = METHOD_PATH.match(self.path)
+            length = int(self.headers.get('Content-Length') or 0)
+            try:
+                data = json.loads(self.rfile.read(length) or b'{}')
+            except ValueError:
+                return self._reply(400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: invalid JSON'})
+            if not match:
+                return self._reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+            self._reply(*state.handle(match.group('method'), data))
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+class FakeTelegramServer:
+    """Run the fake API in a background thread: ``with FakeTelegramServer() as server: server.url``"""
+
+    def __init__(self, host='127.0.0.1', port=0, **options):
+        self.state = FakeTelegramState(**options)
+        self.httpd = ThreadingHTTPServer((host, port), make_handler(self.state))
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,344 @@
+"""
+Telegram outbox worker
+
+Drains TelegramOutbox rows over one pooled keep-alive HTTP client. Rows for
+the same chat are delivered strictly in order. Each chat is rate limited
+(Telegram allows about 20 messages a minute in a group), failures are
+retried with exponential backoff, and a circuit breaker stops hammering the
+API while it is down. Each pass first handles pending webhook updates (see
+telegram_updates.py), whose replies are queued here too.
+
+Rows of a DIGEST_KINDS kind are queued with a delay and don't hold back
+their chat while they wait. When the first is due, every pending row of that
+kind for the chat goes out as one message (see low_stock.py).
+
+When a chat is busy, order notifications are delivered as edits of one
+live board message instead of a message each (see telegram_board.py).
+
+Per-chat order, the rate limits and the circuit breaker live in the worker,
+so only one worker may drain the outbox: run() holds a lease in the shared
+cache, renewed before each delivery, and a second worker stands by until
+the lease lapses. It also deletes delivered rows and handled updates older
+than RETENTION once a day.
+"""
+
+import logging
+import random
+import time
+import uuid
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Min, Q
+from django.utils import timezone
+
+from . import low_stock, metrics, telegram_board, telegram_bot
+from .models import Order, TelegramBoard, TelegramOutbox, TelegramUpdate
+from .telegram_updates import process_pending_updates
+
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 8
+# Only messages count against a chat's rate limit (not e.g. answerCallbackQuery)
+RATE_LIMITED_METHODS = {'sendMessage', 'editMessageText'}
+BACKOFF_BASE = 2.0
+BACKOFF_MAX = 300.0
+DIGEST_KINDS = {'low_stock'}
+
+LEASE_KEY = 'telegram-outbox:lease'
+# Longer than one delivery can take (the client's timeout), as it is renewed before each
+LEASE_TIMEOUT = 60
+
+RETENTION = timedelta(days=7)
+PRUNE_KEY = 'telegram-outbox:prune'
+PRUNE_INTERVAL = 24 * 3600
+
+
+class RateLimiter:
+    """Token bucket per chat: ``rate`` messages per ``per`` seconds, bursting up to ``burst``"""
+
+    def __init__(self, rate=20, per=60.0, burst=3):
+        self.rate = rate / per
+        self.burst = burst
+        self.buckets = {}
+
+    def delay(self, chat_id):
+        """Seconds until the chat may send again (0 if it may send now)"""
+        tokens, updated = self.buckets.get(chat_id, (self.burst, time.monotonic()))
+        tokens = min(self.burst, tokens + (time.monotonic() - updated) * self.rate)
+        self.buckets[chat_id] = (tokens, time.monotonic())
+        return 0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def consume(self, chat_id):
+        tokens, updated = self.buckets[chat_id]
+        self.buckets[chat_id] = (tokens - 1, updated)
+
+    def penalize(self, chat_id, seconds):
+        """Telegram returned retry_after: empty the bucket for that long"""
+        self.buckets[chat_id] = (-seconds * self.rate, time.monotonic())
+
+
+class CircuitBreaker:
+    """Open after ``threshold`` consecutive failures; allow one trial call after ``cooldown``"""
+
+    def __init__(self, threshold=5, cooldown=30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        return time.monotonic() - self.opened_at >= self.cooldown
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+
+def prune(now=None):
+    """
+    Delete outbox rows delivered or given up on, and webhook updates handled,
+    more than RETENTION ago. Returns (outbox rows, updates) deleted.
+    """
+    cutoff = (now or timezone.now()) - RETENTION
+    outbox = TelegramOutbox.objects.filter(status__in=['sent', 'failed'], created_at__lt=cutoff).delete()[0]
+    updates = TelegramUpdate.objects.filter(status__in=['done', 'failed'], received_at__lt=cutoff).delete()[0]
+    return outbox, updates
+
+
+def backoff(attempts):
+    """Exponential backoff with jitter, in seconds"""
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** (attempts - 1)))
+    return delay * random.uniform(0.8, 1.2)
+
+
+class OutboxWorker:
+    def __init__(self, client=None, limiter=None, breaker=None, batch_size=100):
+        self.client = client or telegram_bot.get_client()
+        self.limiter = limiter or RateLimiter()
+        self.breaker = breaker or CircuitBreaker()
+        self.batch_size = batch_size
+        self.sent = 0
+        self.failed = 0
+        self.lease = None
+
+    def acquire_lease(self):
+        """Take or renew the lease on the outbox; False while another worker holds it"""
+        token = self.lease or uuid.uuid4().hex
+        if cache.add(LEASE_KEY, token, LEASE_TIMEOUT):
+            self.lease = token
+            return True
+        if self.lease and cache.get(LEASE_KEY) == self.lease and cache.touch(LEASE_KEY, LEASE_TIMEOUT):
+            return True
+        self.lease = None
+        return False
+
+    def release_lease(self):
+        if self.lease and cache.get(LEASE_KEY) == self.lease:
+            cache.delete(LEASE_KEY)
+        self.lease = None
+
+    def prepare(self, row):
+        """Fill in data only known at send time; returns None if the call is moot"""
+        payload = dict(row.payload)
+        if row.kind == 'order_picked_edit' and not payload.get('message_id'):
+            message_id = Order.objects.filter(pk=row.order_id).values_list('telegram_message_id', flat=True).first()
+            if not message_id:
+                return None
+            payload['message_id'] = message_id
+        if row.kind == 'board_refresh':
+            # Only reached once its board is gone
+            return None
+        if row.kind == 'low_stock':
+            return self.prepare_low_stock(row, payload)
+        return payload
+
+    def prepare_low_stock(self, row, payload):
+        """Fold the chat's pending low stock alerts into one digest of the products still low"""
+        others = list(
+            TelegramOutbox.objects.filter(status='pending', kind='low_stock', chat_id=row.chat_id)
+            .exclude(pk=row.pk).order_by('id')
+        )
+        # mark_sent marks the folded rows sent along with this one
+        row.merged = [other.pk for other in others]
+        products = {}
+        for alert in [row, *others]:
+            products[alert.payload['product']['id']] = alert.payload['product']
+        stock = low_stock.still_low(list(products))
+        if not stock:
+            # All restocked while the digest waited
+            return None
+        payload.pop('product')
+        payload['text'] = telegram_bot.format_low_stock_digest([
+            {**products[product_id], 'stock': units} for product_id, units in stock.items()
+        ])
+        return payload
+
+    def deliver(self, row):
+        """Send one row and record the outcome; returns False if the chat must wait"""
+        board = telegram_board.board_for(row)
+        if board is not None:
+            return self.deliver_board(row, board)
+
+        payload = self.prepare(row)
+        if payload is None:
+            self.mark_sent(row, None)
+            return True
+
+        try:
+            result = telegram_bot.call_api(row.method, payload, client=self.client)
+        except telegram_bot.TelegramAPIError as e:
+            self.record_failure(row, e)
+            return False
+
+        self.breaker.record_success()
+        if row.method in RATE_LIMITED_METHODS:
+            self.limiter.consume(row.chat_id)
+        message_id = result.get('message_id') if isinstance(result, dict) else None
+        self.mark_sent(row, message_id)
+        return True
+
+    def deliver_board(self, row, board):
+        """Deliver ``row`` and the chat's other pending rows about the board's orders as one board edit"""
+        row.merged = telegram_board.collect(board, row)
+        text, reply_markup = telegram_board.render(board)
+        if board.message_id is None or text != board.text:
+            payload = {"chat_id": board.chat_id, "text": text, "parse_mode": "HTML", "reply_markup": reply_markup}
+            method = 'sendMessage'
+            if board.message_id is not None:
+                method = 'editMessageText'
+                payload['message_id'] = board.message_id
+
+            try:
+                result = telegram_bot.call_api(method, payload, client=self.client)
+            except telegram_bot.TelegramAPIError as e:
+                if e.permanent and board.message_id is not None:
+                    # The board message is gone (deleted, or too old to edit): post it again
+                    logger.info("Telegram board %s could not be edited (%s); posting it again", board.pk, e)
+                    TelegramBoard.objects.filter(pk=board.pk).update(message_id=None, text='')
+                    return False
+                self.record_failure(row, e)
+                return False
+
+            self.breaker.record_success()
+            self.limiter.consume(row.chat_id)
+            if board.message_id is None and isinstance(result, dict):
+                board.message_id = result.get('message_id')
+            board.text = text
+            board.save(update_fields=['message_id', 'text', 'updated_at'])
+            Order.objects.filter(telegram_board=board).update(telegram_message_id=board.message_id)
+
+        metrics.TELEGRAM_BOARD_FOLDED.inc(1 + len(row.merged))
+        self.mark_sent(row, board.message_id)
+        return True
+
+    def mark_sent(self, row, message_id):
+        with transaction.atomic():
+            TelegramOutbox.objects.filter(pk__in=[row.pk, *getattr(row, 'merged', [])]).update(
+                status='sent', sent_at=timezone.now(), attempts=row.attempts + 1, message_id=message_id
+            )
+            if row.kind == 'order_created' and message_id and row.order_id:
+                Order.objects.filter(pk=row.order_id).update(telegram_message_id=message_id)
+        self.sent += 1
+
+    def record_failure(self, row, error):
+        attempts = row.attempts + 1
+        if error.retry_after:
+            # Rate limited: not the API's fault, so do not trip the breaker
+            self.limiter.penalize(row.chat_id, error.retry_after)
+            delay = error.retry_after
+        else:
+            self.breaker.record_failure()
+            delay = backoff(attempts)
+
+        if error.permanent or attempts >= MAX_ATTEMPTS:
+            status = 'failed'
+            self.failed += 1
+            logger.warning("Telegram %s for outbox %s failed permanently: %s", row.method, row.pk, error)
+        else:
+            status = 'pending'
+            logger.info("Telegram %s for outbox %s failed (attempt %s): %s", row.method, row.pk, attempts, error)
+
+        TelegramOutbox.objects.filter(pk=row.pk).update(
+            status=status,
+            attempts=attempts,
+            last_error=str(error)[:1000],
+            next_attempt_at=timezone.now() + timedelta(seconds=delay)
+        )
+
+    def drain_once(self):
+        """
+        Deliver what can be sent now. Returns the seconds to sleep before the
+        next pass (0 if more work is ready).
+        """
+        now = timezone.now()
+        pending = TelegramOutbox.objects.filter(status='pending')
+        # Digest rows waiting for their time don't hold back their chat
+        waiting = Q(kind__in=DIGEST_KINDS, next_attempt_at__gt=now)
+        rows = list(pending.exclude(waiting).order_by('id')[:self.batch_size])
+        digest_at = pending.filter(waiting).aggregate(due=Min('next_attempt_at'))['due']
+        wait = (digest_at - now).total_seconds() if digest_at else None
+        if not rows:
+            return wait
+
+        blocked = set()
+        merged = set()
+        for row in rows:
+            if row.chat_id in blocked or row.pk in merged:
+                continue
+
+            if not self.breaker.allow():
+                return self.breaker.cooldown
+            if self.lease and not self.acquire_lease():
+                # Lost the lease (e.g. stalled past LEASE_TIMEOUT): another worker took over
+                return None
+
+            # Keep per-chat order: an earlier row waiting for a retry holds back later ones
+            delay = max(
+                (row.next_attempt_at - now).total_seconds(),
+                self.limiter.delay(row.chat_id) if row.method in RATE_LIMITED_METHODS else 0
+            )
+            if delay > 0:
+                blocked.add(row.chat_id)
+                wait = delay if wait is None else min(wait, delay)
+                continue
+
+            if not self.deliver(row):
+                blocked.add(row.chat_id)
+            merged.update(getattr(row, 'merged', ()))
+
+        if len(rows) == self.batch_size and len(blocked) < len({row.chat_id for row in rows}):
+            return 0
+        return wait
+
+    def run(self, poll_interval=1.0):
+        standing_by = False
+        try:
+            while True:
+                if not self.acquire_lease():
+                    if not standing_by:
+                        logger.warning("Another Telegram worker holds the outbox; standing by")
+                        standing_by = True
+                    time.sleep(poll_interval)
+                    continue
+                standing_by = False
+
+                process_pending_updates()
+                wait = self.drain_once()
+                if cache.add(PRUNE_KEY, True, PRUNE_INTERVAL):
+                    prune()
+                metrics.registry.maybe_flush()
+                if wait is None:
+                    wait = poll_interval
+                time.sleep(min(max(wait, 0.05), poll_interval))
+        finally:
+            self.release_lease()
@@ -0,0 +1,116 @@
+"""
+Incoming Telegram webhook updates
+
+The webhook only checks the secret token, records the update (one row per
+update_id, so Telegram's retries are dropped) and answers 200. The worker
+then handles pending updates in update_id order, and queues the
+answerCallbackQuery/editMessageText calls in the outbox, which delivers them
+in order per chat.
+"""
+
+import hmac
+import logging
+import os
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .models import Order, TelegramUpdate
+from .telegram_bot import enqueue
+
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+WEBHOOK_SECRET = os.environ.get('TELEGRAM_WEBHOOK_SECRET', '')
+
+
+def verify_secret(request):
+    """True if the request carries the webhook secret (or no secret is configured)"""
+    if not WEBHOOK_SECRET:
+        return True
+    return hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), WEBHOOK_SECRET)
+
+
+def update_chat_id(data):
+    callback = data.get('callback_query') or {}
+    message = callback.get('message') or data.get('message') or {}
+    return str((message.get('chat') or {}).get('id', ''))
+
+
+async def arecord_update(data):
+    """Store an update; returns False if this update_id was already recorded"""
+    try:
+        # A single INSERT, so autocommit is enough (no atomic block needed)
+        await TelegramUpdate.objects.acreate(update_id=data['update_id'], chat_id=update_chat_id(data), payload=data)
+    except IntegrityError:
+        return False
+    return True
+
+
+def handle_callback(callback):
+    """Apply a button press and queue the replies to Telegram"""
+    callback_data = callback.get('data') or ''
+    message = callback.get('message') or {}
+    chat_id = (message.get('chat') or {}).get('id')
+
+    # Parse callback data (format: "pick_ORDER_ID")
+    if not callback_data.startswith('pick_'):
+        return
+    order_id = callback_data.split('_')[1]
+
+    order = Order.objects.filter(order_id=order_id).first()
+    picked = order is not None and order.mark_picked()
+    if order is None:
+        answer = "Order not found"
+    elif picked:
+        answer = f"Order {order_id} marked as PICKED"
+    else:
+        answer = "Order cannot be picked"
+
+    # Queued under the message's chat so the answer goes out before the edit
+    enqueue('callback_answer', 'answerCallbackQuery', {
+        "callback_query_id": callback['id'],
+        "text": answer
+    }, order=order, chat_id=chat_id)
+    if picked and order.telegram_board_id:
+        # The button is on a live board: redraw the board rather than overwrite it
+        enqueue('board_refresh', 'editMessageText', {"chat_id": order.telegram_board.chat_id}, order=order)
+    elif picked and chat_id and message.get('message_id'):
+        enqueue('callback_edit', 'editMessageText', {
+            "chat_id": chat_id,
+            "message_id": message['message_id'],
+            "text": f"✅ Order {order_id} - PICKED",
+            "parse_mode": "HTML"
+        }, order=order)
+
+
+def handle_update(data):
+    if 'callback_query' in data:
+        handle_callback(data['callback_query'])
+
+
+def process_pending_updates(limit=100):
+    """Handle pending updates in update_id order; returns how many were handled"""
+    handled = 0
+    for update_id in TelegramUpdate.objects.filter(status='pending').order_by('update_id').values_list('update_id', flat=True)[:limit]:
+        with transaction.atomic():
+            update = (
+                TelegramUpdate.objects.select_for_update(skip_locked=True)
+                .filter(update_id=update_id, status='pending')
+                .first()
+            )
+            if update is None:
+                continue
+            try:
+                with transaction.atomic():
+                    handle_update(update.payload)
+            except Exception as e:
+                logger.exception("Telegram update %s failed", update_id)
+                update.status, update.error = 'failed', str(e)[:1000]
+            else:
+                update.status = 'done'
+            update.processed_at = timezone.now()
+            update.save(update_fields=['status', 'error', 'processed_at'])
+        handled += 1
+    return handled
@@ -1,3 +1,1148 @@
-from django.test import TestCase
+import hashlib
+import os
+import runpy
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+import warnings
+import zlib
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from io import BytesIO
+from unittest import mock
 
-# Create your tests here.
+import httpx
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, OperationalError, connection, connections, transaction
+from django.db.models import F
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+from PIL import Image
+from rest_framework.exceptions import ValidationError
+from rest_framework.renderers import JSONRenderer
+
+from backend import settings as backend_settings
+
+from . import (
+    catalog, expiry, idempotency, low_stock, metrics, order_ids, product_updates, rollups, stock, stock_ledger,
+    telegram_bot, telegram_outbox, throttling,
+)
+from .fast_serializers import PRODUCT_COLUMNS, order_columns, serialize_order, serialize_orders, serialize_products
+from .images import THUMBNAIL_SIZES, render_missing_thumbnails, store_image, thumbnail_path, thumbnail_url
+from .models import (
+    Order, OrderEvent, Product, ProductTombstone, SalesRollup, Sequence, StockMovement, StockSnapshot, StockStripe,
+    TelegramBoard, TelegramOutbox, TelegramUpdate,
+)
+from .renderers import TimedJSONRenderer, render_rows
+from .serializers import OrderSerializer, ProductSerializer
+from .stock import InsufficientStock
+from .telegram_fake import FakeTelegramServer
+from .telegram_outbox import CircuitBreaker, OutboxWorker, RateLimiter
+from .views import ADMIN_PIN
+
+
+class Rollback(Exception):
+    pass
+
+
+def make_order(**fields):
+    return Order.objects.create(**{
+        'customer_name': 'Test',
+        'phone_number': '9000000000',
+        'room_number': '101',
+        'items': [{'productId': 0, 'name': 'Snack', 'qty': 1, 'price': 20}],
+        'total_amount': Decimal('20'),
+        **fields,
+    })
+
+
+class OrderIdTests(TestCase):
+    def setUp(self):
+        order_ids.reset_block()
+
+    def tearDown(self):
+        order_ids.reset_block()
+
+    def test_rolled_back_block_is_not_reused(self):
+        with self.assertRaises(Rollback):
+            with transaction.atomic():
+                make_order()
+                raise Rollback
+
+        # The rollback undid the reservation, so another worker gets the same values
+        other_worker = order_ids._reserve_block(connection, order_ids.BLOCK_SIZE)
+        taken = {order_ids.order_id_for(value) for value in other_worker}
+
+        first, second = make_order(), make_order()
+        self.assertNotEqual(first.order_id, second.order_id)
+        self.assertFalse({first.order_id, second.order_id} & taken)
+
+
+class OrderIdBlockTests(TransactionTestCase):
+    def setUp(self):
+        order_ids.reset_block()
+
+    def tearDown(self):
+        order_ids.reset_block()
+        reservations = getattr(order_ids._local, 'connection', None)
+        if reservations is not None:
+            reservations.close()
+            del order_ids._local.connection
+
+    def sequence(self):
+        return Sequence.objects.get(name=order_ids.SEQUENCE_NAME).value
+
+    def test_committed_block_is_reused(self):
+        ids = []
+        for _ in range(3):
+            with transaction.atomic():
+                ids.append(make_order().order_id)
+        self.assertEqual(ids, [order_ids.order_id_for(value) for value in range(3)])
+        self.assertEqual(self.sequence(), order_ids.BLOCK_SIZE)
+
+    def test_block_is_reserved_outside_the_order_transaction(self):
+        # What every backend but SQLite does: the reservation commits on its own
+        with mock.patch.object(connection, 'vendor', 'postgresql'):
+            with self.assertRaises(Rollback):
+                with transaction.atomic():
+                    first = order_ids.next_order_id()
+                    self.assertIsNot(order_ids._local.connection, connections['default'])
+                    raise Rollback
+            self.assertEqual(self.sequence(), order_ids.BLOCK_SIZE)
+            # The rest of the block is still ours
+            self.assertEqual(order_ids.next_order_id(), order_ids.order_id_for(1))
+        self.assertEqual(first, order_ids.order_id_for(0))
+
+
+# DEBUG is off in tests, which turns on SECURE_SSL_REDIRECT
+@override_settings(SECURE_SSL_REDIRECT=False)
+class ExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Product.objects.bulk_create(
+            Product(name=f'Snack {index}', category='snacks', price=Decimal('20.00'), stock=10)
+            for index in range(50)
+        )
+
+    async def test_asgi_export_streams_without_buffering(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            response = await self.async_client.get(
+                '/api/admin/export', {'type': 'products', 'gzip': '1'}, headers={'X-Admin-Pin': ADMIN_PIN}
+            )
+            self.assertTrue(response.is_async)
+            body = b''.join([chunk async for chunk in response.streaming_content])
+        # Django warns when it has to collect a sync iterator before sending it
+        self.assertFalse([warning for warning in caught if 'StreamingHttpResponse' in str(warning.message)])
+
+        lines = zlib.decompress(body, wbits=31).decode().splitlines()
+        self.assertEqual(lines[0], 'ID,Name,Category,Price,Stock,Active')
+        self.assertEqual(len(lines), 51)
+
+    def test_wsgi_export_is_sync(self):
+        response = self.client.get('/api/admin/export', {'type': 'products'}, headers={'X-Admin-Pin': ADMIN_PIN})
+        self.assertFalse(response.is_async)
+        self.assertEqual(len(b''.join(response.streaming_content).decode().splitlines()), 51)
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class ThumbnailTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        out = BytesIO()
+        Image.new('RGB', (800, 600), 'orange').save(out, 'PNG')
+        self.digest = store_image(out.getvalue(), 'image/png')
+
+    def test_thumbnails_are_served_as_media(self):
+        response = self.client.get(thumbnail_url(self.digest, 150))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(Image.open(BytesIO(b''.join(response.streaming_content))).width, 150)
+
+    async def test_thumbnails_are_served_under_asgi(self):
+        response = await self.async_client.get(thumbnail_url(self.digest))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response['Cache-Control'])
+
+    def test_lost_thumbnails_are_rendered_again(self):
+        for size in THUMBNAIL_SIZES:
+            default_storage.delete(thumbnail_path(self.digest, size))
+
+        self.assertEqual(render_missing_thumbnails(), (1, len(THUMBNAIL_SIZES)))
+        self.assertTrue(all(default_storage.exists(thumbnail_path(self.digest, size)) for size in THUMBNAIL_SIZES))
+        self.assertEqual(render_missing_thumbnails(), (0, 0))
+
+
+# Non-ASCII text, the two characters JSONRenderer escapes, quotes and backslashes
+AWKWARD_TEXT = ['Maggi', 'Chai "special"', 'Café ☕', 'Line\u2028break\u2029', 'Tab\tand \\ slash', '']
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class RendererTests(TestCase):
+    """The fast serializers and the orjson renderer must give JSONRenderer's bytes"""
+
+    @classmethod
+    def setUpTestData(cls):
+        Product.objects.bulk_create(
+            Product(
+                name=f'{AWKWARD_TEXT[n % len(AWKWARD_TEXT)]} {n}',
+                category=['Snacks', 'Drinks'][n % 2],
+                price=Decimal(n + 10) + Decimal(n % 4) / 4,
+                stock=n,
+                image=['', None, 'https://example.com/p.png'][n % 3],
+                image_digest=f'{n:064x}' if n % 4 == 0 else None,
+            )
+            for n in range(12)
+        )
+        now = timezone.now().replace(microsecond=0)
+        statuses = ['reserved', 'picked', 'completed', 'cancelled']
+        Order.objects.bulk_create(
+            Order(
+                order_id=order_ids.order_id_for(n),
+                customer_name=AWKWARD_TEXT[n % len(AWKWARD_TEXT)] or 'Student',
+                phone_number=f'9{n:09d}',
+                room_number=f'B-{n}',
+                notes=AWKWARD_TEXT[n % len(AWKWARD_TEXT)] if n % 3 else None,
+                items=[{'productId': n, 'name': AWKWARD_TEXT[n % len(AWKWARD_TEXT)], 'price': 12.5, 'qty': n % 3 + 1}],
+                total_amount=Decimal('12.5') * (n % 3 + 1),
+                status=statuses[n % len(statuses)],
+                expires_at=now + timedelta(minutes=15),
+            )
+            for n in range(12)
+        )
+        for n, order_id in enumerate(Order.objects.order_by('order_id').values_list('order_id', flat=True)):
+            # With and without microseconds, and the optional timestamps left empty
+            created_at = now - timedelta(minutes=n, microseconds=n * 7919 if n % 2 else 0)
+            Order.objects.filter(order_id=order_id).update(
+                created_at=created_at,
+                picked_at=created_at + timedelta(minutes=5) if n % 4 in (1, 2) else None,
+                completed_at=created_at + timedelta(minutes=9) if n % 4 == 2 else None,
+                cancelled_at=created_at + timedelta(minutes=15) if n % 4 == 3 else None,
+            )
+
+    def test_products(self):
+        products = Product.objects.order_by('id')
+        expected = JSONRenderer().render(ProductSerializer(products, many=True).data)
+        self.assertEqual(render_rows(serialize_products(products.values_list(*PRODUCT_COLUMNS, named=True))), expected)
+
+    def test_orders(self):
+        orders = Order.objects.order_by('-created_at', '-order_id')
+        expected = JSONRenderer().render(OrderSerializer(orders, many=True).data)
+        self.assertEqual(render_rows(serialize_orders(orders.values_list(*order_columns(), named=True))), expected)
+
+    def test_order_projection(self):
+        orders = Order.objects.order_by('-created_at', '-order_id')
+        fields = ['orderId', 'status', 'totalAmount', 'createdAt']
+        expected = JSONRenderer().render(OrderSerializer(orders, many=True, fields=fields).data)
+        rows = orders.values_list(*order_columns(fields), named=True)
+        self.assertEqual(render_rows(serialize_orders(rows, fields)), expected)
+
+    def test_order_detail(self):
+        order = Order.objects.filter(picked_at__isnull=False).first()
+        expected = JSONRenderer().render(OrderSerializer(order).data)
+        row = Order.objects.values_list(*order_columns(), named=True).get(pk=order.pk)
+        self.assertEqual(render_rows(serialize_order(row)), expected)
+
+    def test_stats(self):
+        response = self.client.get('/api/admin/stats', headers={'X-Admin-Pin': ADMIN_PIN})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, JSONRenderer().render(response.data))
+
+    def test_special_values(self):
+        data = {
+            'decimal': Decimal('12.50'),
+            'whole': Decimal('20'),
+            'aware': datetime(2026, 10, 18, 9, 30, 5, 120000, tzinfo=dt_timezone.utc),
+            'naive': datetime(2026, 10, 18, 9, 30),
+            'date': date(2026, 10, 18),
+            'unicode': 'Café ☕ नमस्ते',
+            'separators': 'Line\u2028break\u2029',
+            'none': None,
+            'uuid': uuid.UUID(int=1),
+            'lazy': gettext_lazy('Snacks'),
+            1: 'integer key',
+        }
+        self.assertEqual(TimedJSONRenderer().render(data), JSONRenderer().render(data))
+        # orjson rejects integers wider than 64 bits; the renderer falls back
+        self.assertEqual(TimedJSONRenderer().render({'wide': 2 ** 70}), JSONRenderer().render({'wide': 2 ** 70}))
+
+
+class FakeTelegramTestCase(TestCase):
+    """Points the bot at a local fake Bot API and gives each test an outbox worker"""
+    chat_id = 'test-chat'
+    server_options = {}
+
+    def setUp(self):
+        self.server = FakeTelegramServer(**self.server_options).start()
+        self.addCleanup(self.server.stop)
+        for name, value in (('BOT_TOKEN', 'test'), ('CHAT_ID', self.chat_id), ('API_BASE', self.server.url)):
+            patcher = mock.patch.object(telegram_bot, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.worker = OutboxWorker(
+            client=httpx.Client(timeout=5.0),
+            limiter=RateLimiter(rate=1000, per=1.0, burst=1000),
+            breaker=CircuitBreaker(threshold=50, cooldown=0.1)
+        )
+        self.addCleanup(self.worker.client.close)
+
+    def place_order(self, **fields):
+        """Create an order and queue its notification in one transaction, as order_create does"""
+        with transaction.atomic():
+            order = make_order(**fields)
+            telegram_bot.send_order_notification(order)
+        return order
+
+    def calls(self, method=None):
+        return [call for call in self.server.state.calls if method is None or call['method'] == method]
+
+
+@override_settings(TELEGRAM_BOARD_RATE=0)
+class OutboxTests(FakeTelegramTestCase):
+    def test_row_is_committed_with_its_order(self):
+        order = self.place_order()
+        row = TelegramOutbox.objects.get(order=order)
+        self.assertEqual((row.kind, row.status), ('order_created', 'pending'))
+
+        self.worker.drain_once()
+        row.refresh_from_db()
+        order.refresh_from_db()
+        self.assertEqual(row.status, 'sent')
+        self.assertEqual(len(self.calls('sendMessage')), 1)
+        self.assertEqual(order.telegram_message_id, row.message_id)
+        self.assertIn(order.order_id, self.calls()[0]['data']['text'])
+
+    def test_rolled_back_order_sends_nothing(self):
+        with self.assertRaises(Rollback):
+            with transaction.atomic():
+                order = make_order()
+                telegram_bot.send_order_notification(order)
+                raise Rollback
+
+        self.assertFalse(TelegramOutbox.objects.exists())
+        self.worker.drain_once()
+        self.assertEqual(self.calls(), [])
+
+    def test_failed_send_is_retried_with_backoff(self):
+        order = self.place_order()
+        self.server.state.fail_rate = 1.0
+
+        before = timezone.now()
+        self.worker.drain_once()
+        row = TelegramOutbox.objects.get(order=order)
+        self.assertEqual((row.status, row.attempts, row.last_error), ('pending', 1, 'HTTP 502'))
+        # First retry after BACKOFF_BASE seconds, give or take the jitter
+        self.assertGreater(row.next_attempt_at, before + timedelta(seconds=1.5))
+
+        # Held back until then
+        self.server.state.fail_rate = 0.0
+        self.worker.drain_once()
+        self.assertEqual(self.calls(), [])
+
+        TelegramOutbox.objects.filter(pk=row.pk).update(next_attempt_at=timezone.now())
+        self.worker.drain_once()
+        row.refresh_from_db()
+        self.assertEqual((row.status, row.attempts), ('sent', 2))
+        self.assertEqual(len(self.calls('sendMessage')), 1)
+
+    def test_backoff_grows_with_each_failure(self):
+        order = self.place_order()
+        self.server.state.fail_rate = 1.0
+        delays = []
+        for _ in range(3):
+            TelegramOutbox.objects.filter(order=order).update(next_attempt_at=timezone.now())
+            started = timezone.now()
+            self.worker.drain_once()
+            delays.append((TelegramOutbox.objects.get(order=order).next_attempt_at - started).total_seconds())
+        self.assertTrue(delays[0] < delays[1] < delays[2], delays)
+
+    def test_sent_row_is_not_sent_again(self):
+        order = self.place_order()
+        self.worker.drain_once()
+        TelegramOutbox.objects.filter(order=order).update(next_attempt_at=timezone.now() - timedelta(minutes=1))
+        for _ in range(3):
+            self.worker.drain_once()
+        self.assertEqual(len(self.calls('sendMessage')), 1)
+        self.assertEqual(TelegramOutbox.objects.get(order=order).attempts, 1)
+
+    def test_bad_request_is_not_retried(self):
+        TelegramOutbox.objects.create(
+            kind='order_picked_edit', method='editMessageText', chat_id=self.chat_id,
+            payload={'chat_id': self.chat_id, 'message_id': 999, 'text': 'Picked'}
+        )
+        with self.assertLogs('api.telegram_outbox', 'WARNING'):
+            self.worker.drain_once()
+        row = TelegramOutbox.objects.get()
+        self.assertEqual((row.status, row.attempts), ('failed', 1))
+        self.assertIn('message to edit not found', row.last_error)
+
+    def test_one_worker_holds_the_outbox(self):
+        other = OutboxWorker(client=self.worker.client)
+        self.assertTrue(self.worker.acquire_lease())
+        self.assertFalse(other.acquire_lease())
+        self.assertTrue(self.worker.acquire_lease())  # Renewed
+        self.worker.release_lease()
+        self.assertTrue(other.acquire_lease())
+        self.assertFalse(self.worker.acquire_lease())
+
+    def test_worker_that_lost_its_lease_stops_sending(self):
+        self.place_order()
+        self.assertTrue(self.worker.acquire_lease())
+        # It stalled past LEASE_TIMEOUT, and another worker took over
+        cache.set(telegram_outbox.LEASE_KEY, 'other-worker')
+        self.assertIsNone(self.worker.drain_once())
+        self.assertEqual(self.calls(), [])
+        self.assertEqual(TelegramOutbox.objects.get().status, 'pending')
+
+    def test_prune_keeps_what_is_still_needed(self):
+        def make(status):
+            return TelegramOutbox.objects.create(
+                kind='order_created', method='sendMessage', chat_id=self.chat_id, payload={}, status=status
+            )
+
+        old, recent = make('sent'), make('sent')
+        make('failed'), make('pending')
+        TelegramUpdate.objects.bulk_create(
+            TelegramUpdate(update_id=update_id, payload={}, status=status)
+            for update_id, status in ((1, 'done'), (2, 'failed'), (3, 'pending'), (4, 'done'))
+        )
+        long_ago = timezone.now() - telegram_outbox.RETENTION - timedelta(hours=1)
+        TelegramOutbox.objects.exclude(pk=recent.pk).update(created_at=long_ago)
+        TelegramUpdate.objects.exclude(update_id=4).update(received_at=long_ago)
+
+        self.assertEqual(telegram_outbox.prune(), (2, 2))
+        self.assertEqual(sorted(TelegramOutbox.objects.values_list('status', flat=True)), ['pending', 'sent'])
+        self.assertFalse(TelegramOutbox.objects.filter(pk=old.pk).exists())
+        self.assertEqual(sorted(TelegramUpdate.objects.values_list('update_id', flat=True)), [3, 4])
+
+
+@override_settings(TELEGRAM_BOARD_RATE=3)
+class BoardTests(FakeTelegramTestCase):
+    def drain(self):
+        for _ in range(20):
+            self.worker.drain_once()
+            if not TelegramOutbox.objects.filter(status='pending').exists():
+                return
+        self.fail('Outbox did not drain')
+
+    def rush(self, count):
+        return [self.place_order(room_number=str(200 + index)) for index in range(count)]
+
+    def test_rush_goes_on_one_board(self):
+        orders = self.rush(6)
+        self.drain()
+
+        board = TelegramBoard.objects.get()
+        self.assertEqual(len(self.calls('sendMessage')), 1)
+        self.assertEqual(self.calls('editMessageText'), [])
+        self.assertEqual(set(board.orders.values_list('pk', flat=True)), {order.pk for order in orders})
+        buttons = self.server.state.buttons(self.chat_id)
+        self.assertEqual(set(buttons), {f'pick_{order.order_id}' for order in orders})
+        self.assertEqual(set(buttons.values()), {board.message_id})
+
+    def test_later_orders_edit_the_board(self):
+        self.rush(4)
+        self.drain()
+        late = self.place_order(room_number='999')
+        self.drain()
+
+        self.assertEqual(len(self.calls('sendMessage')), 1)
+        self.assertEqual(len(self.calls('editMessageText')), 1)
+        board = TelegramBoard.objects.get()
+        self.assertEqual(self.server.state.buttons(self.chat_id)[f'pick_{late.order_id}'], board.message_id)
+
+    def test_picked_order_leaves_the_buttons(self):
+        orders = self.rush(4)
+        self.drain()
+        with transaction.atomic():
+            orders[0].mark_picked()
+            telegram_bot.send_order_picked_notification(orders[0])
+        self.drain()
+
+        self.assertEqual(len(self.calls('sendMessage')), 1)
+        buttons = self.server.state.buttons(self.chat_id)
+        self.assertNotIn(f'pick_{orders[0].order_id}', buttons)
+        self.assertEqual(len(buttons), 3)
+
+    def test_retry_after_is_honoured(self):
+        self.server.state.rate_limit = 1
+        self.server.state.rate_window = 30.0
+        self.rush(4)
+        self.drain()
+        self.place_order(room_number='999')
+
+        self.worker.drain_once()
+        self.assertEqual(self.server.state.rejected, 1)
+        row = TelegramOutbox.objects.get(status='pending')
+        self.assertGreaterEqual(row.next_attempt_at, timezone.now() + timedelta(seconds=25))
+        self.assertEqual(self.worker.breaker.failures, 0)
+
+        # Nothing more is tried while Telegram asked us to wait
+        for _ in range(3):
+            self.worker.drain_once()
+        self.assertEqual(self.server.state.rejected, 1)
+        self.assertEqual(len(self.calls('editMessageText')), 0)
+
+    def test_quiet_chat_falls_back_to_messages(self):
+        self.rush(4)
+        self.drain()
+        # The rush is over: its notifications are now outside the rate window
+        TelegramOutbox.objects.update(created_at=timezone.now() - timedelta(minutes=5))
+        late = self.place_order(room_number='999')
+        self.drain()
+
+        late.refresh_from_db()
+        self.assertIsNone(late.telegram_board_id)
+        self.assertFalse(TelegramBoard.objects.get().open)
+        self.assertEqual(len(self.calls('sendMessage')), 2)
+        self.assertEqual(self.server.state.buttons(self.chat_id)[f'pick_{late.order_id}'], late.telegram_message_id)
+
+    def test_deleted_board_is_posted_again(self):
+        self.rush(4)
+        self.drain()
+        self.server.state.messages.clear()
+        self.place_order(room_number='999')
+        self.drain()
+
+        board = TelegramBoard.objects.get()
+        self.assertEqual(len(self.calls('sendMessage')), 2)
+        self.assertEqual(len(self.server.state.buttons(self.chat_id)), 5)
+        self.assertEqual(set(self.server.state.buttons(self.chat_id).values()), {board.message_id})
+
+
+def make_product(name='Maggi', stock=5, category='Snacks', **fields):
+    return Product.objects.create(name=name, category=category, price=Decimal('20.00'), stock=stock, **fields)
+
+
+def order_data(*lines, phone='9000000000'):
+    """Order payload for (product, qty) lines"""
+    return {
+        'customerName': 'Test', 'phoneNumber': phone, 'roomNumber': '101',
+        'items': [
+            {'productId': product.pk, 'name': product.name, 'price': float(product.price), 'qty': qty}
+            for product, qty in lines
+        ],
+    }
+
+
+def place(data):
+    """Create an order through OrderSerializer, as the order_list view does"""
+    serializer = OrderSerializer(data=data)
+    serializer.is_valid(raise_exception=True)
+    return serializer.save()
+
+
+class StockReservationTests(TestCase):
+    def stock(self, product):
+        return stock.available([product.pk])[product.pk]
+
+    def test_order_takes_its_units(self):
+        maggi, chips = make_product(stock=5), make_product('Chips', stock=3)
+        order = place(order_data((maggi, 2), (chips, 3)))
+        self.assertEqual((self.stock(maggi), self.stock(chips)), (3, 0))
+        self.assertEqual(
+            sorted(StockMovement.objects.filter(order_id=order.pk).values_list('product_id', 'quantity')),
+            [(maggi.pk, -2), (chips.pk, -3)]
+        )
+
+    def test_last_units_go_to_one_order(self):
+        maggi = make_product(stock=2)
+        place(order_data((maggi, 2)))
+        with self.assertRaises(ValidationError) as raised:
+            place(order_data((maggi, 1), phone='9000000001'))
+        self.assertIn('Insufficient stock for Maggi. Available: 0', str(raised.exception))
+        self.assertEqual(self.stock(maggi), 0)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_short_item_rolls_back_the_whole_order(self):
+        maggi, chips = make_product(stock=5), make_product('Chips', stock=1)
+        with self.assertRaises(ValidationError) as raised:
+            place(order_data((maggi, 2), (chips, 2)))
+        self.assertIn('Insufficient stock for Chips. Available: 1', str(raised.exception))
+        self.assertEqual((self.stock(maggi), self.stock(chips)), (5, 1))
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(StockMovement.objects.filter(kind='reserve').exists())
+
+    def test_short_striped_item_rolls_back_the_plain_ones(self):
+        maggi, chips = make_product(stock=5), make_product('Chips', stock=2, stock_stripes=2)
+        stock.write_stripes(chips.pk, stock.spread(2, 2))
+        with self.assertRaises(InsufficientStock):
+            with transaction.atomic():
+                stock.reserve(order_data((maggi, 2), (chips, 3))['items'])
+        self.assertEqual((self.stock(maggi), self.stock(chips)), (5, 2))
+
+    def test_check_constraint_stops_negative_stock(self):
+        maggi = make_product(stock=1)
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                Product.objects.filter(pk=maggi.pk).update(stock=F('stock') - 2)
+        stripe = StockStripe.objects.create(product=maggi, stripe=0, quantity=1)
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                StockStripe.objects.filter(pk=stripe.pk).update(quantity=F('quantity') - 2)
+
+
+class ConcurrentReservationTests(TransactionTestCase):
+    def race(self, product, buyers, qty):
+        """``buyers`` threads order ``qty`` units at once; returns their outcomes"""
+        start = threading.Barrier(buyers)
+        outcomes = []
+
+        def buy(index):
+            start.wait()
+            try:
+                # SQLite takes one writer at a time and refuses the others at
+                # once; retry like a client would
+                for _ in range(200):
+                    try:
+                        place(order_data((product, qty), phone=f'9{index:09d}'))
+                        outcomes.append('ordered')
+                        return
+                    except ValidationError:
+                        outcomes.append('sold out')
+                        return
+                    except OperationalError:
+                        time.sleep(0.005)
+                outcomes.append('gave up')
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=buy, args=(index,)) for index in range(buyers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return sorted(outcomes)
+
+    def test_two_orders_for_the_last_units(self):
+        maggi = make_product(stock=2)
+        self.assertEqual(self.race(maggi, 2, 2), ['ordered', 'sold out'])
+        self.assertEqual(Product.objects.get(pk=maggi.pk).stock, 0)
+
+    def test_rush_never_oversells(self):
+        maggi = make_product(stock=5)
+        self.assertEqual(self.race(maggi, 8, 1), ['ordered'] * 5 + ['sold out'] * 3)
+        self.assertEqual(Product.objects.get(pk=maggi.pk).stock, 0)
+        self.assertEqual(Order.objects.count(), 5)
+
+
+class StockLedgerTests(TestCase):
+    def test_striped_reservations_reconcile(self):
+        maggi = make_product(stock=20)
+        self.assertEqual(stock_ledger.compact(stripes=4), (1, 1, 1, 0))
+        self.assertEqual(list(StockStripe.objects.filter(product=maggi).values_list('quantity', flat=True)), [5] * 4)
+        for index in range(6):
+            place(order_data((maggi, 2), phone=f'9{index:09d}'))
+        self.assertEqual(stock.available([maggi.pk])[maggi.pk], 8)
+
+        result = stock_ledger.reconcile()
+        self.assertEqual((result.checked, result.unchecked, result.discrepancies), (1, 0, []))
+
+        # Folding the stripes back writes their total into Product.stock
+        self.assertEqual(stock_ledger.compact(stripes=0), (1, 1, 0, 1))
+        maggi.refresh_from_db()
+        self.assertEqual((maggi.stock, maggi.stock_stripes), (8, 0))
+        self.assertFalse(StockStripe.objects.filter(product=maggi).exists())
+        self.assertEqual(stock_ledger.reconcile().discrepancies, [])
+
+    @override_settings(STOCK_STRIPES=4, STOCK_HOT_RATE=3)
+    def test_stripes_follow_the_reservation_rate(self):
+        maggi = make_product(stock=20)
+        for index in range(3):
+            place(order_data((maggi, 1), phone=f'9{index:09d}'))
+        self.assertEqual(stock_ledger.compact().striped, 1)
+        self.assertEqual(Product.objects.get(pk=maggi.pk).stock_stripes, 4)
+        # Still busy enough to stay striped
+        self.assertEqual(stock_ledger.compact().unstriped, 0)
+        # Quiet a minute later
+        later = timezone.now() + timedelta(minutes=2)
+        self.assertEqual(stock_ledger.compact(now=later).unstriped, 1)
+        self.assertEqual(Product.objects.get(pk=maggi.pk).stock, 17)
+
+    def test_raw_update_is_live_drift(self):
+        maggi = make_product(stock=5)
+        stock_ledger.compact()
+        place(order_data((maggi, 2)))
+        Product.objects.filter(pk=maggi.pk).update(stock=F('stock') + 4)
+
+        result = stock_ledger.reconcile()
+        self.assertEqual(len(result.discrepancies), 1)
+        discrepancy = result.discrepancies[0]
+        self.assertEqual(
+            (discrepancy.product_id, discrepancy.check, discrepancy.expected, discrepancy.actual),
+            (maggi.pk, 'live', 3, 7)
+        )
+        self.assertEqual(discrepancy.movement_id, StockMovement.objects.get(kind='reserve').pk)
+
+    def test_snapshot_without_movements_is_history_drift(self):
+        maggi = make_product(stock=5)
+        stock_ledger.compact()
+        Product.objects.filter(pk=maggi.pk).update(stock=9)
+        # A later compaction records the drifted stock, so it shows between snapshots
+        stock_ledger.compact([maggi.pk])
+        self.assertEqual(
+            [(d.check, d.expected, d.actual) for d in stock_ledger.reconcile().discrepancies],
+            [('history', 5, 9)]
+        )
+
+    def test_product_without_snapshot_is_unchecked(self):
+        make_product()
+        self.assertEqual(stock_ledger.reconcile(), (0, 1, []))
+
+    def test_prune_keeps_what_reconcile_needs(self):
+        maggi = make_product(stock=10)
+        stock_ledger.compact()
+        place(order_data((maggi, 2)))
+        stock_ledger.compact([maggi.pk])
+        place(order_data((maggi, 3), phone='9000000001'))
+        old = timezone.now() - stock_ledger.RETENTION - timedelta(days=1)
+        StockSnapshot.objects.update(taken_at=old)
+        StockMovement.objects.update(created_at=old)
+
+        # The first snapshot goes, and the movements the latest one includes
+        # (opening stock and first order); the one after it is still needed
+        # for the live check
+        self.assertEqual(stock_ledger.prune(), (1, 2))
+        self.assertEqual(list(StockSnapshot.objects.values_list('stock', flat=True)), [8])
+        self.assertEqual(list(StockMovement.objects.values_list('quantity', flat=True)), [-3])
+        self.assertEqual(stock_ledger.reconcile(), (1, 0, []))
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class ClearDatabaseTests(TestCase):
+    def test_clears_the_ledger_and_events_too(self):
+        maggi = make_product(stock=10)
+        order = place(order_data((maggi, 2)))
+        stock_ledger.compact(stripes=2)
+        TelegramOutbox.objects.create(kind='order', method='sendMessage', chat_id='1', payload={}, order=order)
+        models = [Product, Order, StockMovement, StockSnapshot, StockStripe, OrderEvent, TelegramOutbox]
+        self.assertTrue(all(model.objects.exists() for model in models))
+
+        response = self.client.post(
+            '/api/admin/clear-database', {'confirm': 'DELETE_ALL_DATA'}, headers={'X-Admin-Pin': ADMIN_PIN},
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([model for model in models if model.objects.exists()], [])
+
+
+LOCMEM_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tests'}}
+
+
+@override_settings(
+    SECURE_SSL_REDIRECT=False, CACHES=LOCMEM_CACHE,
+    THROTTLE_RATES={'order-create': {'phone': '1/min'}, 'order-cancel': {'ip': '1/min'}},
+)
+class IdempotencyTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        throttling.memory_buckets.clear()
+        self.maggi = make_product(stock=5)
+
+    def post(self, path, data, key):
+        return self.client.post(path, data, content_type='application/json', headers={idempotency.HEADER: key})
+
+    def test_retry_gets_the_first_response(self):
+        data = order_data((self.maggi, 1))
+        first = self.post('/api/orders', data, 'key-1')
+        self.assertEqual(first.status_code, 201)
+        # The phone's bucket is empty now, but a retry is still answered
+        retry = self.post('/api/orders', data, 'key-1')
+        self.assertEqual((retry.status_code, retry['Idempotent-Replayed']), (201, 'true'))
+        self.assertEqual(retry.json()['orderId'], first.json()['orderId'])
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(stock.available([self.maggi.pk])[self.maggi.pk], 4)
+
+        # A new request from the same phone is throttled, and its 429 is not stored
+        other = order_data((self.maggi, 2))
+        self.assertEqual(self.post('/api/orders', other, 'key-2').status_code, 429)
+        throttling.memory_buckets.clear()
+        self.assertEqual(self.post('/api/orders', other, 'key-2').status_code, 400)  # Already has an order
+
+    def test_cancel_retry_is_not_throttled(self):
+        order = place(order_data((self.maggi, 1)))
+        path = f'/api/orders/{order.pk}/cancel'
+        self.assertEqual(self.post(path, {}, 'cancel-1').status_code, 200)
+        retry = self.post(path, {}, 'cancel-1')
+        self.assertEqual((retry.status_code, retry['Idempotent-Replayed']), (200, 'true'))
+        self.assertEqual(self.post(path, {}, 'cancel-2').status_code, 429)
+
+    def test_key_reused_for_another_request(self):
+        self.post('/api/orders', order_data((self.maggi, 1)), 'key-1')
+        response = self.post('/api/orders', order_data((self.maggi, 2)), 'key-1')
+        self.assertEqual(response.status_code, 422)
+        self.assertIn(idempotency.HEADER, response.json()['error'])
+        self.assertEqual(Order.objects.count(), 1)
+
+    def in_flight(self, data, key):
+        """Run ``data`` once, then make it look still running: its lock held and no result yet"""
+        self.post('/api/orders', data, key)
+        digest = hashlib.sha256(f'order-create:{key}'.encode()).hexdigest()
+        result_key = idempotency.RESULT_KEY.format(digest)
+        result = cache.get(result_key)
+        cache.delete(result_key)
+        cache.add(idempotency.LOCK_KEY.format(digest), 'other-worker')
+        return result_key, result
+
+    def test_duplicate_waits_for_the_running_request(self):
+        data = order_data((self.maggi, 1))
+        result_key, result = self.in_flight(data, 'key-1')
+        # The first request finishes while the duplicate waits
+        with mock.patch.object(idempotency.time, 'sleep', side_effect=lambda _: cache.set(result_key, result)) as sleep:
+            response = self.post('/api/orders', data, 'key-1')
+        sleep.assert_called_once()
+        self.assertEqual((response.status_code, response['Idempotent-Replayed']), (201, 'true'))
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_duplicate_gives_up_after_the_wait_timeout(self):
+        data = order_data((self.maggi, 1))
+        self.in_flight(data, 'key-1')
+        with mock.patch.object(idempotency, 'WAIT_TIMEOUT', 0):
+            response = self.post('/api/orders', data, 'key-1')
+        self.assertEqual((response.status_code, response['Retry-After']), (409, '1'))
+        self.assertEqual(Order.objects.count(), 1)
+
+
+class ExpiryTests(TestCase):
+    def setUp(self):
+        self.maggi = make_product(stock=5)
+        self.late = place(order_data((self.maggi, 2)))
+        self.picked = place(order_data((self.maggi, 1), phone='9000000001'))
+        Order.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+
+    def released(self):
+        return sorted(StockMovement.objects.filter(kind='release').values_list('order_id', 'quantity'))
+
+    def test_order_picked_as_it_expires_keeps_its_stock(self):
+        real_filter = Order.objects.filter
+
+        def filter(*args, **kwargs):
+            if 'order_id__in' in kwargs and kwargs.get('status') == 'reserved':
+                # The admin picks it up between the expiry's SELECT and its UPDATE
+                self.assertTrue(Order.objects.get(pk=self.picked.pk).mark_picked())
+            return real_filter(*args, **kwargs)
+
+        with mock.patch.object(Order.objects, 'filter', side_effect=filter):
+            result = expiry.expire_due_orders()
+        self.assertEqual((result.orders, result.units), (1, 2))
+        self.assertEqual(
+            dict(Order.objects.values_list('order_id', 'status')),
+            {self.late.pk: 'cancelled', self.picked.pk: 'picked'}
+        )
+        self.assertEqual(stock.available([self.maggi.pk])[self.maggi.pk], 4)
+        self.assertEqual(self.released(), [(self.late.pk, 2)])
+
+    def test_stock_is_released_once(self):
+        self.assertEqual(expiry.expire_due_orders().orders, 2)
+        # A second sweep, and a cancel that raced the expiry, find nothing to release
+        self.assertEqual(expiry.expire_due_orders(), (0, 0, []))
+        self.late.refresh_from_db()
+        self.assertFalse(self.late.cancel())
+        stale = Order.objects.get(pk=self.picked.pk)
+        stale.status = 'reserved'
+        self.assertFalse(stale.cancel())
+
+        self.assertEqual(stock.available([self.maggi.pk])[self.maggi.pk], 5)
+        self.assertEqual(self.released(), sorted([(self.late.pk, 2), (self.picked.pk, 1)]))
+
+
+@override_settings(SECURE_SSL_REDIRECT=False, CACHES=LOCMEM_CACHE)
+class DeltaSyncTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.maggi = make_product()
+            self.chips = make_product('Chips')
+            self.oats = make_product('Oats')
+        Product.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+
+    def sync(self, token):
+        response = self.client.get('/api/products', {'since': token})
+        self.assertEqual(response['Cache-Control'], 'no-store')
+        return response.json()
+
+    def token(self, ago=timedelta()):
+        return str((time.time_ns() // 1000) - int(ago.total_seconds() * 1_000_000))
+
+    def test_changes_and_tombstones_since_a_token(self):
+        token = self.sync(self.token(timedelta(minutes=5)))['token']
+        chips_id = self.chips.pk
+        with self.captureOnCommitCallbacks(execute=True):
+            self.chips.delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.filter(pk=self.oats.pk).update(active=False, updated_at=timezone.now())
+        with self.captureOnCommitCallbacks(execute=True):
+            place(order_data((self.maggi, 2)))
+
+        changes = self.sync(token)
+        self.assertFalse(changes['full'])
+        self.assertEqual(changes['removed'], sorted([chips_id, self.oats.pk]))
+        self.assertEqual([(p['id'], p['stock']) for p in changes['products']], [(self.maggi.pk, 3)])
+        self.assertGreater(int(changes['token']), int(token))
+
+    def test_late_commits_within_the_grace_are_resent(self):
+        token = self.token()
+        Product.objects.filter(pk=self.maggi.pk).update(updated_at=timezone.now() - timedelta(seconds=50))
+        Product.objects.filter(pk=self.chips.pk).update(updated_at=timezone.now() - timedelta(seconds=70))
+        catalog.invalidate_catalog()
+        self.assertEqual([p['id'] for p in self.sync(token)['products']], [self.maggi.pk])
+
+    def test_catalog_version_older_than_the_grace_skips_the_database(self):
+        token = self.token()
+        # Changed after the version: only a version within TOKEN_GRACE of the token is looked into
+        Product.objects.filter(pk=self.maggi.pk).update(updated_at=timezone.now())
+        cache.set(catalog.VERSION_KEY, time.time_ns() - 61 * 10**9, None)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.sync(token)['products'], [])
+        cache.set(catalog.VERSION_KEY, time.time_ns() - 59 * 10**9, None)
+        self.assertEqual([p['id'] for p in self.sync(token)['products']], [self.maggi.pk])
+
+    def test_expired_or_bad_token_gets_the_whole_catalog(self):
+        expired = self.token(catalog.TOMBSTONE_RETENTION + timedelta(minutes=1))
+        for token in (expired, 'garbage', ''):
+            changes = self.sync(token)
+            self.assertTrue(changes['full'])
+            self.assertEqual(changes['removed'], [])
+            self.assertEqual(len(changes['products']), 3)
+        # A token just inside the retention still syncs
+        self.assertFalse(self.sync(self.token(catalog.TOMBSTONE_RETENTION - timedelta(minutes=1)))['full'])
+
+    def test_old_tombstones_are_pruned(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.chips.delete()
+        ProductTombstone.objects.update(deleted_at=timezone.now() - catalog.TOMBSTONE_RETENTION - timedelta(days=1))
+        self.assertEqual(catalog.prune_tombstones(), 1)
+
+
+class RollupTests(TestCase):
+    def rollups(self):
+        return {
+            (row['granularity'], row['bucket_start'], row['category']): row
+            for row in SalesRollup.objects.values(
+                'granularity', 'bucket_start', 'category', 'orders', 'completed', 'cancellations', 'revenue', 'units'
+            )
+        }
+
+    def test_incremental_rollups_match_a_rebuild(self):
+        maggi, chips = make_product(stock=20), make_product('Chips', stock=20, category='Crisps')
+        completed = place(order_data((maggi, 2), (chips, 1), phone='9000000001'))
+        cancelled = place(order_data((chips, 3), phone='9000000002'))
+        expired = place(order_data((maggi, 1), phone='9000000003'))
+        picked = place(order_data((maggi, 4), (chips, 2), phone='9000000004'))
+        place(order_data((chips, 1), phone='9000000005'))
+
+        self.assertTrue(picked.mark_picked())
+        self.assertTrue(completed.mark_completed())
+        self.assertTrue(cancelled.cancel())
+        Order.objects.filter(pk=expired.pk).update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(expiry.expire_due_orders().orders, 1)
+        # Archived orders still count
+        Order.objects.filter(pk=completed.pk).update(completed_at=timezone.now() - timedelta(days=365))
+        self.assertTrue(order_ids.archive_if_stale(completed.pk))
+
+        incremental = self.rollups()
+        everything = incremental[('all', rollups.ALL_TIME, '')]
+        self.assertEqual(
+            (everything['orders'], everything['completed'], everything['cancellations'], everything['units']),
+            (5, 1, 2, 3)
+        )
+        self.assertEqual(everything['revenue'], Decimal('60.00'))
+        self.assertEqual(rollups.rebuild(), len(incremental))
+        self.assertEqual(self.rollups(), incremental)
+
+
+class ProductUpdateTests(TestCase):
+    def setUp(self):
+        self.maggi, self.chips = make_product(stock=5), make_product('Chips', stock=8)
+        self.striped = make_product('Oats', stock=6, stock_stripes=2)
+        stock.write_stripes(self.striped.pk, stock.spread(6, 2))
+
+    def apply(self, updates):
+        invalidate = mock.Mock()
+        with mock.patch.object(product_updates, 'invalidate_catalog', invalidate), \
+                mock.patch.object(stock, 'invalidate_catalog', invalidate), \
+                mock.patch.object(low_stock, 'send_alerts'), \
+                self.captureOnCommitCallbacks(execute=True):
+            outcome = product_updates.apply_updates(updates)
+        return outcome, invalidate.call_count
+
+    def levels(self):
+        return stock.available([self.maggi.pk, self.chips.pk, self.striped.pk])
+
+    def test_batch_invalidates_the_catalog_once(self):
+        now = timezone.now()
+        (applied, results), invalidations = self.apply([
+            {'id': self.maggi.pk, 'price': '25.00', 'stock': 9},
+            {'id': self.chips.pk, 'stock': 2, 'active': False},
+            {'id': self.striped.pk, 'stock': 10},
+        ])
+        self.assertTrue(applied)
+        self.assertEqual([result['status'] for result in results], ['updated'] * 3)
+        self.assertEqual(invalidations, 1)
+        self.assertEqual(self.levels(), {self.maggi.pk: 9, self.chips.pk: 2, self.striped.pk: 10})
+        self.assertEqual(Product.objects.get(pk=self.maggi.pk).price, Decimal('25.00'))
+        self.assertEqual(
+            sorted(StockMovement.objects.filter(created_at__gt=now).values_list('product_id', 'quantity')),
+            sorted([(self.maggi.pk, 4), (self.chips.pk, -6), (self.striped.pk, 4)])
+        )
+
+    def test_unchanged_batch_does_not_invalidate(self):
+        (applied, results), invalidations = self.apply([{'id': self.maggi.pk, 'stock': 5, 'name': 'Maggi'}])
+        self.assertTrue(applied)
+        self.assertEqual(results[0]['status'], 'unchanged')
+        self.assertEqual(invalidations, 0)
+
+    def test_one_bad_row_rejects_the_batch(self):
+        for bad in ({'id': self.chips.pk, 'stock': -1}, {'id': 9999, 'stock': 1}, {'id': self.chips.pk, 'stock_stripes': 4}):
+            (applied, results), invalidations = self.apply([
+                {'id': self.maggi.pk, 'stock': 1, 'name': 'Noodles'},
+                bad,
+                {'id': self.striped.pk, 'stock': 0},
+            ])
+            self.assertFalse(applied)
+            self.assertEqual([result['status'] for result in results], ['skipped', 'error', 'skipped'])
+            self.assertEqual(invalidations, 0)
+            self.assertEqual(self.levels(), {self.maggi.pk: 5, self.chips.pk: 8, self.striped.pk: 6})
+            self.assertEqual(Product.objects.get(pk=self.maggi.pk).name, 'Maggi')
+            self.assertFalse(StockMovement.objects.exclude(kind='restock').exists())
+
+
+@override_settings(
+    SECURE_SSL_REDIRECT=False, CACHES=LOCMEM_CACHE, THROTTLE_SHARED=False,
+    THROTTLE_RATES={'default': {'ip': '2/min'}, 'order-create': {'ip': '600/min', 'phone': '1/min'}},
+)
+class ThrottleTests(TestCase):
+    def setUp(self):
+        throttling.memory_buckets.clear()
+
+    def get(self, client_ip):
+        # Render's proxy connects from its own address and appends the client's
+        return self.client.get('/api/admin/products', REMOTE_ADDR='10.0.0.1', HTTP_X_FORWARDED_FOR=client_ip)
+
+    def test_parse_rate(self):
+        self.assertEqual(throttling.parse_rate('10/min'), (10, 10 / 60))
+        self.assertEqual(throttling.parse_rate('5 / 10 seconds'), (5, 0.5))
+        for rate in ('0/min', '10/fortnight', 'lots'):
+            with self.assertRaises(ImproperlyConfigured):
+                throttling.parse_rate(rate)
+
+    def test_bucket_refills_evenly(self):
+        state = None
+        for now in (0, 0):
+            state, wait = throttling.take_token(state, 2, 1.0, now)
+            self.assertEqual(wait, 0)
+        state, wait = throttling.take_token(state, 2, 1.0, 0.25)
+        self.assertAlmostEqual(wait, 0.75)
+        self.assertEqual(throttling.take_token(state, 2, 1.0, 1.0)[1], 0)
+
+    @override_settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'NUM_PROXIES': 1})
+    def test_clients_behind_the_proxy_get_their_own_bucket(self):
+        self.assertEqual([self.get('203.0.113.5').status_code for _ in range(3)], [401, 401, 429])
+        self.assertEqual(self.get('203.0.113.6').status_code, 401)
+        # A client cannot pick its bucket by sending its own X-Forwarded-For
+        self.assertEqual(self.get('198.51.100.1, 203.0.113.5').status_code, 429)
+        response = self.get('203.0.113.5')
+        self.assertEqual(response.status_code, 429)
+        self.assertGreaterEqual(int(response['Retry-After']), 1)
+
+    @override_settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'NUM_PROXIES': 0})
+    def test_without_num_proxies_everyone_shares_the_proxy_bucket(self):
+        self.assertEqual([self.get(f'203.0.113.{n}').status_code for n in range(3)], [401, 401, 429])
+
+    def test_new_orders_are_limited_per_phone(self):
+        maggi = make_product()
+
+        def post(phone):
+            return self.client.post('/api/orders', order_data((maggi, 1), phone=phone), content_type='application/json')
+
+        self.assertEqual(post('9000000001').status_code, 201)
+        self.assertEqual(post('9000000001').status_code, 429)
+        self.assertEqual(post('9000000002').status_code, 201)
+
+    def test_num_proxies_defaults_to_one_on_render(self):
+        path = backend_settings.__file__
+        with mock.patch.dict(os.environ, {'RENDER': 'true'}):
+            os.environ.pop('NUM_PROXIES', None)
+            self.assertEqual(runpy.run_path(path)['REST_FRAMEWORK']['NUM_PROXIES'], 1)
+        with mock.patch.dict(os.environ):
+            os.environ.pop('RENDER', None)
+            os.environ.pop('NUM_PROXIES', None)
+            self.assertEqual(runpy.run_path(path)['REST_FRAMEWORK']['NUM_PROXIES'], 0)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class MetricsRetireTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        patcher = mock.patch.object(metrics, 'metrics_dir', return_value=self.directory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.host = socket.gethostname()
+
+    def write(self, process, orders, age):
+        snapshot = {
+            'process': process,
+            'time': time.time() - age,
+            'metrics': {'orders_expired_total': {
+                'help': 'Expired', 'kind': 'counter', 'labels': [], 'buckets': None, 'values': [[[], orders]],
+            }},
+        }
+        metrics.write_snapshot(self.directory, f'{process}.json', snapshot)
+        return snapshot
+
+    def total(self):
+        """Orders expired across the snapshots, leaving out this process's own counts"""
+        merged = metrics.merge(metrics.load_snapshots())['orders_expired_total']['values']
+        own = {tuple(key): value for key, value in metrics.ORDERS_EXPIRED.snapshot()['values']}
+        return merged[()] - own.get((), 0)
+
+    def dead_pid(self):
+        child = subprocess.Popen(['true'])
+        child.wait()
+        return child.pid
+
+    def test_gone_processes_are_folded_without_losing_counts(self):
+        dead, recent, running = (f'{self.host}-{pid}' for pid in (self.dead_pid(), self.dead_pid(), os.getppid()))
+        self.write(dead, 5, age=metrics.RETIRE_AFTER + 1)
+        self.write(recent, 7, age=10)
+        self.write(running, 11, age=metrics.RETIRE_AFTER + 1)
+        self.write('elsewhere-1', 13, age=metrics.STALE_AFTER + 1)
+        self.write('elsewhere-2', 17, age=metrics.RETIRE_AFTER + 1)
+
+        self.assertEqual(self.total(), 53)
+        self.assertEqual(
+            set(os.listdir(self.directory)),
+            {'retired.json', f'{recent}.json', f'{running}.json', 'elsewhere-2.json'}
+        )
+        retired = metrics.read_snapshots(self.directory)['retired.json']
+        self.assertEqual(retired['processes'], sorted([dead, 'elsewhere-1']))
+
+        # Another dead process later: folded on top, and the totals still add up
+        cache.delete(metrics.RETIRE_KEY)
+        self.write(f'{self.host}-{self.dead_pid()}', 19, age=metrics.RETIRE_AFTER + 1)
+        self.assertEqual(self.total(), 72)
+        self.assertEqual(len(metrics.read_snapshots(self.directory)['retired.json']['processes']), 3)
+
+    def test_stopped_workers_cached_snapshot_is_not_counted_twice(self):
+        worker = self.write(f'{self.host}-{self.dead_pid()}', 5, age=metrics.RETIRE_AFTER + 1)
+        cache.set(metrics.PUBLISHERS_KEY, ['telegram_worker'], None)
+        cache.set(metrics.PUBLISH_KEY.format('telegram_worker'), worker, None)
+        self.assertEqual(self.total(), 5)
+        self.assertEqual(self.total(), 5)
@@ -0,0 +1,174 @@
+"""
+Token-bucket rate limits for the DRF views
+
+Rate limits are DRF throttles configured per scope in settings.THROTTLE_RATES,
+with one bucket per client IP and, where the request body has a phoneNumber,
+one per phone number:
+
+    THROTTLE_RATES = {'order-create': {'ip': '600/min', 'phone': '5/min'}}
+
+A rate 'N/period' is a bucket of N tokens refilled evenly over the period, so
+a client can send N requests at once and then one every period/N. Views pick
+a scope with @throttle(scope); every other DRF view uses 'default'. A refused
+request gets 429 with Retry-After.
+
+Buckets live in process memory, which costs a dict update per request but
+lets each worker enforce the limits on its own. THROTTLE_SHARED keeps them in
+the shared cache instead (one cache read and write per bucket, so use it with
+Redis, not the database cache).
+
+Load shedding, which protects the worker as a whole, is
+middleware.LoadShedMiddleware. bench_throttle times both checks and tries
+them against the views.
+"""
+
+import math
+import re
+import threading
+import time
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from rest_framework.throttling import BaseThrottle
+
+from . import metrics
+
+
+PERIODS = {
+    's': 1, 'sec': 1, 'second': 1,
+    'm': 60, 'min': 60, 'minute': 60,
+    'h': 3600, 'hour': 3600,
+    'd': 86400, 'day': 86400,
+}
+RATE_PATTERN = re.compile(r'^(\d+)/(\d*)([a-z]+?)s?$')
+
+# Past this many buckets in one process, full ones are dropped
+MAX_BUCKETS = 50000
+CACHE_PREFIX = 'throttle:'
+
+
+@lru_cache(maxsize=None)
+def parse_rate(rate):
+    """'10/min' or '5/10min' -> (bucket size, tokens per second)"""
+    match = RATE_PATTERN.match(rate.replace(' ', '').lower())
+    if not match or match[3] not in PERIODS or int(match[1]) < 1:
+        raise ImproperlyConfigured(f'Invalid throttle rate {rate!r}; expected e.g. "10/min" or "5/10min"')
+    size = int(match[1])
+    return size, size / (int(match[2] or 1) * PERIODS[match[3]])
+
+
+def take_token(state, size, refill, now):
+    """
+    Take a token from a bucket in ``state`` ((tokens, updated) or None for a
+    full one). Returns the new state and the seconds to wait, 0 if allowed.
+    """
+    if state is None:
+        tokens = size
+    else:
+        tokens = min(size, state[0] + (now - state[1]) * refill)
+    if tokens >= 1:
+        return (tokens - 1, now), 0.0
+    return (tokens, now), (1 - tokens) / refill
+
+
+class MemoryBuckets:
+    """Buckets in this process"""
+
+    def __init__(self, max_buckets=MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        self.buckets = {}  # key -> (tokens, updated, full_at)
+        self.lock = threading.Lock()
+
+    def take(self, key, size, refill):
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            (tokens, updated), wait = take_token(bucket and bucket[:2], size, refill, now)
+            self.buckets[key] = (tokens, updated, updated + (size - tokens) / refill)
+            if len(self.buckets) > self.max_buckets:
+                self.prune(now)
+        return wait
+
+    def prune(self, now):
+        # A full bucket is the same as no bucket
+        self.buckets = {key: bucket for key, bucket in self.buckets.items() if bucket[2] > now}
+        if len(self.buckets) > self.max_buckets // 2:
+            # Still too many clients at once: forget the ones closest to full
+            keep = sorted(self.buckets.items(), key=lambda item: item[1][2])[-(self.max_buckets // 2):]
+            self.buckets = dict(keep)
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+class CacheBuckets:
+    """
+    Buckets in the shared cache, so the limits hold across workers. The read
+    and write are not atomic: clients racing on one bucket can get a few
+    extra requests through, which is fine for a rate limit.
+    """
+
+    def take(self, key, size, refill):
+        key = CACHE_PREFIX + key
+        state, wait = take_token(cache.get(key), size, refill, time.time())
+        # An untouched bucket is full again after size / refill seconds
+        cache.set(key, state, math.ceil(size / refill) + 1)
+        return wait
+
+
+memory_buckets = MemoryBuckets()
+shared_buckets = CacheBuckets()
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """Applies settings.THROTTLE_RATES[scope] (to ``methods`` only, if set)"""
+    scope = 'default'
+    methods = None
+
+    def allow_request(self, request, view):
+        self.retry_after = 0.0
+        if self.methods is not None and request.method not in self.methods:
+            return True
+        rates = settings.THROTTLE_RATES.get(self.scope)
+        if not rates:
+            return True
+
+        buckets = shared_buckets if settings.THROTTLE_SHARED else memory_buckets
+        for key, rate in rates.items():
+            ident = self.identify(key, request)
+            if ident is None:
+                continue
+            size, refill = parse_rate(rate)
+            wait = buckets.take(f'{self.scope}:{key}:{ident}', size, refill)
+            if wait:
+                metrics.REQUESTS_THROTTLED.inc(scope=self.scope, key=key)
+                self.retry_after = max(self.retry_after, wait)
+        return not self.retry_after
+
+    def identify(self, key, request):
+        if key == 'ip':
+            return self.get_ident(request)
+        if key == 'phone':
+            data = request.data
+            phone = data.get('phoneNumber') if isinstance(data, dict) else None
+            return str(phone)[:32] if phone else None
+        raise ImproperlyConfigured(f'Unknown throttle key {key!r} in THROTTLE_RATES[{self.scope!r}]')
+
+    def wait(self):
+        return self.retry_after
+
+
+def throttle(scope, methods=None):
+    """Rate-limit an @api_view function with THROTTLE_RATES[scope] (put it below @api_view)"""
+    attrs = {'scope': scope, 'methods': frozenset(methods) if methods else None}
+    throttle_class = type('ScopedTokenBucketThrottle', (TokenBucketThrottle,), attrs)
+
+    # What rest_framework.decorators.throttle_classes does; importing it here
+    # would be circular, as DEFAULT_THROTTLE_CLASSES loads this module
+    def decorator(func):
+        func.throttle_classes = [throttle_class]
+        return func
+    return decorator
@@ -0,0 +1,15 @@
+from datetime import datetime, time, timedelta
+
+from django.utils import timezone
+
+
+def local_day_range(day=None):
+    """
+    Return (start, end) of a local calendar day as aware datetimes.
+
+    Filtering on created_at__gte=start, created_at__lt=end can use an index
+    on created_at, unlike created_at__date=day.
+    """
+    day = day or timezone.localdate()
+    start = timezone.make_aware(datetime.combine(day, time.min))
+    return start, start + timedelta(days=1)
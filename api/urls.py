@@ -7,6 +7,7 @@ urlpatterns = [
     path('orders', views.order_list, name='order-list'),
     path('orders/<str:order_id>', views.order_detail, name='order-detail'),
     path('orders/<str:order_id>/cancel', views.order_cancel, name='order-cancel'),
+    path('orders/<str:order_id>/events', views.order_events, name='order-events'),
     
     # Admin endpoints
     path('admin/products', views.product_manage, name='product-manage'),
@@ -16,7 +17,9 @@ urlpatterns = [
     path('admin/orders/<str:order_id>/complete', views.order_complete, name='order-complete'),
     path('admin/stats', views.admin_stats, name='admin-stats'),
     path('admin/low-stock', views.admin_low_stock, name='admin-low-stock'),
+    path('admin/low-stock/thresholds', views.admin_low_stock_thresholds, name='admin-low-stock-thresholds'),
     path('admin/active-orders', views.admin_active_orders, name='admin-active-orders'),
+    path('admin/events', views.admin_events, name='admin-events'),
     path('admin/verify-pin', views.admin_verify_pin, name='admin-verify-pin'),
     path('admin/export', views.export_data, name='export-data'),
     path('admin/clear-database', views.clear_database, name='clear-database'),
@@ -2,16 +2,36 @@ from rest_framework import viewsets, status
 from rest_framework.decorators import api_view, action
 from rest_framework.response import Response
 from django.utils import timezone
-from django.http import JsonResponse, HttpResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import parse_etags
 from django.views.decorators.csrf import csrf_exempt
-from django.db.models import Sum, Count, Q
+from django.views.decorators.http import require_safe
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
 from decimal import Decimal
-import csv
 import json
 import hashlib
+import hmac
 
-from .models import Product, Order, AdminSettings
+from .models import (
+    Product, Order, ArchivedOrder, AdminSettings, SalesRollup, StockMovement, StockSnapshot, StockStripe,
+    OrderEvent, TelegramOutbox, TelegramUpdate,
+)
 from .serializers import ProductSerializer, OrderSerializer
+from .fast_serializers import order_columns, serialize_order, serialize_orders
+from .renderers import render_rows
+from .catalog import aget_catalog, aget_changes
+from .exports import FORMATS as EXPORT_FORMATS, stream_export
+from .order_events import event_stream_response, is_streamable as events_streamable, last_event_id, stream as stream_events
+from .product_updates import apply_updates
+from .telegram_updates import arecord_update, verify_secret as verify_webhook_secret
+from .throttling import throttle
+from .idempotency import idempotent
+from . import low_stock, metrics, rollups
+from .pagination import filter_orders, paginate_orders
+from .timeutils import local_day_range
 
 
 # Admin PIN (stored securely in settings)
@@ -23,12 +43,26 @@ def verify_admin_pin(pin):
     return pin == ADMIN_PIN
 
 
-@api_view(['GET'])
-def product_list(request):
-    """Get all active products"""
-    products = Product.objects.filter(active=True)
-    serializer = ProductSerializer(products, many=True)
-    return Response(serializer.data)
+@require_safe
+async def product_list(request):
+    """Get all active products (served from the versioned catalog cache), or with ?since= the changes since a sync token"""
+    if 'since' in request.GET:
+        response = HttpResponse(await aget_changes(request.GET['since']), content_type='application/json')
+        response['Cache-Control'] = 'no-store'
+        return response
+    
+    etag, body = await aget_catalog()
+    
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match and (etag in parse_etags(if_none_match) or if_none_match.strip() == '*'):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(body, content_type='application/json')
+    
+    response['ETag'] = etag
+    # Let browsers keep the catalog but revalidate it on every visit
+    response['Cache-Control'] = 'no-cache'
+    return response
 
 
 @api_view(['GET', 'POST'])
@@ -77,14 +111,41 @@ def product_detail(request, pk):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+def order_page(request, queryset):
+    """
+    One page of orders, newest first.
+    
+    Query params: limit, cursor (from X-Next-Cursor), status (comma separated),
+    since/until (date or ISO datetime), room, phone, fields (comma separated
+    output fields, e.g. fields=orderId,status to skip items).
+    """
+    fields = request.GET.get('fields')
+    fields = fields.split(',') if fields else None
+    
+    try:
+        queryset = filter_orders(queryset, request.GET).values_list(*order_columns(fields), named=True)
+        orders, next_cursor = paginate_orders(queryset, request.GET)
+        data = serialize_orders(orders, fields)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    response = HttpResponse(render_rows(data), content_type='application/json')
+    if next_cursor:
+        params = request.GET.copy()
+        params['cursor'] = next_cursor
+        response['X-Next-Cursor'] = next_cursor
+        response['Link'] = f'<{request.path}?{params.urlencode()}>; rel="next"'
+    return response
+
+
 @api_view(['GET', 'POST'])
+@idempotent('order-create')
+@throttle('order-create', methods=['POST'])
 @csrf_exempt
 def order_list(request):
-    """List orders or create new order"""
+    """List orders (paginated, see order_page) or create new order"""
     if request.method == 'GET':
-        orders = Order.objects.all()
-        serializer = OrderSerializer(orders, many=True)
-        return Response(serializer.data)
+        return order_page(request, Order.objects.all())
     
     elif request.method == 'POST':
         # Check if user already has an active order (reserved or picked)
@@ -93,7 +154,8 @@ def order_list(request):
             existing_order = Order.objects.filter(
                 phone_number=phone_number,
                 status__in=['reserved', 'picked']
-            ).first()
+            ).order_by().only('order_id')[:1]
+            existing_order = existing_order[0] if existing_order else None
             
             if existing_order:
                 return Response({
@@ -103,31 +165,50 @@ def order_list(request):
         
         serializer = OrderSerializer(data=request.data)
         if serializer.is_valid():
-            order = serializer.save()
-            
-            # Send Telegram notification (non-blocking)
-            try:
-                from .telegram_bot import send_order_notification
+            # Queue the Telegram notification in the order's transaction;
+            # the telegram_worker process delivers it
+            from .telegram_bot import send_order_notification
+            with transaction.atomic():
+                order = serializer.save()
                 send_order_notification(order)
-            except Exception as e:
-                print(f"Telegram notification failed: {e}")
             
             return Response(OrderSerializer(order).data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-@api_view(['GET'])
-def order_detail(request, order_id):
+@require_safe
+async def order_detail(request, order_id):
     """Get order details"""
     try:
-        order = Order.objects.get(order_id=order_id)
-        serializer = OrderSerializer(order)
-        return Response(serializer.data)
+        order = await Order.objects.values_list(*order_columns(), named=True).aget(order_id=order_id)
     except Order.DoesNotExist:
-        return Response({'error': 'Order not found'}, status=status.HTTP_404_NOT_FOUND)
+        return JsonResponse({'error': 'Order not found'}, status=404)
+    body = render_rows(serialize_order(order))
+    return HttpResponse(body, content_type='application/json')
+
+
+@require_safe
+async def order_events(request, order_id):
+    """Live status of one order as server-sent events (see order_events.py)"""
+    if not events_streamable(request):
+        return HttpResponse(status=204)
+    
+    try:
+        order = await Order.objects.values_list('order_id', 'status', 'expires_at', named=True).aget(order_id=order_id)
+    except Order.DoesNotExist:
+        return JsonResponse({'error': 'Order not found'}, status=404)
+    
+    if order.status in ['completed', 'cancelled']:
+        # Nothing more will happen; 204 stops EventSource from reconnecting
+        return HttpResponse(status=204)
+    
+    snapshot = {'orderId': order.order_id, 'status': order.status, 'expiresAt': timezone.localtime(order.expires_at).isoformat()}
+    return event_stream_response(stream_events(order.order_id, last_event_id(request), snapshot))
 
 
 @api_view(['POST'])
+@idempotent('order-cancel')
+@throttle('order-cancel')
 @csrf_exempt
 def order_cancel(request, order_id):
     """Cancel an order"""
@@ -157,14 +238,14 @@ def order_pick(request, order_id):
     try:
         order = Order.objects.get(order_id=order_id)
         
-        if order.mark_picked():
-            # Send Telegram update
-            try:
-                from .telegram_bot import send_order_picked_notification
+        from .telegram_bot import send_order_picked_notification
+        with transaction.atomic():
+            picked = order.mark_picked()
+            if picked:
+                # Queue Telegram update
                 send_order_picked_notification(order)
-            except Exception as e:
-                print(f"Telegram notification failed: {e}")
-            
+        
+        if picked:
             return Response({'message': 'Order marked as picked', 'orderId': order_id})
         else:
             return Response({'error': 'Order cannot be picked'}, status=status.HTTP_400_BAD_REQUEST)
@@ -201,19 +282,23 @@ def admin_stats(request):
     if not verify_admin_pin(pin):
         return Response({'error': 'Unauthorized'}, status=status.HTTP_401_UNAUTHORIZED)
     
-    today = timezone.now().date()
+    today_start, _ = local_day_range()
+    totals = {row.granularity: row for row in rollups.totals(today_start)}
+    today = totals.get('day') or SalesRollup()
+    overall = totals.get('all') or SalesRollup()
+    products = Product.objects.filter(active=True).aggregate(
+        total=Count('id'),
+        low_stock=Count('id', filter=low_stock.low_condition())
+    )
     
     stats = {
-        'totalProducts': Product.objects.filter(active=True).count(),
-        'todayRevenue': Order.objects.filter(
-            created_at__date=today,
-            status='completed'
-        ).aggregate(Sum('total_amount'))['total_amount__sum'] or 0,
-        'todayOrders': Order.objects.filter(created_at__date=today).count(),
-        'lowStockItems': Product.objects.filter(stock__lte=5, active=True).count(),
-        'activeOrders': Order.objects.filter(status__in=['reserved', 'picked']).count(),
-        'completedOrders': Order.objects.filter(status='completed').count(),
-        'cancelledOrders': Order.objects.filter(status='cancelled').count(),
+        'totalProducts': products['total'],
+        'todayRevenue': today.revenue,
+        'todayOrders': today.orders,
+        'lowStockItems': products['low_stock'],
+        'activeOrders': overall.orders - overall.completed - overall.cancellations,
+        'completedOrders': overall.completed,
+        'cancelledOrders': overall.cancellations,
     }
     
     return Response(stats)
@@ -227,26 +312,76 @@ def admin_low_stock(request):
     if not verify_admin_pin(pin):
         return Response({'error': 'Unauthorized'}, status=status.HTTP_401_UNAUTHORIZED)
     
-    threshold = int(request.GET.get('threshold', 5))
-    products = Product.objects.filter(stock__lte=threshold, active=True)
+    # Each product's own threshold unless ?threshold= overrides them all
+    threshold = request.GET.get('threshold')
+    condition = low_stock.low_condition(int(threshold) if threshold else None)
+    products = Product.objects.filter(condition, active=True)
     serializer = ProductSerializer(products, many=True)
     return Response(serializer.data)
 
 
+@api_view(['GET', 'PUT'])
+def admin_low_stock_thresholds(request):
+    """Get or set the low-stock alert thresholds: the default and per-product overrides (null removes one)"""
+    pin = request.headers.get('X-Admin-Pin') or request.GET.get('pin')
+    
+    if not verify_admin_pin(pin):
+        return Response({'error': 'Unauthorized'}, status=status.HTTP_401_UNAUTHORIZED)
+    
+    if request.method == 'PUT':
+        default = request.data.get('default')
+        overrides = request.data.get('products') or {}
+        if not isinstance(overrides, dict):
+            return Response({'error': 'products must be an object of product id: threshold'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        changes = {} if default is None else {low_stock.THRESHOLD_KEY: default}
+        for product_id, value in overrides.items():
+            if not str(product_id).isdigit():
+                return Response({'error': f'Invalid product id: {product_id}'}, status=status.HTTP_400_BAD_REQUEST)
+            changes[low_stock.PRODUCT_THRESHOLD_KEY.format(int(product_id))] = value
+        for value in changes.values():
+            if value is not None and (isinstance(value, bool) or not isinstance(value, int) or value < 0):
+                return Response({'error': f'Threshold must be a non-negative integer: {value!r}'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        with transaction.atomic():
+            for key, value in changes.items():
+                if value is None:
+                    AdminSettings.objects.filter(key=key).delete()
+                else:
+                    AdminSettings.objects.update_or_create(key=key, defaults={'value': str(value)})
+        low_stock.thresholds.reset()
+    
+    default, overrides = low_stock.thresholds.get()
+    return Response({'default': default, 'products': {str(pk): value for pk, value in sorted(overrides.items())}})
+
+
 @api_view(['GET'])
 def admin_active_orders(request):
-    """Get active orders (reserved or picked)"""
+    """Get active orders (reserved or picked), paginated like order_list"""
     pin = request.headers.get('X-Admin-Pin') or request.GET.get('pin')
     
     if not verify_admin_pin(pin):
         return Response({'error': 'Unauthorized'}, status=status.HTTP_401_UNAUTHORIZED)
     
-    orders = Order.objects.filter(status__in=['reserved', 'picked'])
-    serializer = OrderSerializer(orders, many=True)
-    return Response(serializer.data)
+    return order_page(request, Order.objects.filter(status__in=['reserved', 'picked']))
+
+
+@require_safe
+async def admin_events(request):
+    """Live feed of order created/picked/completed/cancelled/expired events"""
+    pin = request.headers.get('X-Admin-Pin') or request.GET.get('pin')
+    
+    if not verify_admin_pin(pin):
+        return JsonResponse({'error': 'Unauthorized'}, status=401)
+    
+    if not events_streamable(request):
+        return HttpResponse(status=204)
+    
+    return event_stream_response(stream_events(after_id=last_event_id(request)))
 
 
 @api_view(['POST'])
+@throttle('admin-pin')
 def admin_verify_pin(request):
     """Verify admin PIN"""
     pin = request.data.get('pin')
@@ -259,60 +394,57 @@ def admin_verify_pin(request):
 
 @api_view(['GET'])
 def export_data(request):
-    """Export data as CSV"""
+    """
+    Stream an export: ?type=products|orders|order_items, ?output=csv|jsonl,
+    ?gzip=1, and for orders the same status/since/until filters as /api/orders
+    """
     pin = request.headers.get('X-Admin-Pin') or request.GET.get('pin')
     
     if not verify_admin_pin(pin):
         return Response({'error': 'Unauthorized'}, status=status.HTTP_401_UNAUTHORIZED)
     
     export_type = request.GET.get('type', 'products')
+    output = request.GET.get('output', 'csv')
+    compress = request.GET.get('gzip') in ('1', 'true')
     
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = f'attachment; filename="{export_type}_{timezone.now().strftime("%Y%m%d")}.csv"'
-    
-    writer = csv.writer(response)
-    
-    if export_type == 'products':
-        writer.writerow(['ID', 'Name', 'Category', 'Price', 'Stock', 'Active'])
-        products = Product.objects.all()
-        for p in products:
-            writer.writerow([p.id, p.name, p.category, p.price, p.stock, p.active])
-    
-    elif export_type == 'orders':
-        writer.writerow(['Order ID', 'Customer', 'Phone', 'Room', 'Total', 'Status', 'Created'])
-        orders = Order.objects.all()
-        for o in orders:
-            writer.writerow([
-                o.order_id, o.customer_name, o.phone_number, o.room_number,
-                o.total_amount, o.status, o.created_at.strftime('%Y-%m-%d %H:%M:%S')
-            ])
-    
+    try:
+        chunks = stream_export(
+            export_type, request.GET, output=output, compress=compress,
+            asynchronous=isinstance(request._request, ASGIRequest)
+        )
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    content_type, extension = EXPORT_FORMATS[output]
+    filename = f'{export_type}_{timezone.now().strftime("%Y%m%d")}.{extension}'
+    if compress:
+        content_type = 'application/gzip'
+        filename += '.gz'
+    
+    response = StreamingHttpResponse(chunks, content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response['X-Accel-Buffering'] = 'no'
     return response
 
 
 @api_view(['POST'])
 def bulk_update_products(request):
-    """Bulk update products (admin only)"""
+    """Bulk update name, category, price, stock or active of many products at once (admin only)"""
     pin = request.headers.get('X-Admin-Pin') or request.data.get('pin')
     
     if not verify_admin_pin(pin):
         return Response({'error': 'Unauthorized'}, status=status.HTTP_401_UNAUTHORIZED)
     
-    updates = request.data.get('updates', [])
-    updated = 0
+    applied, results = apply_updates(request.data.get('updates', []))
+    updated = sum(1 for result in results if result['status'] == 'updated')
     
-    for update in updates:
-        try:
-            product = Product.objects.get(id=update['id'])
-            for key, value in update.items():
-                if key != 'id' and hasattr(product, key):
-                    setattr(product, key, value)
-            product.save()
-            updated += 1
-        except Product.DoesNotExist:
-            pass
+    if not applied:
+        return Response(
+            {'error': 'No products updated: fix the rows with errors and retry', 'results': results},
+            status=status.HTTP_400_BAD_REQUEST
+        )
     
-    return Response({'message': f'{updated} products updated'})
+    return Response({'message': f'{updated} products updated', 'updated': updated, 'results': results})
 
 
 @api_view(['POST'])
@@ -328,56 +460,60 @@ def clear_database(request):
     if confirm != 'DELETE_ALL_DATA':
         return Response({'error': 'Confirmation required'}, status=status.HTTP_400_BAD_REQUEST)
     
-    Product.objects.all().delete()
-    Order.objects.all().delete()
+    with transaction.atomic():
+        Product.objects.all().delete()
+        Order.objects.all().delete()
+        # The dashboard reads the rollups, and rebuild_rollups recounts archived orders
+        ArchivedOrder.objects.all().delete()
+        SalesRollup.objects.all().delete()
+        # The ledger and event tables are not keyed to the rows above, so
+        # they would outlive them: stale movements would show up as drift,
+        # and old events and messages would replay for reused order IDs
+        StockStripe.objects.all().delete()  # Cascades from Product too, but say so
+        StockMovement.objects.all().delete()
+        StockSnapshot.objects.all().delete()
+        OrderEvent.objects.all().delete()
+        TelegramOutbox.objects.all().delete()
     
     return Response({'message': 'All data cleared'})
 
 
 @csrf_exempt
-def telegram_webhook(request):
-    """Handle Telegram webhook for button callbacks"""
+async def telegram_webhook(request):
+    """Record a Telegram update and acknowledge it; the telegram_worker handles it"""
     if request.method != 'POST':
         return JsonResponse({'error': 'Method not allowed'}, status=405)
     
+    if not verify_webhook_secret(request):
+        return JsonResponse({'error': 'Forbidden'}, status=403)
+    
     try:
         data = json.loads(request.body)
-        
-        # Handle callback query (button press)
-        if 'callback_query' in data:
-            callback = data['callback_query']
-            callback_data = callback['data']
-            
-            # Parse callback data (format: "pick_ORDER_ID")
-            if callback_data.startswith('pick_'):
-                order_id = callback_data.split('_')[1]
-                
-                try:
-                    order = Order.objects.get(order_id=order_id)
-                    
-                    if order.mark_picked():
-                        # Send success response
-                        from .telegram_bot import answer_callback_query, edit_message
-                        answer_callback_query(callback['id'], f"Order {order_id} marked as PICKED")
-                        edit_message(
-                            callback['message']['chat']['id'],
-                            callback['message']['message_id'],
-                            f"✅ Order {order_id} - PICKED"
-                        )
-                        
-                        return JsonResponse({'success': True})
-                    else:
-                        from .telegram_bot import answer_callback_query
-                        answer_callback_query(callback['id'], "Order cannot be picked")
-                        return JsonResponse({'error': 'Cannot pick order'})
-                
-                except Order.DoesNotExist:
-                    from .telegram_bot import answer_callback_query
-                    answer_callback_query(callback['id'], "Order not found")
-                    return JsonResponse({'error': 'Order not found'})
-        
-        return JsonResponse({'success': True})
+        data['update_id'] = int(data['update_id'])
+    except (ValueError, TypeError, KeyError):
+        return JsonResponse({'error': 'Invalid update'}, status=400)
     
+    try:
+        if not await arecord_update(data):
+            # Telegram retried an update we already have
+            return JsonResponse({'success': True, 'duplicate': True})
     except Exception as e:
         print(f"Webhook error: {e}")
         return JsonResponse({'error': str(e)}, status=500)
+    
+    return JsonResponse({'success': True})
+
+
+def metrics_view(request):
+    """Prometheus metrics merged across all processes"""
+    token = settings.METRICS_TOKEN
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return HttpResponse('Unauthorized', status=401, content_type='text/plain')
+    
+    gauges = [
+        ('orders_reserved', 'Orders currently holding a reservation', Order.objects.filter(status='reserved').count()),
+        ('telegram_outbox_pending', 'Telegram calls waiting in the outbox', TelegramOutbox.objects.filter(status='pending').count()),
+        ('telegram_updates_pending', 'Webhook updates waiting to be handled', TelegramUpdate.objects.filter(status='pending').count()),
+    ]
+    body = metrics.render(metrics.merge(metrics.load_snapshots()), gauges)
+    return HttpResponse(body, content_type='text/plain; version=0.0.4; charset=utf-8')
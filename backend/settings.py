@@ -5,6 +5,7 @@ Django settings for backend project.
 from pathlib import Path
 import os
 import dj_database_url
+from corsheaders.defaults import default_headers
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -36,9 +37,12 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
+    'api.middleware.StaticFilesMiddleware',
+    'api.middleware.MetricsMiddleware',
+    # Above LoadShedMiddleware, so its 503s carry CORS headers and the frontend can retry them
     'corsheaders.middleware.CorsMiddleware',
+    'api.middleware.LoadShedMiddleware',
+    'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -64,6 +68,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'backend.wsgi.application'
+ASGI_APPLICATION = 'backend.asgi.application'
 
 # Database
 if os.environ.get('DATABASE_URL'):
@@ -78,6 +83,22 @@ else:
         }
     }
 
+# Cache (shared by all gunicorn workers; set REDIS_URL to use Redis instead of the database)
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ.get('REDIS_URL'),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'gograbit_cache',
+        }
+    }
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -105,8 +126,17 @@ STATIC_URL = '/static/'
 STATIC_ROOT = BASE_DIR / 'staticfiles'
 STATICFILES_DIRS = [BASE_DIR / 'frontend']
 
-# WhiteNoise configuration
-STATICFILES_STORAGE = 'whitenoise.storage.CompressedStaticFilesStorage'
+# collectstatic minifies the frontend, gives every file a content-hashed name
+# and precompresses it (gzip and brotli); WhiteNoise serves those names with
+# immutable cache headers (see api/storage.py)
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'api.storage.FrontendStaticFilesStorage',
+    },
+}
 
 # Media files
 MEDIA_URL = '/media/'
@@ -123,6 +153,8 @@ else:
     CORS_ALLOWED_ORIGINS = [origin for origin in cors_origins.split(',') if origin]
 
 CORS_ALLOW_CREDENTIALS = True
+CORS_ALLOW_HEADERS = (*default_headers, 'idempotency-key')
+CORS_EXPOSE_HEADERS = ['Idempotent-Replayed', 'Retry-After']
 
 # CSRF settings
 csrf_origins = os.environ.get('CSRF_TRUSTED_ORIGINS', 'http://localhost:8000,http://127.0.0.1:8000').strip()
@@ -143,17 +175,62 @@ if not DEBUG:
 # REST Framework settings
 REST_FRAMEWORK = {
     'DEFAULT_RENDERER_CLASSES': [
-        'rest_framework.renderers.JSONRenderer',
+        'api.renderers.TimedJSONRenderer',
     ],
     'DEFAULT_PARSER_CLASSES': [
         'rest_framework.parsers.JSONParser',
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': [],  # Disable authentication for public API
+    'DEFAULT_THROTTLE_CLASSES': [
+        'api.throttling.TokenBucketThrottle',
+    ],
+    # Proxies in front of the app that append to X-Forwarded-For; rate limits
+    # take the client IP from there. Render (which sets RENDER) has one: with
+    # 0 there, every client would share the proxy's IP and its rate limits
+    'NUM_PROXIES': int(os.environ.get('NUM_PROXIES', '1' if os.environ.get('RENDER') else '0')),
 }
 
+# Rate limits: token buckets per scope, per client IP and per phone number (see api/throttling.py).
+# Students behind the hostel's NAT share one IP, so the per-IP limits are loose; new orders are
+# limited per phone, and their per-IP bucket is only an abuse ceiling that a rush never reaches.
+THROTTLE_RATES = {
+    'default': {'ip': '600/min'},
+    'order-create': {'ip': '600/min', 'phone': '5/min'},
+    'order-cancel': {'ip': '60/min'},
+    'admin-pin': {'ip': '10/min'},
+}
+# Keep the buckets in the shared cache so the limits hold across workers (use with REDIS_URL)
+THROTTLE_SHARED = os.environ.get('THROTTLE_SHARED', 'False') == 'True'
+
+# Load shedding: above this average latency (seconds) a worker refuses part of its requests with 503; 0 disables
+LOAD_SHED_LATENCY = float(os.environ.get('LOAD_SHED_LATENCY', '1.0'))
+LOAD_SHED_EXEMPT = ('/api/admin/', '/api/telegram/', '/metrics', '/static/')
+
+# Stock ledger (see api/stock.py and api/stock_ledger.py): a product taking STOCK_HOT_RATE or more
+# reservations a minute is split into STOCK_STRIPES counters (0 disables striping); the scheduler
+# in process_expired_orders compacts the ledger every STOCK_COMPACT_INTERVAL seconds
+STOCK_STRIPES = int(os.environ.get('STOCK_STRIPES', '8'))
+STOCK_HOT_RATE = int(os.environ.get('STOCK_HOT_RATE', '120'))
+STOCK_COMPACT_INTERVAL = float(os.environ.get('STOCK_COMPACT_INTERVAL', '10'))
+
 # Telegram Bot Configuration (set via environment variables)
 TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN', '')
 TELEGRAM_CHAT_ID = os.environ.get('TELEGRAM_CHAT_ID', '')
 
+# Above this many new orders a minute a chat gets one live board message instead of a message
+# per order (see api/telegram_board.py); 0 always sends one per order
+TELEGRAM_BOARD_RATE = int(os.environ.get('TELEGRAM_BOARD_RATE', '10'))
+
+# Low-stock alerts (see api/low_stock.py) wait this many seconds so they go out as one digest
+LOW_STOCK_DIGEST_INTERVAL = int(os.environ.get('LOW_STOCK_DIGEST_INTERVAL', '300'))
+
+# Order IDs of finished orders can be reused after this many days
+ORDER_ID_QUIET_DAYS = int(os.environ.get('ORDER_ID_QUIET_DAYS', '7'))
+
+# Metrics: per-process snapshots merged by /metrics (a directory shared by the web workers)
+METRICS_DIR = os.environ.get('METRICS_DIR', '')
+# Bearer token required to scrape /metrics (open if unset)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
 # Admin PIN (change in production!)
 ADMIN_PIN = os.environ.get('ADMIN_PIN', '1234')
@@ -19,21 +19,15 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 from django.views.generic import TemplateView
-from django.views.static import serve
-from django.urls import re_path
+from api.views import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('api.urls')),
+    path('metrics', metrics_view, name='metrics'),
     path('', TemplateView.as_view(template_name='index.html'), name='home'),
     path('admin.html', TemplateView.as_view(template_name='admin.html'), name='admin-panel'),
 ]
 
-# Serve static files (CSS, JS) from root for both dev and production
-urlpatterns += [
-    re_path(r'^(?P<path>.*\.(css|js|png|jpg|jpeg|gif|svg|ico|woff|woff2|ttf))$', 
-            serve, {'document_root': settings.BASE_DIR / 'frontend'}),
-]
-
 # Serve media files (uploaded images) in both dev and production
 urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -6,6 +6,7 @@ pip install -r requirements.txt
 
 python manage.py collectstatic --no-input
 python manage.py migrate
+python manage.py render_thumbnails
 
 # Create admin user from environment variables
 python manage.py create_admin
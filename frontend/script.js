@@ -9,6 +9,7 @@ let darkMode = localStorage.getItem('gg_dark_mode') === '1';
 let offerIndex = 0;
 let offerInterval = null;
 let reserveInterval = null;
+let orderEvents = null;
 
 if (darkMode) document.body.classList.add('dark');
 
@@ -63,13 +64,16 @@ function showToast(message, type = 'info') {
     }, 2200);
 }
 
-// Load Products from Backend
+// Load Products from Backend: only what changed since the last sync is
+// downloaded and merged into the cached catalog (gg_products)
 async function loadProducts() {
     try {
-        const response = await fetch('/api/products');
+        const token = products.length ? localStorage.getItem('gg_catalog_token') : null;
+        const response = await fetch(`/api/products?since=${encodeURIComponent(token || '')}`);
         if (!response.ok) throw new Error('Failed to load products');
-        const fetchedProducts = await response.json();
-        products = fetchedProducts.filter(p => p.active !== false);
+        const changes = await response.json();
+        products = mergeCatalog(changes.full ? [] : products, changes);
+        localStorage.setItem('gg_catalog_token', changes.token);
         saveState();
         return products;
     } catch (error) {
@@ -80,6 +84,42 @@ async function loadProducts() {
     }
 }
 
+function mergeCatalog(current, changes) {
+    const byId = new Map(current.map(p => [p.id, p]));
+    changes.removed.forEach(id => byId.delete(id));
+    changes.products.forEach(p => byId.set(p.id, p));
+    // Same order as the server's catalog
+    return [...byId.values()]
+        .filter(p => p.active !== false)
+        .sort((a, b) => (a.name < b.name ? -1 : a.name > b.name ? 1 : 0));
+}
+
+// POST that survives a flaky connection: every attempt carries the same
+// Idempotency-Key, so the server acts once and replays its response to retries
+async function postWithRetry(url, body, attempts = 3) {
+    const key = window.crypto && crypto.randomUUID
+        ? crypto.randomUUID()
+        : `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+
+    for (let attempt = 1; ; attempt++) {
+        let retryAfter = 0;
+        try {
+            const response = await fetch(url, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json', 'Idempotency-Key': key },
+                body: JSON.stringify(body)
+            });
+            // 409: the first attempt is still running on the server
+            if ((response.status < 500 && response.status !== 409) || attempt >= attempts) return response;
+            retryAfter = Number(response.headers.get('Retry-After')) || 0;
+        } catch (error) {
+            if (attempt >= attempts) throw error;
+        }
+        const delay = Math.min(Math.max(retryAfter * 1000, 500 * attempt), 5000);
+        await new Promise(resolve => setTimeout(resolve, delay));
+    }
+}
+
 // Save/Load State
 function saveState() {
     try {
@@ -127,6 +167,7 @@ async function loadActiveOrder() {
                 showReservation();
                 showReservationBanner();
                 startReservationTimer();
+                watchOrder();
             } else {
                 activeReservation = null;
                 localStorage.removeItem('gg_reservation');
@@ -160,11 +201,15 @@ async function renderRecentOrders() {
     }
 
     try {
-        const response = await fetch('/api/orders');
+        const params = new URLSearchParams({
+            phone: userProfile.phone,
+            limit: '5',
+            fields: 'orderId,status,totalAmount,createdAt'
+        });
+        const response = await fetch(`/api/orders?${params}`);
         if (!response.ok) throw new Error('Failed to fetch orders');
 
-        const allOrders = await response.json();
-        const userOrders = allOrders.filter(order => order.phoneNumber === userProfile.phone).slice(0, 5);
+        const userOrders = await response.json();
 
         const userBox = document.getElementById('userRecentOrders');
         if (userBox) {
@@ -279,6 +324,11 @@ function renderCategories() {
     });
 }
 
+// Build a srcset from the {size: url} thumbnails returned by the API
+function imageSrcset(thumbnails) {
+    return Object.entries(thumbnails).map(([size, url]) => `${url} ${size}w`).join(', ');
+}
+
 // Render Products
 function renderProducts(filterCat, searchQ) {
     const q = (searchQ || searchInput.value || '').toLowerCase();
@@ -303,8 +353,9 @@ function renderProducts(filterCat, searchQ) {
                 <div style="position:relative;width:100%">
                     <div class="p-image">
                         <img src="${p.image || 'https://via.placeholder.com/150?text=' + encodeURIComponent(p.name)}" 
-                             alt="${p.name}" 
-                             onerror="this.onerror=null; this.src='https://via.placeholder.com/150?text=No+Image'">
+                             ${p.thumbnails ? `srcset="${imageSrcset(p.thumbnails)}" sizes="(max-width: 600px) 45vw, 200px"` : ''}
+                             alt="${p.name}" loading="lazy" decoding="async"
+                             onerror="this.onerror=null; this.removeAttribute('srcset'); this.src='https://via.placeholder.com/150?text=No+Image'">
                     </div>
                     <button class="fav-btn ${isFav ? 'active' : ''}" onclick="toggleFavorite(${p.id})" 
                             style="position:absolute;top:8px;right:8px;background:rgba(255,255,255,0.9);border:none;font-size:18px;padding:6px 8px;border-radius:6px;cursor:pointer">❤</button>
@@ -483,21 +534,17 @@ async function confirmReservation() {
     try {
         const total = cart.reduce((s, i) => s + i.qty * i.price, 0);
 
-        const response = await fetch('/api/orders', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({
-                items: cart.map(item => ({
-                    productId: item.id,
-                    name: item.name,
-                    price: item.price,
-                    qty: item.qty
-                })),
-                customerName: name,
-                phoneNumber: phone,
-                roomNumber: room,
-                notes: ''
-            })
+        const response = await postWithRetry('/api/orders', {
+            items: cart.map(item => ({
+                productId: item.id,
+                name: item.name,
+                price: item.price,
+                qty: item.qty
+            })),
+            customerName: name,
+            phoneNumber: phone,
+            roomNumber: room,
+            notes: ''
         });
 
         const data = await response.json();
@@ -524,11 +571,12 @@ async function confirmReservation() {
                     showReservation();
                     showReservationBanner();
                     startReservationTimer();
+                    watchOrder();
                     openReservationDetails();
                 }
                 return;
             }
-            return showToast(data.error || 'Order failed', 'error');
+            return showToast(data.error || data.detail || 'Order failed', 'error');
         }
 
         const until = Date.now() + 15 * 60 * 1000;
@@ -559,6 +607,7 @@ async function confirmReservation() {
         showReservation();
         showReservationBanner();
         startReservationTimer();
+        watchOrder();
         saveState();
 
         showToast(`Order ${activeReservation.id} confirmed!`, 'success');
@@ -641,16 +690,16 @@ async function cancelOrder() {
     if (!activeReservation) return;
     if (!confirm(`Cancel order ${activeReservation.id}?`)) return;
 
+    // Our own cancellation needs no live notification
+    stopWatchingOrder();
     try {
-        const response = await fetch(`/api/orders/${activeReservation.id}/cancel`, {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ reason: 'Customer cancellation' })
+        const response = await postWithRetry(`/api/orders/${activeReservation.id}/cancel`, {
+            reason: 'Customer cancellation'
         });
 
         if (!response.ok) {
             const error = await response.json();
-            throw new Error(error.error || 'Failed to cancel order');
+            throw new Error(error.error || error.detail || 'Failed to cancel order');
         }
 
         activeReservation = null;
@@ -667,6 +716,7 @@ async function cancelOrder() {
     } catch (error) {
         console.error('Cancel order error:', error);
         showToast('Cancellation failed: ' + error.message, 'error');
+        watchOrder();
     }
 }
 
@@ -696,8 +746,13 @@ function startReservationTimer() {
 }
 
 function expireReservation() {
+    endReservation('Reservation expired', 'error');
+}
+
+function endReservation(message, type) {
+    stopWatchingOrder();
     if (!activeReservation) return;
-    showToast('Reservation expired', 'error');
+    showToast(message, type);
     activeReservation = null;
     showReservation();
     renderProducts();
@@ -705,6 +760,50 @@ function expireReservation() {
     saveState();
 }
 
+// Live order status over server-sent events instead of polling. The server
+// answers 204 when it cannot stream (or the order is already finished), which
+// closes the EventSource; then check the order once.
+function watchOrder() {
+    stopWatchingOrder();
+    if (!activeReservation || !window.EventSource) return;
+
+    const id = activeReservation.id;
+    const source = new EventSource(`/api/orders/${id}/events`);
+    orderEvents = source;
+
+    source.addEventListener('status', (e) => {
+        const order = JSON.parse(e.data);
+        if (activeReservation && activeReservation.id === id && order.expiresAt) {
+            activeReservation.until = new Date(order.expiresAt).getTime();
+            saveState();
+        }
+    });
+    source.addEventListener('picked', () => showToast(`Order ${id} is being packed`, 'success'));
+    source.addEventListener('completed', () => endReservation(`Order ${id} completed. Thank you!`, 'success'));
+    source.addEventListener('cancelled', () => endReservation(`Order ${id} was cancelled`, 'error'));
+    source.addEventListener('expired', () => endReservation('Reservation expired', 'error'));
+    source.onerror = async () => {
+        if (source.readyState !== EventSource.CLOSED || orderEvents !== source) return;
+        orderEvents = null;
+        try {
+            const response = await fetch(`/api/orders/${id}`);
+            if (!response.ok) return;
+            const order = await response.json();
+            if (order.status === 'completed') endReservation(`Order ${id} completed. Thank you!`, 'success');
+            else if (order.status === 'cancelled') endReservation(`Order ${id} was cancelled`, 'error');
+        } catch (error) {
+            console.warn('Order status check failed', error);
+        }
+    };
+}
+
+function stopWatchingOrder() {
+    if (orderEvents) {
+        orderEvents.close();
+        orderEvents = null;
+    }
+}
+
 // Event Listeners
 openCartBtn.addEventListener('click', openCart);
 if (closeCartBtn) closeCartBtn.addEventListener('click', closeCart);
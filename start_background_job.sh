@@ -3,7 +3,7 @@
 # Background Job Script for Order Expiration
 
 echo "⏰ Starting Order Expiration Background Job..."
-echo "Checking for expired orders every 5 minutes (300 seconds)"
+echo "Releasing stock as each reservation expires (full resync every 300 seconds)"
 echo "Press Ctrl+C to stop"
 echo ""
 